@@ -0,0 +1,79 @@
+import numpy as np
+from impl.molecule import MoleculeKind
+
+SOAP = MoleculeKind.SoapKind.value
+
+def active_mask(kinds):
+    """
+    3x3 近傍 (自分を含む、周期境界) に 2 種類以上の kind か soap があるセル。
+    それ以外 (純粋な water / air の領域の内側) では swap は同じ分子の交換、rotate は提案されないので、
+    提案しても格子は変わらない。
+    """
+    mixed = np.zeros(kinds.shape, dtype=bool)
+    has_soap = kinds == SOAP
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            ngb = np.roll(kinds, (-dr, -dc), axis=(0, 1))
+            mixed |= ngb != kinds
+            has_soap |= ngb == SOAP
+    return mixed | has_soap
+
+class ActiveSites:
+    """
+    active なセル (active_mask) の集合。sites[:count] に flat index を持ち、where[i] がその位置 (なければ -1)。
+    追加・削除は末尾との入れ替えで O(1)、一様な抽出は sites[rng.integers(count)]。
+    kind が変わったら refresh でその周りだけ判定し直す。
+    """
+    def __init__(self, mols, sites=None):
+        kinds = mols[:, :, 0]
+        self.shape = kinds.shape
+        self.where = np.full(kinds.size, -1, dtype=np.int64)
+        self.sites = np.empty(kinds.size, dtype=np.int64)
+        if sites is None:
+            sites = np.flatnonzero(active_mask(kinds))
+        # checkpoint から戻すときは保存した順番のまま使う (抽出の結果を再現するため)
+        self.count = len(sites)
+        self.sites[:self.count] = sites
+        self.where[sites] = np.arange(self.count)
+
+    def __len__(self):
+        return self.count
+
+    def sample(self, rng):
+        """active なセルを一様に 1 つ選ぶ (row, col)"""
+        return divmod(int(self.sites[rng.integers(self.count)]), self.shape[1])
+
+    def add(self, i):
+        self.where[i] = self.count
+        self.sites[self.count] = i
+        self.count += 1
+
+    def remove(self, i):
+        last = self.sites[self.count - 1]
+        self.sites[self.where[i]] = last
+        self.where[last] = self.where[i]
+        self.where[i] = -1
+        self.count -= 1
+
+    def refresh(self, mols, row_idx, col_idx, radius=2):
+        """(row_idx, col_idx) から radius 以内のセルの active を判定し直す"""
+        n_rows, n_cols = self.shape
+        rows = np.arange(row_idx - radius - 1, row_idx + radius + 2) % n_rows
+        cols = np.arange(col_idx - radius - 1, col_idx + radius + 2) % n_cols
+        window = mols[np.ix_(rows, cols, [0])][:, :, 0]
+        size = 2 * radius + 1
+        center = window[1:1 + size, 1:1 + size]
+        mixed = np.zeros(center.shape, dtype=bool)
+        has_soap = np.zeros(center.shape, dtype=bool)
+        for dr in range(3):
+            for dc in range(3):
+                ngb = window[dr:dr + size, dc:dc + size]
+                mixed |= ngb != center
+                has_soap |= ngb == SOAP
+        active = mixed | has_soap
+        idx = rows[1:1 + size, None] * n_cols + cols[None, 1:1 + size]
+        now = self.where[idx] >= 0
+        for i in idx[active & ~now]:
+            self.add(i)
+        for i in idx[~active & now]:
+            self.remove(i)
@@ -0,0 +1,258 @@
+"""
+MCMC の hot path のベンチマーク。結果を JSON に書いて commit 間で比べる。
+
+- step: Tank.step の sweeps/s と proposals/s (backend × tank_size × soap_ratio)
+- micro: MCMCUtl の 7x7 関数・ΔE 関数、get/embed_neighbor_7x7、write_log の 1 回あたりの時間
+- check: 同じ seed で速い backend が基準 (sequential + 7x7) と同じエネルギー・採択率になるか
+- parallel: ParallelTank の worker 数ごとの sec/step と、1 プロセスの checkerboard に対する speedup・効率
+
+    python -m impl.benchmark --out bench.json
+    python -m impl.benchmark --sizes 50 120 --backends delta checkerboard --out bench.json --compare old.json
+    python -m impl.benchmark --sizes 1000 --backends checkerboard --parallel-workers 1 2 4 8 16 32 --out par.json
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+from impl.tank import Tank, VISIT_PROB
+from impl.stats import SWAP, ROTATE
+
+# backend 名 → Tank の引数。reference が基準の実装
+BACKENDS = {
+    "reference": dict(sweep="sequential", delta_energy=False),
+    "delta": dict(sweep="sequential", delta_energy=True),
+    "checkerboard": dict(sweep="checkerboard"),
+    "active": dict(sweep="active"),
+}
+
+def time_call(fn, min_time=0.2, repeat=3):
+    """fn を min_time 秒以上回すのを repeat 回やって、1 回あたりの最短時間 (秒) を返す"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+def bench_step(backend, tank_size, soap_ratio, water_ratio=0.35, temp_scale=0.3, seed=0, min_time=1.0):
+    """Tank.step の速さ。1 step で各セルは VISIT_PROB で選ばれ、swap と rotate を 1 回ずつ提案する"""
+    tank = Tank(soap_ratio, water_ratio, temp_scale, tank_size=tank_size, seed=seed, **BACKENDS[backend])
+    tank.step()
+    steps = 0
+    start = time.perf_counter()
+    while True:
+        tank.step()
+        steps += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+    proposals = 2 * VISIT_PROB * tank_size * tank_size
+    return dict(backend=backend, tank_size=tank_size, soap_ratio=soap_ratio, steps=steps,
+                sec_per_step=elapsed / steps, sweeps_per_sec=steps / elapsed,
+                proposals_per_sec=proposals * steps / elapsed)
+
+def bench_parallel(workers_list, tank_size=1000, soap_ratio=0.3, water_ratio=0.35, temp_scale=0.3, seed=0,
+                   min_time=2.0):
+    """
+    ParallelTank の worker 数ごとの sec/step。speedup は 1 プロセスの checkerboard (同じ副格子 sweep) に対する比、
+    efficiency は speedup / workers (線形に伸びれば 1)。workers は tank_size // 4 で頭打ちになる
+    """
+    from impl.parallel import ParallelTank
+
+    base = bench_step("checkerboard", tank_size, soap_ratio, water_ratio, temp_scale, seed, min_time)
+    results = []
+    for workers in workers_list:
+        with ParallelTank(soap_ratio, water_ratio, temp_scale, tank_size=tank_size, seed=seed,
+                          workers=workers) as tank:
+            tank.step()
+            sec_per_step = time_call(tank.step, min_time, repeat=1)
+            speedup = base["sec_per_step"] / sec_per_step
+            results.append(dict(workers=tank.workers, tank_size=tank_size, soap_ratio=soap_ratio,
+                                sec_per_step=sec_per_step, speedup=speedup, efficiency=speedup / tank.workers))
+    return dict(baseline_sec_per_step=base["sec_per_step"], runs=results)
+
+def bench_micro(tank_size=120, soap_ratio=0.3, water_ratio=0.35, temp_scale=0.3, seed=0, min_time=0.2):
+    """1 回あたりの時間 (マイクロ秒)"""
+    tank = Tank(soap_ratio, water_ratio, temp_scale, tank_size=tank_size, seed=seed)
+    for _ in range(3):
+        tank.step()
+    mcmc_utl = tank.mcmc_utl
+    rng = np.random.default_rng(seed)
+    centers = rng.integers(tank_size, size=(1024, 2))
+    neighbors = [tank.get_neighbor_7x7(r, c) for r, c in centers]
+    state = dict(i=0)
+
+    def next_idx():
+        state["i"] = (state["i"] + 1) % len(centers)
+        return state["i"]
+
+    def swap_delta():
+        # mols を書き換えるのでコピーに対して行う
+        r, c = centers[next_idx()]
+        mcmc_utl.try_swap_delta(mols, r, c, temp_scale, rng)
+
+    def rotate_delta():
+        r, c = centers[next_idx()]
+        mcmc_utl.try_rotate_delta(mols, r, c, temp_scale, rng)
+
+    def embed():
+        # 窓は同じ中心から切り出したものなので、書き戻しても tank.mols は変わらない
+        i = next_idx()
+        tank.embed_neighbor_7x7(neighbors[i], *centers[i])
+
+    mols = tank.mols.copy()
+    funcs = {
+        "calc_neighbor_energy_7x7": lambda: mcmc_utl.calc_neighbor_energy_7x7(neighbors[next_idx()]),
+        "try_local_swap_7x7": lambda: mcmc_utl.try_local_swap_7x7(neighbors[next_idx()].copy(), temp_scale, rng),
+        "try_local_rotate_7x7": lambda: mcmc_utl.try_local_rotate_7x7(neighbors[next_idx()].copy(), temp_scale, rng),
+        "try_swap_delta": swap_delta,
+        "try_rotate_delta": rotate_delta,
+        "get_neighbor_7x7": lambda: tank.get_neighbor_7x7(*centers[next_idx()]),
+        "embed_neighbor_7x7": embed,
+    }
+    result = {name: time_call(fn, min_time) * 1e6 for name, fn in funcs.items()}
+
+    # write_log は一時ディレクトリに書いて測る
+    with tempfile.TemporaryDirectory() as tmp:
+        tank.log_dir = tmp
+        result["write_log"] = time_call(lambda: tank.write_log("bench", 0), min_time) * 1e6
+    return result
+
+def block_error(x, blocks=10):
+    """step 間の相関を考えて、blocks 個に分けたブロック平均から平均の標準誤差を出す"""
+    means = np.array([b.mean() for b in np.array_split(x, blocks)])
+    return means.std(ddof=1) / np.sqrt(blocks)
+
+def check_backends(backends, tank_size=50, soap_ratio=0.3, steps=200, seed=0, tol_sigma=4.0):
+    """
+    基準 (reference) と各 backend を同じ seed で回して比べる。後半のエネルギーと
+    swap / rotate の採択率 (Tank.stats) の平均が tol_sigma 倍の誤差の範囲で一致するか。
+    ΔE が 0 付近で丸め誤差の分だけ乱数の引き方が変わるので、同じ seed でも軌跡そのものは一致しない。
+    そのため sequential / active の backend は check_delta=True で提案ごとの ΔE を 7x7 の再計算と突き合わせる。
+    """
+    def trace(backend):
+        tank = Tank(soap_ratio, 0.35, 0.3, tank_size=tank_size, seed=seed, stats=True, **BACKENDS[backend])
+        energies, acc = [], []
+        for _ in range(steps):
+            before = tank.stats.counts.copy()
+            tank.step()
+            energies.append(tank.energy)
+            counts = tank.stats.counts - before
+            # move ごとのその step の採択率
+            acc.append(counts[..., 1].sum(axis=(1, 2)) / np.maximum(counts.sum(axis=(1, 2, 3)), 1))
+        assert np.isclose(tank.energy, tank.recompute_energy())
+        return np.array(energies) / (tank_size * tank_size), np.array(acc)
+
+    ref_energy, ref_acc = trace("reference")
+    results = {}
+    for backend in backends:
+        if backend == "reference":
+            continue
+        if BACKENDS[backend].get("sweep") in ("sequential", "active"):
+            # ずれていれば check_delta_energy の assert で止まる
+            tank = Tank(soap_ratio, 0.35, 0.3, tank_size=tank_size, seed=seed, check_delta=True, **BACKENDS[backend])
+            for _ in range(5):
+                tank.step()
+        energy, acc = trace(backend)
+        # 後半を平衡とみなして平均を比べる
+        half = steps // 2
+        stats = {}
+        ok = True
+        for name, a, b in (("energy_per_site", energy[half:], ref_energy[half:]),
+                           ("swap_acceptance", acc[half:, SWAP], ref_acc[half:, SWAP]),
+                           ("rotate_acceptance", acc[half:, ROTATE], ref_acc[half:, ROTATE])):
+            err = np.hypot(block_error(a), block_error(b))
+            stats[name] = [float(a.mean()), float(b.mean())]
+            ok &= bool(abs(a.mean() - b.mean()) <= tol_sigma * err + 1e-12)
+        results[backend] = dict(ok=ok, **stats)
+    return results
+
+def git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.stdout.strip() or None
+    except OSError:
+        return None
+
+def compare(result, old):
+    """old (前の JSON) に対する step の速さの比"""
+    old_steps = {(r["backend"], r["tank_size"], r["soap_ratio"]): r for r in old.get("step", [])}
+    for r in result["step"]:
+        o = old_steps.get((r["backend"], r["tank_size"], r["soap_ratio"]))
+        if o is not None:
+            print("{:>12} N={:<5} soap={:<5} x{:.2f}".format(r["backend"], r["tank_size"], r["soap_ratio"],
+                                                          r["sweeps_per_sec"] / o["sweeps_per_sec"]))
+    for name, t in result["micro"].items():
+        if name in old.get("micro", {}):
+            print("{:>26} x{:.2f}".format(name, old["micro"][name] / t))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="MCMC の hot path のベンチマーク")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[50, 120, 500, 1000])
+    parser.add_argument("--soap-ratios", type=float, nargs="+", default=[0.1, 0.3])
+    parser.add_argument("--backends", nargs="+", default=list(BACKENDS), choices=list(BACKENDS))
+    parser.add_argument("--min-time", type=float, default=1.0, help="1 条件あたりの最短計測時間 (秒)")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--parallel-workers", type=int, nargs="*", default=[],
+                        help="ParallelTank の scaling を測る worker 数 (空なら測らない)")
+    parser.add_argument("--parallel-size", type=int, default=1000)
+    parser.add_argument("--skip-check", action="store_true")
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--compare", default=None, help="比べる前の結果 (JSON)")
+    args = parser.parse_args(argv)
+
+    result = dict(meta=dict(commit=git_commit(), time=time.strftime("%Y-%m-%dT%H:%M:%S"),
+                            python=platform.python_version(), numpy=np.__version__,
+                            machine=platform.machine(), cpu_count=os.cpu_count()),
+                  step=[], micro={}, check={}, parallel={})
+    for tank_size in args.sizes:
+        for soap_ratio in args.soap_ratios:
+            for backend in args.backends:
+                r = bench_step(backend, tank_size, soap_ratio, min_time=args.min_time)
+                print("{:>12} N={:<5} soap={:<5} {:8.3f} sweeps/s {:12.0f} proposals/s".format(
+                    backend, tank_size, soap_ratio, r["sweeps_per_sec"], r["proposals_per_sec"]))
+                result["step"].append(r)
+    if not args.skip_micro:
+        result["micro"] = bench_micro()
+        for name, t in result["micro"].items():
+            print("{:>26} {:10.2f} us".format(name, t))
+    if args.parallel_workers:
+        result["parallel"] = bench_parallel(args.parallel_workers, args.parallel_size, min_time=args.min_time)
+        print("parallel N={} 1 process {:.4f} s/step".format(args.parallel_size,
+                                                            result["parallel"]["baseline_sec_per_step"]))
+        for r in result["parallel"]["runs"]:
+            print("parallel workers={:<3} {:.4f} s/step speedup x{:.2f} efficiency {:.2f}".format(
+                r["workers"], r["sec_per_step"], r["speedup"], r["efficiency"]))
+    if not args.skip_check:
+        result["check"] = check_backends(args.backends)
+        for backend, r in result["check"].items():
+            print("check", backend, "ok" if r["ok"] else "NG", r)
+
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+    if not all(r["ok"] for r in result["check"].values()):
+        print("backend check failed.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+simulation の入口 (画面なしで使える)。サブコマンドは run / render / analyze / monitor。
+
+    python -m impl.cli run --soap-ratio 0.3 --water-ratio 0.35 --temp-scale 0.1 --steps 1001 --out-dir out/exe
+    python -m impl.cli run --config run.json --out-dir out/exe2 --trajectory --checkpoint
+    python -m impl.cli render --log-dir out/exe --out-dir out/exe/png
+    python -m impl.cli analyze out/exe/exe.traj --out out/exe/summary.csv
+    python -m impl.cli run --steps 100001 --out-dir out/long --live long & python -m impl.cli monitor long
+
+- run の設定は引数か --config (JSON。キーは引数の名前で、"temp_scale" でも "temp-scale" でもよい)。
+  両方あれば引数が優先。実際に使った設定は <out-dir>/<out-prefix>_config.json に残す
+- 出力 (.npy / trajectory / checkpoint / 動画 / 観測量) はすべて --out-dir に書く。
+  --checkpoint のとき checkpoint が既にあれば、そこから続きを回す
+- import の重いもの (Tank など) はサブコマンドの中で読み込み、matplotlib は render --matplotlib と
+  monitor (--text なし) のときだけ読み込む
+"""
+
+import os
+import csv
+import json
+import argparse
+
+def add_run_arguments(parser):
+    parser.add_argument("--config", default=None, help="設定の JSON (引数で上書きできる)")
+    parser.add_argument("--soap-ratio", type=float, default=0.3)
+    parser.add_argument("--water-ratio", type=float, default=0.35)
+    parser.add_argument("--temp-scale", type=float, default=0.1)
+    parser.add_argument("--tank-size", type=int, default=120)
+    parser.add_argument("--dims", type=int, default=2, choices=[2, 3], help="3 なら Tank3D")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sweep", default=None, choices=["sequential", "checkerboard", "active"],
+                        help="既定は 2D なら sequential、3D なら checkerboard")
+    parser.add_argument("--moves", nargs="*", default=[],
+                        help="非局所な move の name=確率[,設定=値...] (例 kawasaki=0.1 cluster_translate=0.05,max_size=100)")
+    parser.add_argument("--restart", default=None, help="初期配置の .npy")
+    parser.add_argument("--steps", type=int, default=1001, help="loop_num (checkpoint から再開しても同じ値を渡す)")
+    parser.add_argument("--save-step-num", type=int, default=10)
+    parser.add_argument("--out-dir", default="./log")
+    parser.add_argument("--out-prefix", default="exe")
+    parser.add_argument("--trajectory", action="store_true", help=".npy の代わりに <prefix>.traj に追記する")
+    parser.add_argument("--checkpoint", action="store_true", help="<prefix>_ckpt.npz に保存し、あれば再開する")
+    parser.add_argument("--checkpoint-step-num", type=int, default=1000)
+    parser.add_argument("--video", action="store_true", help="<prefix>.mp4 (ffmpeg が無ければ APNG) を書く")
+    parser.add_argument("--observables", action="store_true", help="観測量の時系列を <prefix>_obs.traj に書く")
+    parser.add_argument("--converge", type=int, default=0,
+                        help="有効サンプル数がこの値になったら止める (ConvergenceMonitor の target_samples。0 なら使わない)")
+    parser.add_argument("--stats", action="store_true", help="採択率と時間を数える (MoveStats)")
+    parser.add_argument("--live", default=None, help="共有メモリの名前 (monitor で run 中の様子を見る)")
+    parser.add_argument("--live-interval", type=float, default=2.0, help="live に publish する間隔 (秒)")
+
+def load_config(path, parser):
+    """--config の JSON を parser の既定値として使える dict にする"""
+    with open(path) as f:
+        config = json.load(f)
+    names = vars(parser.parse_args([]))
+    values = {}
+    for key, value in config.items():
+        name = key.replace("-", "_")
+        if name not in names or name == "config":
+            parser.error("invalid config key in {}: {}".format(path, key))
+        values[name] = value
+    return values
+
+def parse_moves(moves):
+    """
+    ["kawasaki=0.1", "cluster_translate=0.05,max_size=100", ...] か
+    {"kawasaki": 0.1, "cluster_translate": {"prob": 0.05, "max_size": 100}, ...} (--config) -> Tank の moves
+    """
+    if isinstance(moves, dict):
+        return {name: dict(spec) if isinstance(spec, dict) else float(spec) for name, spec in moves.items()}
+    mix = {}
+    for spec in moves:
+        head, *options = spec.split(",")
+        name, prob = head.split("=")
+        if not options:
+            mix[name] = float(prob)
+            continue
+        mix[name] = dict(prob=float(prob))
+        for option in options:
+            key, value = option.split("=")
+            mix[name][key] = int(value)
+    return mix
+
+def run_command(args):
+    import numpy as np
+    from impl.tank import Tank
+    from impl.tank3d import Tank3D
+    from impl.convergence import ConvergenceMonitor
+    from impl.live import LivePublisher
+    from impl.stats import MoveStats
+    from impl.moves import make_moves
+
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    def out_path(suffix):
+        return os.path.join(args.out_dir, args.out_prefix + suffix)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("command", "func", "config", "parser")}
+    with open(out_path("_config.json"), "w") as f:
+        json.dump(config, f, indent=2)
+
+    try:
+        moves = parse_moves(args.moves)
+        make_moves(moves)
+    except ValueError as e:
+        args.parser.error("--moves: {}".format(e))
+    tank_class = Tank3D if args.dims == 3 else Tank
+    checkpoint = out_path("_ckpt.npz") if args.checkpoint else None
+    if checkpoint is not None and os.path.exists(checkpoint):
+        tank = tank_class.from_checkpoint(checkpoint)
+        print("resume from", checkpoint, "step", tank.loop_idx)
+        # checkpoint の設定と食い違う sweep / moves は受け付けない。--stats は再開した run から数え始める
+        if args.sweep is not None and args.sweep != tank.sweep:
+            args.parser.error("--sweep {} conflicts with the checkpoint ({})".format(args.sweep, tank.sweep))
+        if moves and moves != tank.move_mix:
+            args.parser.error("--moves conflicts with the checkpoint ({})".format(tank.move_mix))
+        if args.stats and tank.stats is None:
+            tank.stats = MoveStats()
+    else:
+        sweep = args.sweep or ("checkerboard" if args.dims == 3 else "sequential")
+        restart = np.load(args.restart) if args.restart is not None else None
+        tank = tank_class(args.soap_ratio, args.water_ratio, args.temp_scale, tank_size=args.tank_size, seed=args.seed,
+                          restart=restart, sweep=sweep, stats=args.stats, moves=moves)
+    tank.log_dir = args.out_dir
+
+    convergence = None
+    if args.converge > 0:
+        # 3D では構造の観測量が使えないのでエネルギーだけで判定する
+        observables = () if args.dims == 3 else ("max_cluster_size", "interface_fraction")
+        convergence = ConvergenceMonitor(target_samples=args.converge, observables=observables)
+    live = None
+    if args.live is not None:
+        live = LivePublisher(args.live, tank.mols.shape, tank.metadata(), interval=args.live_interval)
+    try:
+        tank.run(args.steps, args.out_prefix, args.save_step_num,
+                 trajectory=out_path(".traj") if args.trajectory else None, checkpoint=checkpoint,
+                 checkpoint_step_num=args.checkpoint_step_num, video=out_path(".mp4") if args.video else None,
+                 observables=out_path("_obs.traj") if args.observables else None, convergence=convergence, live=live)
+    finally:
+        if live is not None:
+            live.close()
+    if tank.stats is not None:
+        print(json.dumps(tank.stats.summary()))
+
+def load_renderer(parser):
+    """impl/ の隣の renderer.py を、カレントディレクトリによらずに読み込む (無ければ parser.error)"""
+    import importlib.util
+
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "renderer.py")
+    if not os.path.exists(path):
+        parser.error("renderer.py not found: {}".format(path))
+    spec = importlib.util.spec_from_file_location("renderer", path)
+    renderer = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(renderer)
+    return renderer
+
+def render_command(args):
+    from impl import raster
+
+    os.makedirs(args.out_dir, exist_ok=True)
+    jobs = raster.collect_jobs(args.log_dir, args.out_dir)
+    print(len(jobs), "frames")
+    if args.matplotlib:
+        # renderer.py (impl/ と同じ階層) の matplotlib 版。ここで初めて matplotlib を読み込む
+        renderer = load_renderer(args.parser)
+        for src, out in jobs:
+            print("render:", out)
+            renderer.render(raster.load_frame(src), out)
+    else:
+        raster.render_frames(jobs, scale=args.scale, processes=args.processes)
+
+def iter_frames(path):
+    """.npy か .traj の (step, 格子, metadata) (.npy の step はファイル名の _step_xxx から)"""
+    import numpy as np
+    from impl.trajectory import TrajectoryReader
+
+    if path.endswith(".npy"):
+        name = os.path.splitext(os.path.basename(path))[0]
+        yield int(name.split("_")[-1]), np.load(path), {}
+        return
+    with TrajectoryReader(path) as reader:
+        metadata = reader.metadata
+        for step, frame in reader:
+            yield step, np.asarray(frame), metadata
+
+def analyze_command(args):
+    from impl.molecule import LEC, LocalEnergyConstant
+    from impl.lattice import LatticeKernel
+    from impl.lattice3d import LatticeKernel3D
+    from impl.observables import SCALAR_COLUMNS, compute_observables
+
+    rows = []
+    for path in args.paths:
+        kernels = {}
+        for step, mols, metadata in iter_frames(path):
+            lec = LocalEnergyConstant(**metadata["lec"]) if "lec" in metadata else LEC
+            if mols.ndim not in kernels:
+                kernels[mols.ndim] = (LatticeKernel3D if mols.ndim == 4 else LatticeKernel)(lec)
+            row = dict(path=path, step=step,
+                       energy_per_site=float(kernels[mols.ndim].total_energy(mols) / mols[..., 0].size))
+            # 構造の観測量は 2D だけ
+            if mols.ndim == 3:
+                values = compute_observables(mols, args.micelle_min_size)
+                row.update({name: float(values[i]) for i, name in enumerate(SCALAR_COLUMNS)})
+            rows.append(row)
+            print(" ".join("{} {}".format(k, "{:.4f}".format(v) if isinstance(v, float) else v)
+                           for k, v in row.items()))
+    if args.out is not None and rows:
+        fieldnames = list(max(rows, key=len))
+        with open(args.out, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+
+def monitor_command(args):
+    from impl.live import watch
+
+    try:
+        watch(args.name, text=args.text, poll=args.poll)
+    except (FileNotFoundError, ValueError) as e:
+        args.parser.error(str(e))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="soap / water / air 格子の simulation (run / render / analyze / monitor)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Tank を回して --out-dir に書く")
+    add_run_arguments(run_parser)
+    run_parser.set_defaults(func=run_command, parser=run_parser)
+
+    render_parser = subparsers.add_parser("render", help="--log-dir の .npy / .traj を PNG にする")
+    render_parser.add_argument("--log-dir", default="./log")
+    render_parser.add_argument("--out-dir", default="./png")
+    render_parser.add_argument("--scale", type=int, default=8, help="1 セルのピクセル数")
+    render_parser.add_argument("--processes", type=int, default=None, help="None なら CPU 数")
+    render_parser.add_argument("--matplotlib", action="store_true", help="renderer.py の matplotlib 版で描く (遅い)")
+    render_parser.set_defaults(func=render_command, parser=render_parser)
+
+    analyze_parser = subparsers.add_parser("analyze", help=".npy / .traj のフレームごとのエネルギーと構造の観測量")
+    analyze_parser.add_argument("paths", nargs="+")
+    analyze_parser.add_argument("--micelle-min-size", type=int, default=10)
+    analyze_parser.add_argument("--out", default=None, help="CSV")
+    analyze_parser.set_defaults(func=analyze_command)
+
+    monitor_parser = subparsers.add_parser("monitor", help="run --live NAME の run を共有メモリから表示する")
+    monitor_parser.add_argument("name")
+    monitor_parser.add_argument("--text", action="store_true", help="matplotlib を使わず 1 行ずつ表示する")
+    monitor_parser.add_argument("--poll", type=float, default=0.5, help="新しい snapshot を見に行く間隔 (秒)")
+    monitor_parser.set_defaults(func=monitor_command, parser=monitor_parser)
+
+    args = parser.parse_args(argv)
+    if args.command == "run" and args.config is not None:
+        run_parser.set_defaults(**load_config(args.config, run_parser))
+        args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+平衡化の判定と run の打ち切り。Tank.run(..., convergence=ConvergenceMonitor(...)) で使う。
+
+sample_step_num step ごとに全エネルギーと選んだ観測量 (impl/observables.py の COLUMNS) を記録し、
+check_sample_num サンプルごとに次を判定する。
+
+- 平衡化の終わり t0: 捨てる先頭の長さの候補ごとに、残りの有効サンプル数 n / (2 tau) (全系列の最小) を出し、
+  それが最大になる t0 を選ぶ (短すぎると初期の緩和で分散と tau が膨らみ、長すぎると n が減る)
+- tau (積分自己相関時間): ブロック長 b を倍々にした blocking で 2 tau = b Var(ブロック平均) / Var(x)
+- drift: t0 以降の前半と後半の平均の差が、それぞれの標準誤差の drift_sigma 倍以内か
+
+全系列で drift がなく、有効サンプル数が target_samples 以上になったら平衡と判定して run を止める。
+判定と推定した統計量は summary() で Tank.metadata() (checkpoint など) に残る。
+"""
+
+import numpy as np
+from impl.observables import COLUMNS, compute_observables
+
+def integrated_time(x, min_blocks=32):
+    """
+    blocking による積分自己相関時間 (サンプル単位、無相関なら 0.5)。
+    ブロック長 b を 1, 2, 4, ... と倍にしながら (ブロックが min_blocks 個以上残る間)
+    2 tau = b Var(ブロック平均) / Var(x) を計算し、最大値を返す (b が tau より短いと過小評価になるので、
+    平らになったところの値を少し大きめに取る)。min_blocks より短い系列では inf
+    """
+    if len(x) < min_blocks:
+        return np.inf
+    var = x.var()
+    if var == 0:
+        return 0.5
+    tau = 0.5
+    b = 1
+    while len(x) // b >= min_blocks:
+        n = len(x) // b
+        means = x[:b * n].reshape(n, b).mean(axis=1)
+        tau = max(tau, 0.5 * b * means.var(ddof=1) / var)
+        b *= 2
+    return tau
+
+def detect_equilibration(series, min_blocks=32, candidates=20):
+    """
+    series (n, 系列数) の平衡化の終わり t0 (サンプル単位) と、t0 以降の系列ごとの tau (サンプル単位)。
+    t0 は [0, n/2] を candidates 等分した候補から、全系列の有効サンプル数の最小が最大になるものを選ぶ
+    """
+    n = len(series)
+    best = (-1.0, 0, None)
+    for t0 in np.unique(np.linspace(0, n // 2, candidates + 1).astype(int)):
+        taus = np.array([integrated_time(x, min_blocks) for x in series[t0:].T])
+        n_eff = ((n - t0) / (2 * taus)).min()
+        if n_eff > best[0]:
+            best = (n_eff, t0, taus)
+    return best[1], best[2]
+
+def drift_z(x, tau):
+    """前半と後半の平均の差 / その標準誤差 (tau は x のサンプル単位の自己相関時間)"""
+    half = len(x) // 2
+    a, b = x[:half], x[half:]
+    se2 = 2 * tau * (a.var() / len(a) + b.var() / len(b))
+    diff = abs(a.mean() - b.mean())
+    if se2 == 0:
+        return 0.0 if diff == 0 else np.inf
+    return diff / np.sqrt(se2)
+
+class ConvergenceMonitor:
+    """
+    Tank.run に渡す平衡化の monitor。observables は COLUMNS の名前のリスト (エネルギーは常に見る)。
+    min_samples サンプルたまるまでは判定しない。
+    """
+    def __init__(self, target_samples=100, observables=("max_cluster_size", "interface_fraction"),
+                 sample_step_num=10, check_sample_num=50, min_samples=200, drift_sigma=3.0, min_blocks=32,
+                 micelle_min_size=10):
+        for name in observables:
+            assert name in COLUMNS
+        self.target_samples = target_samples
+        self.observables = list(observables)
+        self.columns = [COLUMNS.index(name) for name in self.observables]
+        self.sample_step_num = sample_step_num
+        self.check_sample_num = check_sample_num
+        self.min_samples = min_samples
+        self.drift_sigma = drift_sigma
+        self.min_blocks = min_blocks
+        self.micelle_min_size = micelle_min_size
+        # 記録したサンプル (行: [エネルギー, 観測量...]) と、その step
+        self.samples = []
+        self.steps = []
+        self.converged = False
+        self.result = None
+
+    @property
+    def names(self):
+        return ["energy"] + self.observables
+
+    def update(self, tank):
+        """step の後に呼ぶ。平衡と判定したら True"""
+        if self.converged:
+            return True
+        step = tank.loop_idx
+        if step % self.sample_step_num != 0:
+            return False
+        row = [tank.energy]
+        if self.columns:
+            row.extend(compute_observables(tank.mols, self.micelle_min_size)[self.columns])
+        self.samples.append(row)
+        self.steps.append(step)
+        n = len(self.samples)
+        if n < self.min_samples or n % self.check_sample_num != 0:
+            return False
+        self.check(step)
+        return self.converged
+
+    def check(self, step):
+        """いまのサンプルで判定して self.result を更新する"""
+        series = np.array(self.samples)
+        t0, taus = detect_equilibration(series, self.min_blocks)
+        prod = series[t0:]
+        stats = {}
+        for name, x, tau in zip(self.names, prod.T, taus):
+            n_eff = len(x) / (2 * tau)
+            stats[name] = dict(tau_steps=float(tau * self.sample_step_num), n_eff=float(n_eff),
+                               mean=float(x.mean()), stderr=float(x.std() / np.sqrt(n_eff)),
+                               drift_z=float(drift_z(x, tau)))
+        self.converged = bool(all(s["n_eff"] >= self.target_samples and s["drift_z"] < self.drift_sigma
+                                  for s in stats.values()))
+        self.result = dict(converged=self.converged, checked_step=int(step),
+                           equilibration_step=int(self.steps[t0]), series=stats)
+
+    def format_line(self):
+        if self.result is None:
+            return "convergence: {} samples".format(len(self.samples))
+        stats = self.result["series"]
+        return "convergence: eq {} n_eff {:.0f} max drift {:.1f}{}".format(
+            self.result["equilibration_step"], min(s["n_eff"] for s in stats.values()),
+            max(s["drift_z"] for s in stats.values()), " (converged)" if self.converged else "")
+
+    def summary(self):
+        """run の metadata に残す設定と判定結果"""
+        return dict(target_samples=self.target_samples, observables=self.observables,
+                    sample_step_num=self.sample_step_num, check_sample_num=self.check_sample_num,
+                    min_samples=self.min_samples, drift_sigma=self.drift_sigma, min_blocks=self.min_blocks,
+                    micelle_min_size=self.micelle_min_size, result=self.result)
+
+    @classmethod
+    def from_summary(cls, summary, samples, steps):
+        """checkpoint から戻す (summary と記録したサンプル)"""
+        params = {k: v for k, v in summary.items() if k != "result"}
+        monitor = cls(**params)
+        monitor.samples = [list(row) for row in samples]
+        monitor.steps = list(steps)
+        monitor.result = summary["result"]
+        monitor.converged = bool(monitor.result and monitor.result["converged"])
+        return monitor
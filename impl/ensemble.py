@@ -0,0 +1,187 @@
+"""
+同じ設定の小さな Tank を n_replicas 個まとめて回す ensemble。
+格子は (R, N, N, 2) の 1 つの配列に積み、副格子 sweep (LatticeKernel) を全 replica について一括で行うので、
+Python のループの回数は replica の数によらない (64 個の 50x50 が 1 つの大きな格子とほぼ同じ手間で回る)。
+
+各 replica は普通の Tank (self.tanks[r]) で、mols は ensemble の配列の view になっている。
+乱数は replica ごとに SeedSequence.spawn した独立な stream で、replica r の軌跡は
+その seed だけで決まる (n_replicas を変えても、他の replica があっても同じ)。
+ログ・trajectory・観測量・checkpoint は replica ごとに Tank のものをそのまま使う。
+"""
+
+import time
+import numpy as np
+from impl.molecule import LEC, MoleculeKind
+from impl.lattice import SUBLATTICE_STRIDE
+from impl.tank import Tank, VISIT_PROB
+from impl.stats import MoveStats, SWAP, ROTATE
+
+SOAP = MoleculeKind.SoapKind.value
+
+class EnsembleTank:
+    """
+    n_replicas 個の Tank (sweep="checkerboard" と同じ更新) の一括版。temp_scale は replica ごとの配列でもよい。
+    restart は (N, N, 2) (全 replica 共通) か (R, N, N, 2)。
+    1 step の提案の分布は Tank(sweep="checkerboard") と同じだが、乱数は step ごとにまとめて引くので
+    同じ seed の Tank とは軌跡は一致しない。
+    """
+    def __init__(self, soap_ratio, water_ratio, temp_scale, n_replicas=64, tank_size=50, seed=0, restart=None,
+                 lec=LEC, stats=False):
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        temps = np.broadcast_to(np.asarray(temp_scale, dtype=float), (n_replicas,))
+        if restart is not None:
+            restart = np.asarray(restart)
+            if restart.ndim == 3:
+                restart = np.broadcast_to(restart, (n_replicas,) + restart.shape)
+        tanks = [Tank(soap_ratio, water_ratio, float(temps[r]), tank_size=tank_size, seed=replica_seed,
+                      restart=None if restart is None else restart[r], lec=lec, sweep="checkerboard")
+                 for r, replica_seed in enumerate(seed.spawn(n_replicas))]
+        self.set_tanks(tanks, stats)
+
+    def set_tanks(self, tanks, stats=False):
+        """tanks の格子を 1 つの配列に積み、各 Tank の mols をその view にする"""
+        assert len({tank.loop_idx for tank in tanks}) == 1
+        self.tanks = tanks
+        self.n_replicas = len(tanks)
+        self.tank_size = tanks[0].tank_size
+        self.kernel = tanks[0].kernel
+        self.mols = np.stack([tank.mols for tank in tanks])
+        for r, tank in enumerate(tanks):
+            tank.mols = self.mols[r]
+        self.loop_idx = tanks[0].loop_idx
+        self.stats = MoveStats() if stats else None
+        # 副格子の色 (原点のずらし方) と、1 つの副格子の 1 辺の点の数
+        colors = np.meshgrid(*[np.arange(SUBLATTICE_STRIDE)] * self.kernel.ndim, indexing="ij")
+        self.colors = np.stack(colors, axis=-1).reshape(-1, self.kernel.ndim)
+        self.n_sub = self.tank_size // SUBLATTICE_STRIDE
+
+    @property
+    def energies(self):
+        """replica ごとの全エネルギー"""
+        return np.array([tank.energy for tank in self.tanks])
+
+    @property
+    def temps(self):
+        return np.array([tank.temp_scale for tank in self.tanks])
+
+    def draw(self):
+        """
+        1 step 分の乱数を replica ごとに自分の rng からまとめて引く。
+        (副格子の原点のずらし (R, 2)、色の順番 (R, 色数)、一様乱数 (R, 3, 色数, 点数)、整数 (R, 色数, 点数))
+        一様乱数は [visit, swap の採択, rotate の採択]、整数は swap の方向 + 8 * rotate の向き
+        """
+        R, n_colors, n_points = self.n_replicas, len(self.colors), self.n_sub ** self.kernel.ndim
+        n_dirs, n_rots = len(self.kernel.offsets), self.kernel.rotations.shape[1]
+        shifts = np.empty((R, self.kernel.ndim), dtype=np.int64)
+        orders = np.empty((R, n_colors), dtype=np.int64)
+        u = np.empty((R, 3, n_colors, n_points))
+        moves = np.empty((R, n_colors, n_points), dtype=np.int64)
+        for r, tank in enumerate(self.tanks):
+            rng = tank.rng
+            shifts[r] = rng.integers(SUBLATTICE_STRIDE, size=self.kernel.ndim)
+            orders[r] = rng.permutation(n_colors)
+            rng.random(out=u[r])
+            moves[r] = rng.integers(n_dirs * n_rots, size=(n_colors, n_points))
+        return shifts, orders, u, moves
+
+    def step(self):
+        """全 replica を 1 step 進める。色ごとに全 replica の副格子を 1 つの index 配列にして swap → rotate"""
+        R, N, kernel, stats = self.n_replicas, self.tank_size, self.kernel, self.stats
+        n_dirs = len(kernel.offsets)
+        shifts, orders, u, moves = self.draw()
+        temps = self.temps
+        grid = SUBLATTICE_STRIDE * np.arange(self.n_sub)
+        shape = (R, self.n_sub, self.n_sub)
+        rep = np.repeat(np.arange(R), self.n_sub * self.n_sub)
+        dE_sum = np.zeros(R)
+        for k in range(len(self.colors)):
+            origin = shifts + self.colors[orders[:, k]]
+            rows = np.broadcast_to((origin[:, 0, None, None] + grid[:, None]) % N, shape).ravel()
+            cols = np.broadcast_to((origin[:, 1, None, None] + grid[None, :]) % N, shape).ravel()
+            visit = u[:, 0, k].ravel() < VISIT_PROB
+            pos = (rep[visit], rows[visit], cols[visit])
+            move = moves[:, k].ravel()[visit]
+            swap_pos, rot_idx = move % n_dirs, move // n_dirs
+            temp = temps[pos[0]]
+            if stats is not None:
+                kind_a = self.mols[pos][:, 0]
+                kind_b = self.mols[kernel.shift(self.mols, pos, swap_pos)][:, 0]
+            accepted, dE = kernel.try_swap(self.mols, pos, swap_pos, u[:, 1, k].ravel()[visit], temp)
+            dE_sum += np.bincount(pos[0][accepted], dE[accepted], minlength=R)
+            if stats is not None:
+                stats.count_array(SWAP, kind_a, kind_b, accepted)
+            # try_rotate は swap 後の soap だけを対象にするので、同じ絞り込みで replica を対応させる
+            soap_rep = pos[0][self.mols[pos][:, 0] == SOAP]
+            accepted, dE = kernel.try_rotate(self.mols, pos, rot_idx, u[:, 2, k].ravel()[visit], temp)
+            dE_sum += np.bincount(soap_rep[accepted], dE[accepted], minlength=R)
+            if stats is not None:
+                stats.count_array(ROTATE, MoleculeKind.SoapKind, MoleculeKind.SoapKind, accepted)
+        for r, tank in enumerate(self.tanks):
+            tank.energy += dE_sum[r]
+
+    def run(self, loop_num, out_prefix, save_step_num, trajectory=None, observables=None, checkpoint=None,
+            checkpoint_step_num=1000):
+        """
+        Tank.run の ensemble 版。loop_idx が loop_num になるまで全 replica を進める。
+        出力は replica ごとで、write_log は <out_prefix>_r<replica>_step_xxxxx.npy、
+        trajectory / observables / checkpoint は "{}" に replica の index を入れるパスの書式
+        (例: "log/ens_r{}.traj")。各 Tank の energy_trace も step ごとに記録する。
+        """
+        tanks = self.tanks
+        writers = [tank.open_trajectory(trajectory.format(r)) for r, tank in enumerate(tanks)] if trajectory else None
+        recorders = ([tank.open_observables(observables.format(r)) for r, tank in enumerate(tanks)]
+                     if observables else None)
+        stats = self.stats
+        try:
+            for loop_idx in range(self.loop_idx, loop_num):
+                if stats is not None:
+                    start = time.perf_counter()
+                self.step()
+                if stats is not None:
+                    io_start = time.perf_counter()
+                    stats.add_step_time(io_start - start)
+                self.loop_idx = loop_idx + 1
+                for tank in tanks:
+                    tank.loop_idx = self.loop_idx
+                    tank.energy_trace.append(tank.energy)
+                if loop_idx % save_step_num == 0:
+                    if stats is None:
+                        print(loop_idx)
+                    else:
+                        print(loop_idx, stats.format_line())
+                    for r, tank in enumerate(tanks):
+                        if writers is None:
+                            tank.write_log("{}_r{}".format(out_prefix, r), loop_idx)
+                        else:
+                            writers[r].append(loop_idx, tank.mols)
+                        if recorders is not None:
+                            recorders[r].record(loop_idx, tank.mols)
+                if checkpoint is not None and self.loop_idx % checkpoint_step_num == 0:
+                    self.flush_outputs(writers, recorders)
+                    self.save_checkpoint(checkpoint)
+                if stats is not None:
+                    stats.io_time += time.perf_counter() - io_start
+            if checkpoint is not None:
+                self.flush_outputs(writers, recorders)
+                self.save_checkpoint(checkpoint)
+        finally:
+            for writer in (writers or []) + (recorders or []):
+                writer.close()
+
+    def flush_outputs(self, writers, recorders):
+        """checkpoint の前に trajectory と観測量をディスクまで書く (Tank.run と同じ)"""
+        for writer in (writers or []) + (recorders or []):
+            writer.flush()
+
+    def save_checkpoint(self, path):
+        """replica ごとに Tank.save_checkpoint する。path は "{}" に replica の index を入れる書式"""
+        for r, tank in enumerate(self.tanks):
+            tank.save_checkpoint(path.format(r))
+
+    @classmethod
+    def from_checkpoint(cls, path, n_replicas, stats=False):
+        """save_checkpoint した ensemble を復元する (続けて同じ run を呼べば中断しなかった場合と同じ結果になる)"""
+        ensemble = cls.__new__(cls)
+        ensemble.set_tanks([Tank.from_checkpoint(path.format(r)) for r in range(n_replicas)], stats)
+        return ensemble
@@ -0,0 +1,198 @@
+"""
+rejection-free (n-fold way / BKL) の kinetic Monte Carlo。
+すべての swap (隣り合う 2 セルの組) と rotate (soap の ±45°) について Metropolis の採択確率 × 提案の頻度を
+rate として sum tree に持ち、次に起きる move を rate に比例して直接選んで、待ち時間 (指数分布) だけ時計を進める。
+棄却がないので、ほとんどの提案が棄却される低温 (temp_scale=0.1 など) で速い。
+
+時間の単位は Tank.step の 1 step: sequential の step では各セルが VISIT_PROB で中心になり、
+8 方向の 1 つと swap、続けて ±45° の 1 つに rotate を提案するので、
+swap の組 1 つあたりの提案の頻度は 2 * VISIT_PROB / 8、rotate は VISIT_PROB / 2 (1 step あたり)。
+"""
+
+import numpy as np
+from impl.molecule import LEC, MoleculeKind
+from impl.tank import Tank, VISIT_PROB
+from impl.stats import SWAP, ROTATE
+
+# swap の組を 1 回ずつ数えるための片側 4 方向 (directions の index: (0,1), (1,1), (1,0), (1,-1))
+HALF_DIRS = np.array([3, 4, 5, 6])
+N_HALF = len(HALF_DIRS)
+N_ROT = 2
+OFFSETS_3X3 = np.array([[dr, dc] for dr in (-1, 0, 1) for dc in (-1, 0, 1)])
+SWAP_FREQ = 2 * VISIT_PROB / 8
+ROTATE_FREQ = VISIT_PROB / N_ROT
+
+class SumTree:
+    """
+    葉に非負の値を持ち、和と「累積和が u を超える葉」を O(log n) で求める完全二分木 (配列表現)。
+    親は子の和から毎回計算し直すので、更新を繰り返しても丸め誤差はたまらない。
+    """
+    def __init__(self, values):
+        self.n = len(values)
+        self.size = 1 << max(0, int(np.ceil(np.log2(max(self.n, 1)))))
+        self.tree = np.zeros(2 * self.size)
+        self.tree[self.size:self.size + self.n] = values
+        lo = self.size
+        while lo > 1:
+            parents = np.arange(lo // 2, lo)
+            self.tree[parents] = self.tree[2 * parents] + self.tree[2 * parents + 1]
+            lo //= 2
+
+    @property
+    def total(self):
+        return self.tree[1]
+
+    def __getitem__(self, idx):
+        return self.tree[self.size + idx]
+
+    def update(self, idx, values):
+        """
+        葉 idx (配列) を values にして、根までの親を下の段から計算し直す。
+        同じ親が重複しても同じ値を書くだけなので、unique は取らない。
+        """
+        node = self.size + np.asarray(idx)
+        self.tree[node] = values
+        tree = self.tree
+        while node[0] > 1:
+            node = node >> 1
+            tree[node] = tree[2 * node] + tree[2 * node + 1]
+
+    def find(self, u):
+        """累積和が u を超える最初の葉 (0 <= u < total)"""
+        tree = self.tree
+        node = 1
+        while node < self.size:
+            left = tree[2 * node]
+            if u < left:
+                node = 2 * node
+            else:
+                u -= left
+                node = 2 * node + 1
+        return node - self.size
+
+class KMCTank(Tank):
+    """
+    n-fold way で時間発展する Tank。step() は時計を 1 (Tank.step 1 回分) 進める。
+    move の id は swap が cell * 4 + h (相手は HALF_DIRS[h] 方向)、rotate が 4 * N^2 + cell * 2 + r。
+    1 つ move を起こすたびに、ΔE が変わりうる move (変化したセルの 3x3 に端を持つもの) の rate だけ計算し直す。
+    平衡分布は Metropolis の Tank と同じ (各 move が同じ ΔE で詳細つり合いを満たす)。
+    """
+    def __init__(self, soap_ratio, water_ratio, temp_scale, tank_size=100, seed=0, restart=None, lec=LEC,
+                 delta_energy=True, check_delta=False, sweep="kmc", stats=False, moves=None):
+        # 非局所な move (moves) には対応していない
+        assert not moves
+        super().__init__(soap_ratio, water_ratio, temp_scale, tank_size=tank_size, seed=seed, restart=restart,
+                         lec=lec, delta_energy=delta_energy, check_delta=check_delta, stats=stats)
+        self.sweep = "kmc"
+        # 経過時間 (step 単位)
+        self.time = 0.0
+        self.move_num = 0
+        self.n_cells = tank_size * tank_size
+        self.rot_begin = N_HALF * self.n_cells
+        self.build()
+
+    def build(self):
+        """全 move の rate を計算して sum tree を作り直す (temp_scale を変えたときも呼ぶ)"""
+        self.rate_temp = self.temp_scale
+        ids = np.arange(self.rot_begin + N_ROT * self.n_cells)
+        self.dE = np.zeros(len(ids))
+        rates = self.move_rates(ids)
+        self.tree = SumTree(rates)
+
+    def move_rates(self, ids):
+        """move ids の rate。ついでに self.dE[ids] を更新する"""
+        rates = np.zeros(len(ids))
+        is_swap = ids < self.rot_begin
+        swap_ids = ids[is_swap]
+        if len(swap_ids):
+            cell, h = np.divmod(swap_ids, N_HALF)
+            pos = np.divmod(cell, self.tank_size)
+            swap_pos = HALF_DIRS[h]
+            dE = self.kernel.swap_delta_energy(self.mols, pos, swap_pos)
+            # 同じ状態どうしの swap は何も変えないので数えない
+            tgt = self.kernel.shift(self.mols, pos, swap_pos)
+            same = self.kernel.state(self.mols, pos) == self.kernel.state(self.mols, tgt)
+            self.dE[swap_ids] = dE
+            rates[is_swap] = np.where(same, 0.0, SWAP_FREQ * np.exp(-np.maximum(dE, 0.0) / self.temp_scale))
+        rot_ids = ids[~is_swap]
+        if len(rot_ids):
+            cell, r = np.divmod(rot_ids - self.rot_begin, N_ROT)
+            pos = np.divmod(cell, self.tank_size)
+            mol = self.mols[pos]
+            is_soap = mol[:, 0] == MoleculeKind.SoapKind
+            new_dir = self.kernel.rotations[mol[:, 1] % 8, r]
+            dE = np.zeros(len(rot_ids))
+            soap_pos = tuple(x[is_soap] for x in pos)
+            dE[is_soap] = self.kernel.rotate_delta_energy(self.mols, soap_pos, new_dir[is_soap])
+            self.dE[rot_ids] = dE
+            rates[~is_swap] = np.where(is_soap, ROTATE_FREQ * np.exp(-np.maximum(dE, 0.0) / self.temp_scale), 0.0)
+        return rates
+
+    def affected_moves(self, cells):
+        """cells の 3x3 (周期境界) に端を持つ move の id"""
+        N = self.tank_size
+        rows, cols = np.divmod(np.asarray(cells), N)
+        near_rows = ((rows[:, None] + OFFSETS_3X3[:, 0]) % N).ravel()
+        near_cols = ((cols[:, None] + OFFSETS_3X3[:, 1]) % N).ravel()
+        near = np.unique(near_rows * N + near_cols)
+        near_rows, near_cols = np.divmod(near, N)
+        # near から HALF_DIRS の逆向きに 1 つ戻ったセルの move も near に端を持つ
+        half = self.kernel.offsets[HALF_DIRS]
+        back = ((near_rows[:, None] - half[:, 0]) % N) * N + (near_cols[:, None] - half[:, 1]) % N
+        h = np.arange(N_HALF)
+        swap_ids = np.concatenate([(near[:, None] * N_HALF + h).ravel(), (back * N_HALF + h).ravel()])
+        rot_ids = (self.rot_begin + near[:, None] * N_ROT + np.arange(N_ROT)).ravel()
+        return np.unique(np.concatenate([swap_ids, rot_ids]))
+
+    def do_move(self, move):
+        """move を起こして、変化したセルの flat index を返す"""
+        N = self.tank_size
+        if move < self.rot_begin:
+            cell, h = divmod(move, N_HALF)
+            row_idx, col_idx = divmod(cell, N)
+            d = self.kernel.offsets[HALF_DIRS[h]]
+            tgt_row, tgt_col = (row_idx + d[0]) % N, (col_idx + d[1]) % N
+            if self.stats is not None:
+                self.stats.count(SWAP, self.mols[row_idx, col_idx, 0], self.mols[tgt_row, tgt_col, 0], True)
+            a = self.mols[row_idx, col_idx].copy()
+            self.mols[row_idx, col_idx] = self.mols[tgt_row, tgt_col]
+            self.mols[tgt_row, tgt_col] = a
+            return [cell, tgt_row * N + tgt_col]
+        cell, r = divmod(move - self.rot_begin, N_ROT)
+        row_idx, col_idx = divmod(cell, N)
+        if self.stats is not None:
+            self.stats.count(ROTATE, MoleculeKind.SoapKind, MoleculeKind.SoapKind, True)
+        self.mols[row_idx, col_idx, 1] = self.kernel.rotations[self.mols[row_idx, col_idx, 1], r]
+        return [cell]
+
+    def step(self):
+        """
+        時計を 1 進める。待ち時間が残りを超えたらそこで止める (指数分布は無記憶なので、
+        次の step はそのまま新しく待ち時間を引けばよい)。
+        """
+        if self.temp_scale != self.rate_temp:
+            self.build()
+        remaining = 1.0
+        tree = self.tree
+        while tree.total > 0:
+            dt = self.rng.exponential(1.0 / tree.total)
+            if dt > remaining:
+                break
+            remaining -= dt
+            move = tree.find(self.rng.random() * tree.total)
+            if tree[move] <= 0:
+                # 丸め誤差で rate 0 の葉に落ちたときは引き直す
+                continue
+            self.energy += self.dE[move]
+            changed = self.do_move(move)
+            ids = self.affected_moves(changed)
+            tree.update(ids, self.move_rates(ids))
+            self.move_num += 1
+        self.time += 1.0
+
+    @classmethod
+    def from_checkpoint(cls, path):
+        tank = super().from_checkpoint(path)
+        # step は毎回ちょうど 1 進めるので、時計は loop_idx と同じ
+        tank.time = float(tank.loop_idx)
+        return tank
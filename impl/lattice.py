@@ -0,0 +1,198 @@
+import numpy as np
+from impl.molecule import LEC, MoleculeKind, directions, get_energy_table, get_bond_table
+from impl.stats import SWAP, ROTATE
+
+# swap は中心から距離 1、ΔE はそこからさらに距離 1 の近傍まで読むので、
+# 中心同士を 4 (= 1 + 2 + 1) 以上離せば同じ副格子の提案は互いに独立になる。
+SUBLATTICE_STRIDE = 4
+
+class LatticeKernel:
+    """
+    格子全体 (Tank.mols) に対するベクトル化した ΔE 計算と副格子 (checkerboard) sweep。
+    位置は mols の先頭軸に対する index 配列の tuple (pos) で渡す。
+    最後の ndim 個が空間座標で、それより前の軸 (replica など) はそのまま使う。
+    状態は s = kind * n_dirs + dir % n_dirs (Water/Air の dir=-1 もそのまま入る)。
+    """
+    def __init__(self, lec=LEC):
+        self.offsets = np.array(directions)
+        # offsets[opposite[p]] == -offsets[p]
+        self.opposite = np.array([np.flatnonzero((self.offsets == -off).all(axis=1))[0] for off in self.offsets])
+        # 回転の候補 (±45°)。try_local_rotate_7x7 の rng.choice([-1, 1]) と同じ順
+        self.rotations = np.array([[(d - 1) % 8, (d + 1) % 8] for d in range(8)])
+        self.set_tables(get_energy_table(lec), get_bond_table(lec))
+
+    def set_tables(self, energy_table, bond_table):
+        """table[kind, dir, kind, dir, pos] を状態 index で引ける形にしておく"""
+        n_kinds, self.n_dirs = energy_table.shape[:2]
+        n_states = n_kinds * self.n_dirs
+        self.energy_flat = np.ascontiguousarray(energy_table).reshape(n_states, n_states, -1)
+        self.bond_flat = np.ascontiguousarray(bond_table).reshape(n_states, n_states, -1)
+
+    @property
+    def ndim(self):
+        return self.offsets.shape[1]
+
+    def state(self, mols, pos):
+        mol = mols[pos]
+        return mol[..., 0].astype(np.intp) * self.n_dirs + mol[..., 1] % self.n_dirs
+
+    def energy_field(self, mols):
+        """
+        セルごとの self energy (calc_self_energy と同じ値) を格子全体について np.roll でまとめて計算する。
+        mols (..., *shape, 2) -> (..., *shape)
+        """
+        s = mols[..., 0].astype(np.intp) * self.n_dirs + mols[..., 1] % self.n_dirs
+        axes = tuple(range(s.ndim - self.ndim, s.ndim))
+        field = np.zeros(s.shape)
+        for p, off in enumerate(self.offsets):
+            # ngb[x] = s[x + off]
+            ngb = np.roll(s, shift=tuple(-off), axis=axes)
+            field += self.energy_flat[s, ngb, p]
+        return field
+
+    def total_energy(self, mols):
+        """
+        格子全体のエネルギー (全セルの self energy の和)。先頭に replica などの軸があれば軸ごとに返す。
+        MCMC の ΔE (7x7 の和の差) はこの量の差になっている。
+        """
+        field = self.energy_field(mols)
+        return field.sum(axis=tuple(range(field.ndim - self.ndim, field.ndim)))
+
+    def shift(self, mols, pos, p):
+        """pos から offsets[p] 方向に 1 つ進んだ位置 (周期境界)。p はスカラーでも配列でもよい"""
+        lead = pos[:-self.ndim]
+        spatial = pos[-self.ndim:]
+        shape = mols.shape[-self.ndim-1:-1]
+        off = self.offsets[p]
+        return lead + tuple((x + off[..., i]) % shape[i] for i, x in enumerate(spatial))
+
+    def neighbor_states(self, mols, pos):
+        """pos の全近傍の状態。shape (M, n_pos)"""
+        lead = tuple(x[:, None] for x in pos[:-self.ndim])
+        spatial = pos[-self.ndim:]
+        shape = mols.shape[-self.ndim-1:-1]
+        ngb_pos = lead + tuple((x[:, None] + self.offsets[:, i]) % shape[i] for i, x in enumerate(spatial))
+        return self.state(mols, ngb_pos)
+
+    def bond_energy(self, s, ngb_s, skip_pos=None):
+        """状態 s のセルと近傍 ngb_s の結合エネルギーの和。skip_pos (M,) の方向は数えない"""
+        bonds = self.bond_flat[s[:, None], ngb_s, np.arange(ngb_s.shape[1])]
+        if skip_pos is not None:
+            bonds[np.arange(len(s)), skip_pos] = 0.0
+        return bonds.sum(axis=1)
+
+    def swap_delta_energy(self, mols, pos, swap_pos):
+        """pos と swap_pos 方向の隣を交換したときの ΔE (MCMCUtl.calc_swap_delta_energy の配列版)"""
+        tgt = self.shift(mols, pos, swap_pos)
+        back_pos = self.opposite[swap_pos]
+        sa, sb = self.state(mols, pos), self.state(mols, tgt)
+        ngb_a, ngb_b = self.neighbor_states(mols, pos), self.neighbor_states(mols, tgt)
+        E0 = (self.bond_energy(sa, ngb_a, swap_pos) + self.bond_energy(sb, ngb_b, back_pos)
+              + self.bond_flat[sa, sb, swap_pos])
+        E1 = (self.bond_energy(sb, ngb_a, swap_pos) + self.bond_energy(sa, ngb_b, back_pos)
+              + self.bond_flat[sb, sa, swap_pos])
+        return E1 - E0
+
+    def rotate_delta_energy(self, mols, pos, new_dir):
+        """pos の soap の向きを new_dir にしたときの ΔE"""
+        kind = mols[pos][..., 0].astype(np.intp)
+        ngb = self.neighbor_states(mols, pos)
+        E0 = self.bond_energy(self.state(mols, pos), ngb)
+        E1 = self.bond_energy(kind * self.n_dirs + new_dir, ngb)
+        return E1 - E0
+
+    def change_delta_energy(self, mols, pos, new_mols):
+        """
+        pos (重複なし、離れていてもよい) のセルを new_mols (M, 2) に書き換えたときの ΔE。
+        書き換えるセル同士の結合は両側から数えるので半分ずつ足す。(先頭に replica などの軸がない格子用)
+        """
+        shape = mols.shape[-self.ndim-1:-1]
+        new_mols = np.asarray(new_mols)
+        s_old = self.state(mols, pos)
+        s_new = new_mols[:, 0].astype(np.intp) * self.n_dirs + new_mols[:, 1] % self.n_dirs
+        ngb_pos = tuple((x[:, None] + self.offsets[:, i]) % shape[i] for i, x in enumerate(pos))
+        ngb_old = self.state(mols, ngb_pos)
+        flat = np.ravel_multi_index(pos, shape)
+        order = np.argsort(flat)
+        ngb_flat = np.ravel_multi_index(ngb_pos, shape)
+        idx = np.minimum(np.searchsorted(flat[order], ngb_flat), len(flat) - 1)
+        changed = flat[order][idx] == ngb_flat
+        ngb_new = np.where(changed, s_new[order][idx], ngb_old)
+        weight = np.where(changed, 0.5, 1.0)
+        p = np.arange(len(self.offsets))
+        dE = weight * (self.bond_flat[s_new[:, None], ngb_new, p] - self.bond_flat[s_old[:, None], ngb_old, p])
+        return dE.sum()
+
+    def metropolis(self, dE, temp_scale, u):
+        """MCMCUtl.MCMC_step の配列版。u は [0,1) 一様乱数"""
+        return (dE <= 0) | (u < np.exp(-np.maximum(dE, 0.0) / temp_scale))
+
+    def try_swap(self, mols, pos, swap_pos, u, temp_scale):
+        """互いに独立な pos について swap を一括で提案・採択し、mols を書き換える。(accepted, dE) を返す"""
+        dE = self.swap_delta_energy(mols, pos, swap_pos)
+        accepted = self.metropolis(dE, temp_scale, u)
+        a = tuple(x[accepted] for x in pos)
+        b = self.shift(mols, a, swap_pos[accepted])
+        mol_a = mols[a]
+        mols[a] = mols[b]
+        mols[b] = mol_a
+        return accepted, dE
+
+    def try_rotate(self, mols, pos, rot_idx, u, temp_scale):
+        """
+        pos の soap を rotations[dir, rot_idx] に回す提案を一括で採択する。soap 以外は何もしない。
+        temp_scale は pos ごとの配列でもよい (EnsembleTank)
+        """
+        mol = mols[pos]
+        is_soap = mol[..., 0] == MoleculeKind.SoapKind
+        pos = tuple(x[is_soap] for x in pos)
+        new_dir = self.rotations[mol[is_soap, 1], rot_idx[is_soap]]
+        dE = self.rotate_delta_energy(mols, pos, new_dir)
+        if np.ndim(temp_scale):
+            temp_scale = temp_scale[is_soap]
+        accepted = self.metropolis(dE, temp_scale, u[is_soap])
+        mols[tuple(x[accepted] for x in pos) + (1,)] = new_dir[accepted]
+        return accepted, dE
+
+    def sublattice(self, shape, origin, stride=SUBLATTICE_STRIDE):
+        """origin から stride 間隔の格子点。周期境界をまたいでも間隔が stride 以上になる点だけ取る"""
+        grids = np.meshgrid(*[(o + stride * np.arange(n // stride)) % n for o, n in zip(origin, shape)],
+                            indexing="ij")
+        return tuple(g.ravel() for g in grids)
+
+    def checkerboard_sweep(self, mols, temp_scale, rng, visit_prob, stats=None):
+        """
+        Tank.step の副格子版。stride 間隔の副格子ごとに、各点を visit_prob で選んで
+        swap → rotate を一括で提案・採択する。副格子の原点は毎回ランダムにずらす
+        (tank_size が stride で割り切れないときも全セルが中心になれるように)。
+        採択された ΔE の和を返す。stats (MoveStats) を与えると提案を数える。
+        """
+        shape = mols.shape[-self.ndim-1:-1]
+        shift = rng.integers(SUBLATTICE_STRIDE, size=self.ndim)
+        colors = np.stack(np.meshgrid(*[np.arange(SUBLATTICE_STRIDE)] * self.ndim, indexing="ij"), axis=-1)
+        colors = colors.reshape(-1, self.ndim)
+        dE_sum = 0.0
+        for color in colors[rng.permutation(len(colors))]:
+            pos = self.sublattice(shape, shift + color)
+            visit = rng.random(len(pos[0])) < visit_prob
+            pos = tuple(x[visit] for x in pos)
+            n = len(pos[0])
+            swap_pos = rng.integers(len(self.offsets), size=n)
+            if stats is not None:
+                kind_a = mols[pos][..., 0]
+                kind_b = mols[self.shift(mols, pos, swap_pos)][..., 0]
+            accepted, dE = self.try_swap(mols, pos, swap_pos, rng.random(n), temp_scale)
+            dE_sum += dE[accepted].sum()
+            if stats is not None:
+                stats.count_array(SWAP, kind_a, kind_b, accepted)
+            accepted, dE = self.try_rotate(mols, pos, rng.integers(self.rotations.shape[1], size=n), rng.random(n),
+                                           temp_scale)
+            dE_sum += dE[accepted].sum()
+            if stats is not None:
+                stats.count_array(ROTATE, MoleculeKind.SoapKind, MoleculeKind.SoapKind, accepted)
+        return dE_sum
+
+def calc_energy_field(mols, lec=LEC):
+    """Tank.mols のセルごとの self energy と全エネルギー"""
+    field = LatticeKernel(lec).energy_field(mols)
+    return field, field.sum()
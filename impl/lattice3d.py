@@ -0,0 +1,128 @@
+"""
+3 次元 (N x N x N、周期境界) の格子。近傍は 26 方向、soap の向きも同じ 26 方向。
+
+相互作用のルール (InteractionHelpers の xsc/xsh/xsn、sspa/ssta/sshi/sscurv、接線の報酬) を
+方向ベクトルで書き直して、2D と同じ形のテーブル table[kind, dir, kind, dir, pos] に焼き込む。
+
+- xsc: soap が x の方を向いている / xsh: soap が x と反対を向いている / xsn: それ以外
+- 接線 (E_wst): soap の向きが soap -> water と直交 (2D の ±90°)
+- sscurv: 2 つの soap が互いの方を向いている
+- sspa: 2 つの向きが「隣の向き」(なす角が 0 より大きく 45° 以下。2D の ±45°)
+- ssta: 同じ向きで、2 つを結ぶ軸の方向ではない
+- sshi: 2 つとも 2 つを結ぶ軸 (pos, -pos) の方向
+- ssn: それ以外
+
+同じ関数に 2D の directions を渡すと get_energy_table と一致する (build_energy_table_from_directions)。
+更新は LatticeKernel の副格子 sweep をそのまま使い (stride 4 で 4^3 色)、rotate は隣の向きへの回転。
+"""
+
+import functools
+import itertools
+import numpy as np
+from impl.molecule import LEC, MoleculeKind
+from impl.lattice import LatticeKernel
+
+S = MoleculeKind.SoapKind.value
+W = MoleculeKind.WaterKind.value
+A = MoleculeKind.AirKind.value
+
+# (dz, dy, dx) の 26 方向
+DIRECTIONS_3D = [list(d) for d in itertools.product((-1, 0, 1), repeat=3) if any(d)]
+
+def direction_geometry(dirs):
+    """方向ごとの逆向きの index と、隣の向き (なす角が 0 より大きく 45° 以下) の行列"""
+    dirs = np.asarray(dirs, dtype=float)
+    opposite = np.array([np.flatnonzero((dirs == -d).all(axis=1))[0] for d in dirs])
+    unit = dirs / np.linalg.norm(dirs, axis=1, keepdims=True)
+    cos = unit @ unit.T
+    adjacent = (cos >= np.cos(np.pi / 4) - 1e-9) & (cos < 1 - 1e-9)
+    return opposite, adjacent, dirs @ dirs.T
+
+def build_energy_table_from_directions(dirs, lec=LEC):
+    """
+    build_energy_table の方向ベクトル版。table[self_kind, self_dir, other_kind, other_dir, pos]。
+    pos は self -> other の方向 (dirs の index)
+    """
+    n = len(dirs)
+    opposite, adjacent, dot = direction_geometry(dirs)
+
+    def xs_energy(d, toward_x, c, h, other):
+        # d: soap の向き、toward_x: soap -> x の向き
+        if d == toward_x:
+            return c
+        if d == opposite[toward_x]:
+            return h
+        return other
+
+    def ws_energy(d, toward_water):
+        base = xs_energy(d, toward_water, lec.E_wsc, lec.E_wsh, lec.E_wsn)
+        if dot[d, toward_water] == 0:
+            base += lec.E_wst
+        return base
+
+    def as_energy(d, toward_air):
+        return xs_energy(d, toward_air, lec.E_asc, lec.E_ash, lec.E_asn)
+
+    def ss_energy(d, d2, pos):
+        axis = (pos, opposite[pos])
+        if d == pos and d2 == opposite[pos]:
+            return lec.E_sscurv
+        if adjacent[d, d2]:
+            return lec.E_sspa
+        if d == d2 and d not in axis:
+            return lec.E_ssta
+        if d in axis and d2 in axis:
+            return lec.E_sshi
+        return lec.E_ssn
+
+    table = np.zeros((4, n, 4, n, n))
+    for pos in range(n):
+        back = opposite[pos]
+        table[W, :, W, :, pos] = lec.E_ww
+        table[W, :, A, :, pos] = lec.E_aw
+        table[A, :, W, :, pos] = lec.E_aw
+        table[A, :, A, :, pos] = lec.E_aa
+        for d in range(n):
+            table[S, d, W, :, pos] = ws_energy(d, pos)
+            table[S, d, A, :, pos] = as_energy(d, pos)
+            table[W, :, S, d, pos] = ws_energy(d, back)
+            table[A, :, S, d, pos] = as_energy(d, back)
+            for d2 in range(n):
+                table[S, d, S, d2, pos] = ss_energy(d, d2, pos)
+    return table
+
+@functools.lru_cache(maxsize=None)
+def get_energy_table_3d(lec=LEC):
+    table = build_energy_table_from_directions(DIRECTIONS_3D, lec)
+    table.flags.writeable = False
+    return table
+
+@functools.lru_cache(maxsize=None)
+def get_bond_table_3d(lec=LEC):
+    """get_bond_table の 3D 版 (両側の self energy の和)"""
+    table = get_energy_table_3d(lec)
+    opposite, _, _ = direction_geometry(DIRECTIONS_3D)
+    bond_table = table + table[:, :, :, :, opposite].transpose(2, 3, 0, 1, 4)
+    bond_table.flags.writeable = False
+    return bond_table
+
+def get_rotation_table_3d():
+    """
+    rotations[d]: 向き d から rotate で提案する先 (隣の向き)。隣の向きの数は d によって 3 か 4 なので、
+    足りない分は d 自身 (何もしない提案) で埋めて、d -> d2 と d2 -> d の提案確率を同じにする
+    """
+    _, adjacent, _ = direction_geometry(DIRECTIONS_3D)
+    width = adjacent.sum(axis=1).max()
+    rotations = np.empty((len(DIRECTIONS_3D), width), dtype=np.int64)
+    for d, row in enumerate(adjacent):
+        targets = np.flatnonzero(row)
+        rotations[d] = np.concatenate([targets, np.full(width - len(targets), d)])
+    return rotations
+
+class LatticeKernel3D(LatticeKernel):
+    """26 方向の LatticeKernel。ΔE・副格子 sweep は LatticeKernel のものをそのまま使う"""
+    def __init__(self, lec=LEC):
+        self.offsets = np.array(DIRECTIONS_3D)
+        self.opposite, _, _ = direction_geometry(DIRECTIONS_3D)
+        self.rotations = get_rotation_table_3d()
+        self.set_tables(get_energy_table_3d(lec), get_bond_table_3d(lec))
@@ -0,0 +1,320 @@
+"""
+run 中の Tank の格子とカウンタを共有メモリに publish し、別プロセスから覗く (live monitor)。
+
+    tank.run(100001, "exe", 1000, live="exe_live")         # 共有メモリの名前 (run の間だけ存在する)
+    python -m impl.live exe_live                           # 別の端末から。種類と向きの地図・エネルギー・採択率
+    python -m impl.live exe_live --text                    # 画面なし (新しい snapshot ごとに 1 行)
+
+- LivePublisher.update(tank) は step ごとに呼ばれるが、前の publish から interval 秒経っていなければ時刻を見るだけ。
+  publish は格子とカウンタ・履歴を memcpy するだけで、ロックは取らない
+- バッファは 2 つ。書くのは最後に publish していない方で、書く前後にそのバッファの seq を 1 ずつ増やし (書いている間は奇数)、
+  書き終えてから latest をそのバッファにする (seqlock)。読む側は latest のバッファを写し、前後で seq が同じ偶数なら一貫した snapshot。
+  publish は数秒おきなので、写している間にもう一方ではなく同じバッファが書き換えられることはまずない (あれば読み直す)
+- 履歴 (trace) は publish ごとの [step, エネルギー, swap 採択率, rotate 採択率] の直近 TRACE_LEN 点。
+  採択率は前の publish からの値で、Tank(..., stats=True) のときだけ (それ以外は nan)
+"""
+
+import json
+import time
+import argparse
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+from impl.stats import SWAP, ROTATE
+
+MAGIC = 0x534f4150  # "SOAP"
+# header (int64): [magic, ndim, shape_0, ..., shape_4, trace_len, latest, publish_count, closed, metadata の長さ]
+HEADER_LEN = 12
+MAX_NDIM = 5
+LATEST = 8
+PUBLISH_COUNT = 9
+CLOSED = 10
+META_LEN = 11
+META_SIZE = 4096
+# カウンタ (float64): [step, energy, temp_scale, time, swap 提案, swap 採択, rotate 提案, rotate 採択, trace の点数]
+COUNTERS = ["step", "energy", "temp_scale", "time", "swap_attempted", "swap_accepted", "rotate_attempted",
+            "rotate_accepted", "trace_count"]
+TRACE_COLUMNS = ["step", "energy", "swap_rate", "rotate_rate"]
+TRACE_LEN = 2048
+# metadata のうち共有メモリに書くもの
+META_KEYS = ("soap_ratio", "water_ratio", "temp_scale", "tank_size", "seed", "sweep", "moves")
+
+def align8(n):
+    return (n + 7) // 8 * 8
+
+def buffer_layout(shape):
+    """バッファ 1 つの中の (seq, counters, trace, mols) の offset と、バッファ 1 つの大きさ"""
+    seq = 0
+    counters = 8
+    trace = counters + 8 * len(COUNTERS)
+    mols = trace + 8 * TRACE_LEN * len(TRACE_COLUMNS)
+    return dict(seq=seq, counters=counters, trace=trace, mols=mols), align8(mols + int(np.prod(shape)))
+
+def segment_size(shape):
+    return 8 * HEADER_LEN + META_SIZE + 2 * buffer_layout(shape)[1]
+
+class LiveSegment:
+    """共有メモリ上の header と 2 つのバッファの numpy view (LivePublisher と LiveReader で共通)"""
+    def __init__(self, shm, shape):
+        self.shm = shm
+        self.shape = tuple(shape)
+        self.header = np.ndarray(HEADER_LEN, dtype=np.int64, buffer=shm.buf)
+        self.meta = np.ndarray(META_SIZE, dtype=np.uint8, buffer=shm.buf, offset=8 * HEADER_LEN)
+        offsets, size = buffer_layout(shape)
+        self.buffers = []
+        for b in range(2):
+            base = 8 * HEADER_LEN + META_SIZE + b * size
+            self.buffers.append(dict(
+                seq=np.ndarray(1, dtype=np.int64, buffer=shm.buf, offset=base + offsets["seq"]),
+                counters=np.ndarray(len(COUNTERS), dtype=np.float64, buffer=shm.buf, offset=base + offsets["counters"]),
+                trace=np.ndarray((TRACE_LEN, len(TRACE_COLUMNS)), dtype=np.float64, buffer=shm.buf,
+                                 offset=base + offsets["trace"]),
+                mols=np.ndarray(self.shape, dtype=np.int8, buffer=shm.buf, offset=base + offsets["mols"])))
+
+    def release(self):
+        # view が残っていると close できない
+        del self.header, self.meta, self.buffers
+        self.shm.close()
+
+class LivePublisher:
+    """
+    Tank.run(..., live=...) に渡す publisher。name の共有メモリを作り、close() で消す。
+    interval 秒おきに update(tank) が snapshot を書く。
+    """
+    def __init__(self, name, shape, metadata=None, interval=2.0):
+        assert len(shape) <= MAX_NDIM
+        self.name = name
+        self.interval = interval
+        self.segment = LiveSegment(shared_memory.SharedMemory(name=name, create=True, size=segment_size(shape)),
+                                   shape)
+        header = self.segment.header
+        header[:] = 0
+        header[0] = MAGIC
+        header[1] = len(shape)
+        header[2:2 + len(shape)] = shape
+        header[7] = TRACE_LEN
+        header[LATEST] = -1
+        meta = json.dumps({k: metadata[k] for k in META_KEYS if k in (metadata or {})}).encode()[:META_SIZE]
+        self.segment.meta[:len(meta)] = np.frombuffer(meta, dtype=np.uint8)
+        header[META_LEN] = len(meta)
+        # publisher 側の履歴 (publish ごとにバッファへ写す)
+        self.trace = np.full((TRACE_LEN, len(TRACE_COLUMNS)), np.nan)
+        self.trace_count = 0
+        self.last_time = -np.inf
+        self.last_counts = (0, 0, 0, 0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, tank, force=False):
+        """前の publish から interval 秒経っていれば (force なら必ず) tank の snapshot を書く"""
+        now = time.monotonic()
+        if not force and now - self.last_time < self.interval:
+            return False
+        self.last_time = now
+        self.publish(tank)
+        return True
+
+    def publish(self, tank):
+        counts = (0, 0, 0, 0)
+        if tank.stats is not None:
+            counts = (tank.stats.attempted(SWAP), tank.stats.accepted(SWAP), tank.stats.attempted(ROTATE),
+                      tank.stats.accepted(ROTATE))
+        # 採択率は前の publish からの差分
+        rates = []
+        for att, acc, last_att, last_acc in ((counts[0], counts[1], *self.last_counts[:2]),
+                                             (counts[2], counts[3], *self.last_counts[2:])):
+            rates.append((acc - last_acc) / (att - last_att) if att > last_att else np.nan)
+        self.last_counts = counts
+        self.trace[self.trace_count % TRACE_LEN] = [tank.loop_idx, tank.energy, *rates]
+        self.trace_count += 1
+
+        header = self.segment.header
+        b = 0 if header[LATEST] != 0 else 1
+        buf = self.segment.buffers[b]
+        buf["seq"][0] += 1
+        buf["counters"][:] = [tank.loop_idx, tank.energy, tank.temp_scale, time.time(), *counts, self.trace_count]
+        buf["trace"][:] = self.trace
+        buf["mols"][:] = tank.mols
+        buf["seq"][0] += 1
+        header[LATEST] = b
+        header[PUBLISH_COUNT] += 1
+
+    def close(self):
+        if self.segment is None:
+            return
+        # 繋いでいる reader は map したままなので closed を見て終わる
+        self.segment.header[CLOSED] = 1
+        shm = self.segment.shm
+        self.segment.release()
+        shm.unlink()
+        self.segment = None
+
+class LiveReader:
+    """
+    別プロセスから name の共有メモリに繋いで snapshot を読む (書き込みはしない)。
+    segment が無ければ FileNotFoundError、LivePublisher のものでなければ ValueError
+    """
+    def __init__(self, name):
+        try:
+            shm = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            raise FileNotFoundError("no live run: {}".format(name)) from None
+        # attach しただけのプロセスの終了で segment が消されないように (Python 3.13 未満の resource_tracker)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        header = np.ndarray(HEADER_LEN, dtype=np.int64, buffer=shm.buf)
+        if header[0] != MAGIC:
+            del header
+            shm.close()
+            raise ValueError("not a live segment: {}".format(name))
+        shape = tuple(int(x) for x in header[2:2 + header[1]])
+        del header
+        self.segment = LiveSegment(shm, shape)
+        self.metadata = json.loads(bytes(self.segment.meta[:self.segment.header[META_LEN]]).decode() or "{}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def publish_count(self):
+        return int(self.segment.header[PUBLISH_COUNT])
+
+    @property
+    def closed(self):
+        return bool(self.segment.header[CLOSED])
+
+    def snapshot(self, retries=100):
+        """
+        一貫した (counters の dict, trace (古い順、nan の行なし), mols) のコピー。
+        まだ publish されていなければ None
+        """
+        header = self.segment.header
+        for _ in range(retries):
+            b = int(header[LATEST])
+            if b < 0:
+                return None
+            buf = self.segment.buffers[b]
+            seq = int(buf["seq"][0])
+            if seq % 2 == 1:
+                continue
+            counters = buf["counters"].copy()
+            trace = buf["trace"].copy()
+            mols = buf["mols"].copy()
+            if int(buf["seq"][0]) == seq:
+                break
+        else:
+            return None
+        info = dict(zip(COUNTERS, counters.tolist()))
+        n = int(info["trace_count"])
+        # ring buffer を古い順に並べる
+        trace = np.roll(trace, -(n % TRACE_LEN), axis=0) if n >= TRACE_LEN else trace[:n]
+        return info, trace, mols
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.release()
+            self.segment = None
+
+def format_line(info):
+    swap = info["swap_accepted"] / info["swap_attempted"] if info["swap_attempted"] else np.nan
+    rotate = info["rotate_accepted"] / info["rotate_attempted"] if info["rotate_attempted"] else np.nan
+    return "step {:.0f} energy {:.2f} T {:.3f} acc swap {:.3f} rotate {:.3f} ({:.1f}s ago)".format(
+        info["step"], info["energy"], info["temp_scale"], swap, rotate, time.time() - info["time"])
+
+def kind_dir_maps(mols):
+    """表示する 2D の (kind, soap の dir (soap 以外は -1))。3D は真ん中の z 断面"""
+    if mols.ndim == 4:
+        mols = mols[mols.shape[0] // 2]
+    return mols[..., 0], np.where(mols[..., 0] == 1, mols[..., 1], -1)
+
+def watch_text(reader, poll):
+    last = -1
+    while True:
+        # close の直前の最後の snapshot も表示してから終わる
+        closed = reader.closed
+        if reader.publish_count != last:
+            last = reader.publish_count
+            snapshot = reader.snapshot()
+            if snapshot is not None:
+                print(format_line(snapshot[0]), flush=True)
+        if closed:
+            return
+        time.sleep(poll)
+
+def watch_plot(reader, poll):
+    # 表示するときだけ matplotlib を読み込む
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ListedColormap, BoundaryNorm
+
+    fig, axes = plt.subplots(2, 2, figsize=(10, 9))
+    title = " ".join("{}={}".format(k, v) for k, v in reader.metadata.items())
+    kind_cmap = ListedColormap(["orange", "#7ec8e3", "#b0b0b0"])
+    kind_norm = BoundaryNorm([0.5, 1.5, 2.5, 3.5], kind_cmap.N)
+    dir_cmap = plt.get_cmap("hsv").copy()
+    dir_cmap.set_under("white")
+    kind_img = dir_img = None
+    last = -1
+    while plt.fignum_exists(fig.number):
+        closed = reader.closed
+        if reader.publish_count != last:
+            last = reader.publish_count
+            snapshot = reader.snapshot()
+            if snapshot is not None:
+                info, trace, mols = snapshot
+                kinds, dirs = kind_dir_maps(mols)
+                if kind_img is None:
+                    kind_img = axes[0, 0].imshow(kinds, cmap=kind_cmap, norm=kind_norm, interpolation="nearest")
+                    n_dirs = 26 if mols.ndim == 4 else 8
+                    dir_img = axes[0, 1].imshow(dirs, cmap=dir_cmap, vmin=0, vmax=n_dirs - 1, interpolation="nearest")
+                    axes[0, 0].set_title("kind (Soap / Water / Air)")
+                    axes[0, 1].set_title("soap direction")
+                    for ax in axes[0]:
+                        ax.axis("off")
+                else:
+                    kind_img.set_data(kinds)
+                    dir_img.set_data(dirs)
+                for ax in axes[1]:
+                    ax.cla()
+                axes[1, 0].plot(trace[:, 0], trace[:, 1])
+                axes[1, 0].set_xlabel("step")
+                axes[1, 0].set_ylabel("energy")
+                axes[1, 1].plot(trace[:, 0], trace[:, 2], label="swap")
+                axes[1, 1].plot(trace[:, 0], trace[:, 3], label="rotate")
+                axes[1, 1].set_xlabel("step")
+                axes[1, 1].set_ylabel("acceptance (stats=True)")
+                axes[1, 1].legend()
+                fig.suptitle(title + "\n" + format_line(info), fontsize=8)
+                fig.canvas.draw_idle()
+        if closed:
+            # 最後の snapshot を表示したままにする
+            plt.show()
+            return
+        plt.pause(poll)
+
+def watch(name, text=False, poll=0.5):
+    """name の run を表示し続ける (run が終わって segment が閉じられたら戻る)"""
+    with LiveReader(name) as reader:
+        if text:
+            watch_text(reader, poll)
+        else:
+            watch_plot(reader, poll)
+    print("run finished:", name)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="run 中の Tank (run(..., live=name)) を共有メモリから表示する")
+    parser.add_argument("name")
+    parser.add_argument("--text", action="store_true", help="matplotlib を使わず 1 行ずつ表示する")
+    parser.add_argument("--poll", type=float, default=0.5, help="新しい snapshot を見に行く間隔 (秒)")
+    args = parser.parse_args(argv)
+    try:
+        watch(args.name, args.text, args.poll)
+    except (FileNotFoundError, ValueError) as e:
+        parser.error(str(e))
+
+if __name__ == "__main__":
+    main()
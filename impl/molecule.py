@@ -1,7 +1,8 @@
 from abc import ABCMeta, abstractmethod
-from enum import Enum
+from enum import IntEnum
 import sys
 import dataclasses
+import functools
 import numpy as np
 
 directions = [[-1, -1], [-1, 0], [-1, 1], [0, 1], [1, 1], [1, 0], [1, -1], [0, -1]]
@@ -38,8 +39,8 @@ class LocalEnergyConstant:
 LEC = LocalEnergyConstant()
 
 class InteractionHelpers:
-    def __init__(self):
-        self.lec = LEC
+    def __init__(self, lec=LEC):
+        self.lec = lec
     def as_interaction_energy(self, soap, pos):
         if self.is_xsc_interaction(soap, pos):
             return self.lec.E_asc
@@ -183,11 +184,14 @@ class InteractionHelpers:
             other_soap.dir == toward_self
         )
 
-class MoleculeKind(Enum):
+class MoleculeKind(IntEnum):
     SoapKind = 1
     WaterKind = 2
     AirKind = 3
 
+# Tank.mols などの格子は (..., 2) = [kind, dir] の int8 配列で持つ (Water/Air の dir は -1)
+MOL_DTYPE = np.int8
+
 class Molecule(metaclass=ABCMeta):
     @abstractmethod
     def encode(self):
@@ -197,7 +201,8 @@ class Molecule(metaclass=ABCMeta):
         pass
 
 class Soap:
-    def __init__(self, rng=None, dir=None):
+    def __init__(self, rng=None, dir=None, lec=LEC):
+        self.lec = lec
         if rng is not None:
             self.dir = rng.choice(8)
         elif dir is not None:
@@ -210,93 +215,116 @@ class Soap:
         return [MoleculeKind.SoapKind, self.dir]
 
     def calc_self_energy(self, neighbor):
-        energy = 0.0
-        mcmc_utl = MCMCUtl()
-        interaction_helpers = InteractionHelpers()
-        for row_idx in range(0, 3):
-            for col_idx in range(0, 3):
-                if row_idx == 1 and col_idx == 1:
-                    continue
-                ngb = neighbor[row_idx, col_idx]
-                pos = find_dir([row_idx, col_idx])
-                match ngb[0]:
-                    case MoleculeKind.WaterKind:
-                        energy = energy + interaction_helpers.ws_interaction_energy(self, (pos+4)%8)
-                    case MoleculeKind.AirKind:
-                        energy = energy + interaction_helpers.as_interaction_energy(self, (pos+4)%8)
-                    case MoleculeKind.SoapKind:
-                        other_soap = mcmc_utl.decode(ngb)
-                        energy = energy + interaction_helpers.ss_interaction_energy(self, other_soap, pos)
-        return energy
+        return calc_table_energy(MoleculeKind.SoapKind, self.dir, neighbor, self.lec)
 
 class Water:
-    def __init__(self):
-        self.lec = LEC
+    def __init__(self, lec=LEC):
+        self.lec = lec
 
     def encode(self):
         return [MoleculeKind.WaterKind, -1]
 
     def calc_self_energy(self, neighbor):
-        energy = 0.0
-
-        for row_idx in range(0, 3):
-            for col_idx in range(0, 3):
-                if row_idx == 1 and col_idx == 1:
-                    continue
-                ngb = neighbor[row_idx, col_idx]
-                match ngb[0]:
-                    case MoleculeKind.WaterKind:
-                        energy = energy + self.lec.E_ww
-                    case MoleculeKind.AirKind:
-                        energy = energy + self.lec.E_aw
-                    case MoleculeKind.SoapKind:
-                        mcmc_utl = MCMCUtl()
-                        soap = mcmc_utl.decode(ngb)
-                        interaction_helpers = InteractionHelpers()
-                        pos = find_dir([row_idx, col_idx])
-                        energy = energy + interaction_helpers.ws_interaction_energy(soap, pos)
-        return energy
+        return calc_table_energy(MoleculeKind.WaterKind, -1, neighbor, self.lec)
 
 class Air:
-    def __init__(self):
-        self.lec = LEC
+    def __init__(self, lec=LEC):
+        self.lec = lec
 
     def encode(self):
         return [MoleculeKind.AirKind, -1]
 
     def calc_self_energy(self, neighbor):
-        energy = 0.0
-        for row_idx in range(0, 3):
-            for col_idx in range(0, 3):
-                if row_idx == 1 and col_idx == 1:
-                    continue
-                ngb = neighbor[row_idx, col_idx]
-                match ngb[0]:
-                    case MoleculeKind.WaterKind:
-                        energy = energy + self.lec.E_aw
-                    case MoleculeKind.AirKind:
-                        energy = energy + self.lec.E_aa
-                    case MoleculeKind.SoapKind:
-                        mcmc_utl = MCMCUtl()
-                        soap = mcmc_utl.decode(ngb)
-                        interaction_helpers = InteractionHelpers()
-                        pos = find_dir([row_idx, col_idx])
-                        energy = energy + interaction_helpers.as_interaction_energy(soap, pos)
-        return energy
+        return calc_table_energy(MoleculeKind.AirKind, -1, neighbor, self.lec)
 
 Molecule.register(Soap)
 Molecule.register(Water)
 Molecule.register(Air)
 
+def build_energy_table(lec=LEC):
+    """
+    InteractionHelpers のルールを全状態について評価したテーブル。
+    table[self_kind, self_dir, other_kind, other_dir, pos] が self から見た other との相互作用。
+    pos は self -> other の方向 (directions の index)、kind は MoleculeKind.value (0 は未使用)。
+    Water/Air の dir (-1) でもそのまま引けるよう、dir を持たない分子は全 dir に同じ値を入れる。
+    """
+    interaction_helpers = InteractionHelpers(lec)
+    S = MoleculeKind.SoapKind.value
+    W = MoleculeKind.WaterKind.value
+    A = MoleculeKind.AirKind.value
+    table = np.zeros((4, 8, 4, 8, 8))
+    for pos in range(8):
+        # x -> soap の向きは pos+4
+        back = (pos + 4) % 8
+        table[W, :, W, :, pos] = lec.E_ww
+        table[W, :, A, :, pos] = lec.E_aw
+        table[A, :, W, :, pos] = lec.E_aw
+        table[A, :, A, :, pos] = lec.E_aa
+        for dir in range(8):
+            soap = Soap(dir=dir, lec=lec)
+            table[S, dir, W, :, pos] = interaction_helpers.ws_interaction_energy(soap, back)
+            table[S, dir, A, :, pos] = interaction_helpers.as_interaction_energy(soap, back)
+            table[W, :, S, dir, pos] = interaction_helpers.ws_interaction_energy(soap, pos)
+            table[A, :, S, dir, pos] = interaction_helpers.as_interaction_energy(soap, pos)
+            for other_dir in range(8):
+                other_soap = Soap(dir=other_dir, lec=lec)
+                table[S, dir, S, other_dir, pos] = interaction_helpers.ss_interaction_energy(soap, other_soap, pos)
+    return table
+
+@functools.lru_cache(maxsize=None)
+def get_energy_table(lec=LEC):
+    """lec ごとに一度だけ build_energy_table する (LocalEnergyConstant は frozen なので key にできる)"""
+    table = build_energy_table(lec)
+    table.flags.writeable = False
+    return table
+
+# directions を配列にしたもの (ΔE 計算で周期境界の近傍をまとめて引くのに使う)
+DIR_ROWS = np.array([d[0] for d in directions])
+DIR_COLS = np.array([d[1] for d in directions])
+POS8 = np.arange(8)
+BACK8 = (POS8 + 4) % 8
+
+@functools.lru_cache(maxsize=None)
+def get_bond_table(lec=LEC):
+    """
+    bond_table[k, d, k2, d2, pos]: pos 方向に並んだ 2 分子の結合エネルギー (両側の self energy の和)。
+    ΔE 計算は変化する結合だけをこれで足す。
+    """
+    table = get_energy_table(lec)
+    bond_table = table + table[:, :, :, :, BACK8].transpose(2, 3, 0, 1, 4)
+    bond_table.flags.writeable = False
+    return bond_table
+
+# 3x3 近傍の走査順 (row, col, pos)。和の順番を揃えておくと旧実装と完全に同じ値になる。
+NEIGHBOR_SCAN = [(row_idx, col_idx, find_dir([row_idx, col_idx]))
+                 for row_idx in range(0, 3) for col_idx in range(0, 3)
+                 if not (row_idx == 1 and col_idx == 1)]
+
+def calc_table_energy(kind, dir, neighbor, lec=LEC):
+    """neighbor (3x3) の中心に (kind, dir) の分子があるときの self energy"""
+    table = get_energy_table(lec)
+    energy = 0.0
+    for row_idx, col_idx, pos in NEIGHBOR_SCAN:
+        ngb = neighbor[row_idx, col_idx]
+        energy = energy + table[kind, dir, ngb[0], ngb[1], pos]
+    return energy
+
 class MCMCUtl:
+    def __init__(self, lec=LEC, check_delta=False):
+        self.lec = lec
+        # True なら ΔE 経路の結果を毎回 7x7 の全再計算と突き合わせる (debug 用)
+        self.check_delta = check_delta
+        # 直前の swap の提案の方向 (Tank.stats で相手の kind を数えるのに使う)
+        self.last_swap_pos = None
+
     def decode(self, encoded):
         match encoded[0]:
             case MoleculeKind.SoapKind:
-                return Soap(dir=encoded[1])
+                return Soap(dir=encoded[1], lec=self.lec)
             case MoleculeKind.WaterKind:
-                return Water()
+                return Water(self.lec)
             case MoleculeKind.AirKind:
-                return Air()
+                return Air(self.lec)
             case _:
                 print("invalid decode.")
                 sys.exit()
@@ -341,19 +369,29 @@ class MCMCUtl:
         evaluate core cells (1..5, 1..5): each uses its own 3x3 slice
         This fully covers the energy changes induced by swapping within distance-1 around center.
         """
+        table = get_energy_table(self.lec)
+        kinds = neighbor7[:, :, 0]
+        dirs = neighbor7[:, :, 1]
+        core_kinds, core_dirs = kinds[1:6, 1:6], dirs[1:6, 1:6]
+        cell_energy = np.zeros((5, 5))
+        for row_idx, col_idx, pos in NEIGHBOR_SCAN:
+            cell_energy = cell_energy + table[core_kinds, core_dirs,
+                                              kinds[row_idx:row_idx+5, col_idx:col_idx+5],
+                                              dirs[row_idx:row_idx+5, col_idx:col_idx+5], pos]
+        # セルごとの和を旧実装と同じ順で足す (np.sum は順番が変わる)
         energy = 0.0
-        for r in range(1, 6):      # 1..5
-            for c in range(1, 6):  # 1..5
-                mol = self.decode(neighbor7[r, c])
-                energy += mol.calc_self_energy(neighbor7[r-1:r+2, c-1:c+2])
+        for e in cell_energy.ravel():
+            energy += e
         return energy
 
-    def try_local_swap_7x7(self, neighbor7, temp_scale, rng):
+    def try_local_swap_7x7(self, neighbor7, temp_scale, rng, return_dE=False):
         """
         swap center (3,3) with one of 8 neighbors at radius 1 around center.
+        return_dE=True なら (neighbor7, 採択された ΔE (棄却なら 0)) を返す。
         """
         center = (3, 3)
         may_swap_indicator = rng.choice(8)
+        self.last_swap_pos = may_swap_indicator
         d = directions[may_swap_indicator]         # (drow,dcol) in [-1,0,1]
         tgt = (center[0] + d[0], center[1] + d[1]) # still within 7x7
 
@@ -369,17 +407,18 @@ class MCMCUtl:
         E1 = self.calc_neighbor_energy_7x7(proposal)
 
         if self.MCMC_step(E0, E1, temp_scale, rng):
-            return proposal
+            return (proposal, E1 - E0) if return_dE else proposal
         else:
-            return original
+            return (original, 0.0) if return_dE else original
 
-    def try_local_rotate_7x7(self, neighbor7, temp_scale, rng):
+    def try_local_rotate_7x7(self, neighbor7, temp_scale, rng, return_dE=False):
         """
         rotate the soap direction at center (3,3) only (no translation).
+        return_dE=True なら (neighbor7, 採択された ΔE (棄却なら 0)) を返す。
         """
         center = (3, 3)
         if neighbor7[center[0], center[1]][0] != MoleculeKind.SoapKind:
-            return neighbor7
+            return (neighbor7, 0.0) if return_dE else neighbor7
 
         original = neighbor7
         proposal = neighbor7.copy()
@@ -393,6 +432,103 @@ class MCMCUtl:
         E1 = self.calc_neighbor_energy_7x7(proposal)
 
         if self.MCMC_step(E0, E1, temp_scale, rng):
-            return proposal
+            return (proposal, E1 - E0) if return_dE else proposal
         else:
-            return original
\ No newline at end of file
+            return (original, 0.0) if return_dE else original
+
+    # --- ΔE only: 変化する結合だけを評価する (7x7 窓のコピーなし) ---
+    def get_neighbor_8(self, mols, row_idx, col_idx):
+        """(row_idx, col_idx) の 8 近傍 (directions 順, 周期境界)。shape (8,2)"""
+        tank_size = mols.shape[0]
+        return mols[(row_idx + DIR_ROWS) % tank_size, (col_idx + DIR_COLS) % tank_size]
+
+    def calc_bond_energy(self, ngb, kind, dir, skip_pos=None):
+        """
+        8 近傍 ngb の中心に (kind, dir) を置いたときの結合エネルギーの和。
+        kind, dir は配列でもよく、そのときは先頭の軸ごとに和を返す。
+        結合は両側の self energy の和 (calc_neighbor_energy_7x7 の数え方と同じ)。
+        skip_pos の方向の結合は数えない (swap する 2 セル間の結合を別に扱うため)。
+        """
+        bonds = get_bond_table(self.lec)[np.asarray(kind)[..., None], np.asarray(dir)[..., None],
+                                         ngb[:, 0], ngb[:, 1], POS8]
+        if skip_pos is not None:
+            bonds[..., skip_pos] = 0.0
+        return bonds.sum(axis=-1)
+
+    def calc_swap_delta_energy(self, mols, row_idx, col_idx, swap_pos):
+        """(row_idx, col_idx) と swap_pos 方向の隣を交換したときの ΔE"""
+        bond_table = get_bond_table(self.lec)
+        tank_size = mols.shape[0]
+        d = directions[swap_pos]
+        tgt_row, tgt_col = (row_idx + d[0]) % tank_size, (col_idx + d[1]) % tank_size
+        ka, da = mols[row_idx, col_idx]
+        kb, db = mols[tgt_row, tgt_col]
+
+        # [交換前, 交換後] をまとめて評価する
+        a_bonds = self.calc_bond_energy(self.get_neighbor_8(mols, row_idx, col_idx),
+                                        [ka, kb], [da, db], skip_pos=swap_pos)
+        b_bonds = self.calc_bond_energy(self.get_neighbor_8(mols, tgt_row, tgt_col),
+                                        [kb, ka], [db, da], skip_pos=(swap_pos + 4) % 8)
+        E0 = a_bonds[0] + b_bonds[0] + bond_table[ka, da, kb, db, swap_pos]
+        E1 = a_bonds[1] + b_bonds[1] + bond_table[kb, db, ka, da, swap_pos]
+        return E1 - E0
+
+    def calc_rotate_delta_energy(self, mols, row_idx, col_idx, new_dir):
+        """(row_idx, col_idx) の soap の向きを new_dir にしたときの ΔE"""
+        kind, cur_dir = mols[row_idx, col_idx]
+        bonds = self.calc_bond_energy(self.get_neighbor_8(mols, row_idx, col_idx),
+                                      [kind, kind], [cur_dir, new_dir])
+        return bonds[1] - bonds[0]
+
+    def check_delta_energy(self, mols, row_idx, col_idx, changes, dE):
+        """
+        debug 用: changes = [(drow, dcol, [kind, dir]), ...] を (row_idx, col_idx) 中心の
+        7x7 窓に適用して全再計算した ΔE と dE が一致するか確認する。
+        """
+        tank_size = mols.shape[0]
+        idx = [(row_idx + di) % tank_size for di in range(-3, 4)]
+        jdx = [(col_idx + dj) % tank_size for dj in range(-3, 4)]
+        original = mols[np.ix_(idx, jdx)]
+        proposal = original.copy()
+        for drow, dcol, mol in changes:
+            proposal[3+drow, 3+dcol] = mol
+        full_dE = self.calc_neighbor_energy_7x7(proposal) - self.calc_neighbor_energy_7x7(original)
+        assert np.isclose(full_dE, dE), "ΔE mismatch at ({}, {}): {} != {}".format(row_idx, col_idx, dE, full_dE)
+
+    def try_swap_delta(self, mols, row_idx, col_idx, temp_scale, rng):
+        """
+        try_local_swap_7x7 の ΔE 版。mols を直接書き換える。
+        乱数の引き方は try_local_swap_7x7 と同じ。(is_swap, dE) を返す。
+        """
+        may_swap_indicator = rng.choice(8)
+        self.last_swap_pos = may_swap_indicator
+        dE = self.calc_swap_delta_energy(mols, row_idx, col_idx, may_swap_indicator)
+        d = directions[may_swap_indicator]
+        tgt_row, tgt_col = (row_idx + d[0]) % mols.shape[0], (col_idx + d[1]) % mols.shape[0]
+        if self.check_delta:
+            self.check_delta_energy(mols, row_idx, col_idx,
+                                    [(0, 0, mols[tgt_row, tgt_col]), (d[0], d[1], mols[row_idx, col_idx])], dE)
+
+        is_swap = self.MCMC_step(0.0, dE, temp_scale, rng)
+        if is_swap:
+            a = mols[row_idx, col_idx].copy()
+            mols[row_idx, col_idx] = mols[tgt_row, tgt_col]
+            mols[tgt_row, tgt_col] = a
+        return is_swap, dE
+
+    def try_rotate_delta(self, mols, row_idx, col_idx, temp_scale, rng):
+        """try_local_rotate_7x7 の ΔE 版。mols を直接書き換える。(is_rotate, dE) を返す。"""
+        if mols[row_idx, col_idx][0] != MoleculeKind.SoapKind:
+            return False, 0.0
+
+        cur_dir = int(mols[row_idx, col_idx][1])
+        diff = rng.choice([-1, 1])
+        new_dir = (cur_dir + diff) % 8
+        dE = self.calc_rotate_delta_energy(mols, row_idx, col_idx, new_dir)
+        if self.check_delta:
+            self.check_delta_energy(mols, row_idx, col_idx, [(0, 0, [MoleculeKind.SoapKind, new_dir])], dE)
+
+        is_rotate = self.MCMC_step(0.0, dE, temp_scale, rng)
+        if is_rotate:
+            mols[row_idx, col_idx, 1] = new_dir
+        return is_rotate, dE
@@ -0,0 +1,165 @@
+"""
+近傍 swap / rotate に加える非局所な move。Tank(..., moves={"kawasaki": 0.05, ...}) で、
+Tank.try_swap_7x7 が中心に選んだセルごとに swap / rotate の後でそれぞれの確率で提案する。
+値を dict にすると move の設定も渡せる (例 {"cluster_translate": {"prob": 0.05, "max_size": 100}})。
+
+- kawasaki: 中心と格子全体から一様に選んだセルの kind が違えば交換する
+- cluster_translate: 中心を含む soap クラスタ (8 近傍) を 8 方向の 1 つに 1 セル平行移動する
+  (中心のセルが移動後のクラスタに含まれないときは棄却する。含まれないと同じセルから逆向きの move が提案できない)
+- cluster_rotate: 中心を含む soap クラスタを中心のまわりに ±90° 回す (soap の向きも ±90°)
+  (cluster の move の設定は max_size: これより大きいクラスタは提案しない。既定は 50)
+
+どの move も逆向きの move が同じ確率で提案されるように作ってあるので、採択は Metropolis でよい。
+cluster の move は移動先で別の soap と接する (逆向きのときにクラスタが変わる) ときは棄却する。
+押しのけた water / air は、空いたセルと移動先のセルをそれぞれ flat index 順に並べて対応させて入れ替える
+(逆向きの move でちょうど元に戻る)。
+"""
+
+import numpy as np
+from impl.molecule import MoleculeKind, directions
+from impl.stats import KAWASAKI, CLUSTER_TRANSLATE, CLUSTER_ROTATE
+
+SOAP = MoleculeKind.SoapKind.value
+
+def find_cluster(mols, row_idx, col_idx, max_size):
+    """
+    (row_idx, col_idx) の soap を含むクラスタ (8 近傍、周期境界) の各セルの中心からの相対位置 (周期で畳まない)。
+    max_size より大きければ None。
+    """
+    N = mols.shape[0]
+    seen = {(row_idx, col_idx)}
+    offsets = [(0, 0)]
+    queue = [(0, 0)]
+    while queue:
+        dr, dc = queue.pop()
+        for ddr, ddc in directions:
+            off = (dr + ddr, dc + ddc)
+            cell = ((row_idx + off[0]) % N, (col_idx + off[1]) % N)
+            if cell in seen or mols[cell][0] != SOAP:
+                continue
+            seen.add(cell)
+            offsets.append(off)
+            queue.append(off)
+            if len(offsets) > max_size:
+                return None
+    return np.array(offsets)
+
+class KawasakiMove:
+    """中心と格子全体から一様に選んだセルの交換 (kind が同じなら提案しない)"""
+    stat = KAWASAKI
+
+    def propose(self, tank, row_idx, col_idx):
+        """
+        提案して採択なら tank.mols を書き換える。提案しなかったら None、
+        したら (accepted, dE, 変化したセルの (rows, cols), kind_a, kind_b) を返す。
+        """
+        mols = tank.mols
+        tgt_row, tgt_col = tank.rng.integers(tank.tank_size, size=2)
+        kind_a, kind_b = mols[row_idx, col_idx, 0], mols[tgt_row, tgt_col, 0]
+        if kind_a == kind_b:
+            return None
+        pos = (np.array([row_idx, tgt_row]), np.array([col_idx, tgt_col]))
+        new_mols = mols[pos][::-1]
+        dE = tank.kernel.change_delta_energy(mols, pos, new_mols)
+        accepted = tank.mcmc_utl.MCMC_step(0.0, dE, tank.temp_scale, tank.rng)
+        if accepted:
+            mols[pos] = new_mols
+        return accepted, dE, pos, kind_a, kind_b
+
+class ClusterMove:
+    """
+    中心を含む soap クラスタ全体の平行移動 (translate) か回転 (rotate)。
+    max_size より大きいクラスタや、(rotate では) 周期境界で自分とつながるほど広がったクラスタは提案しない。
+    """
+    def __init__(self, kind, max_size=50):
+        assert kind in ("translate", "rotate")
+        self.kind = kind
+        self.max_size = max_size
+        self.stat = CLUSTER_TRANSLATE if kind == "translate" else CLUSTER_ROTATE
+
+    def propose(self, tank, row_idx, col_idx):
+        """KawasakiMove.propose と同じ"""
+        mols = tank.mols
+        N = tank.tank_size
+        if mols[row_idx, col_idx, 0] != SOAP:
+            return None
+        rng = tank.rng
+        if self.kind == "translate":
+            d = np.array(directions[rng.integers(8)])
+        else:
+            sense = rng.integers(2)
+        offsets = find_cluster(mols, row_idx, col_idx, self.max_size)
+        if offsets is None:
+            return None
+        kind_a = kind_b = MoleculeKind.SoapKind
+        if self.kind == "translate":
+            # 中心が移動後のクラスタに残る (-d が元のクラスタにある) ときだけ。中心にできるセルは C ∩ (C + d) で、
+            # 逆向きの move (-d) でも同じ集合になる
+            if not (offsets == -d).all(axis=1).any():
+                return False, 0.0, None, kind_a, kind_b
+            new_offsets = offsets + d
+            dir_shift = 0
+        elif sense == 0:
+            # +90°: (dr, dc) -> (dc, -dr)、向きの index は +2
+            new_offsets = np.stack([offsets[:, 1], -offsets[:, 0]], axis=1)
+            dir_shift = 2
+        else:
+            new_offsets = np.stack([-offsets[:, 1], offsets[:, 0]], axis=1)
+            dir_shift = 6
+        if self.kind == "rotate":
+            # 回転は展開した相対位置で決まるので、周期境界で自分とつながるクラスタ (射影が N 列を覆う) は除く。
+            # 判定は移動前後の和集合の幅で、どの中心から見ても (逆向きの move でも) 同じになる
+            both = np.concatenate([offsets, new_offsets])
+            if (both.max(axis=0) - both.min(axis=0) >= N - 1).any():
+                return None
+        old_flat = ((row_idx + offsets[:, 0]) % N) * N + (col_idx + offsets[:, 1]) % N
+        new_flat = ((row_idx + new_offsets[:, 0]) % N) * N + (col_idx + new_offsets[:, 1]) % N
+
+        flat_mols = mols.reshape(-1, 2)
+        targets = np.setdiff1d(new_flat, old_flat)
+        vacated = np.setdiff1d(old_flat, new_flat)
+        # 移動先にクラスタ外の soap がいる、または移動後に別の soap と接するなら棄却
+        if (flat_mols[targets, 0] == SOAP).any():
+            return False, 0.0, None, kind_a, kind_b
+        new_rows, new_cols = np.divmod(new_flat, N)
+        ngb = (((new_rows[:, None] + tank.kernel.offsets[:, 0]) % N) * N
+               + (new_cols[:, None] + tank.kernel.offsets[:, 1]) % N).ravel()
+        ngb = np.setdiff1d(ngb, np.concatenate([new_flat, vacated]))
+        if (flat_mols[ngb, 0] == SOAP).any():
+            return False, 0.0, None, kind_a, kind_b
+
+        changed = np.concatenate([new_flat, vacated])
+        new_mols = np.empty((len(changed), 2), dtype=mols.dtype)
+        cluster = flat_mols[old_flat]
+        new_mols[:len(new_flat), 0] = cluster[:, 0]
+        new_mols[:len(new_flat), 1] = (cluster[:, 1] + dir_shift) % 8
+        # setdiff1d は sort 済みなので、そのまま順に対応させる
+        new_mols[len(new_flat):] = flat_mols[targets]
+        pos = np.divmod(changed, N)
+        dE = tank.kernel.change_delta_energy(mols, pos, new_mols)
+        accepted = tank.mcmc_utl.MCMC_step(0.0, dE, tank.temp_scale, rng)
+        if accepted:
+            mols[pos] = new_mols
+        return accepted, dE, pos, kind_a, kind_b
+
+def make_moves(move_mix):
+    """
+    {"kawasaki": 確率, "cluster_translate": 確率, "cluster_rotate": 確率} -> [(確率, move), ...]。
+    確率の代わりに {"prob": 確率, 設定: 値, ...} を渡すと、設定は move の引数になる (cluster の max_size)。
+    知らない名前や設定は ValueError
+    """
+    factories = dict(kawasaki=KawasakiMove, cluster_translate=lambda **kw: ClusterMove("translate", **kw),
+                     cluster_rotate=lambda **kw: ClusterMove("rotate", **kw))
+    options = dict(kawasaki=(), cluster_translate=("max_size",), cluster_rotate=("max_size",))
+    moves = []
+    for name, spec in (move_mix or {}).items():
+        if name not in factories:
+            raise ValueError("invalid move name: {}".format(name))
+        spec = dict(spec) if isinstance(spec, dict) else dict(prob=spec)
+        prob = spec.pop("prob")
+        unknown = set(spec) - set(options[name])
+        if unknown:
+            raise ValueError("invalid option for {}: {}".format(name, ", ".join(sorted(unknown))))
+        if prob > 0:
+            moves.append((prob, factories[name](**spec)))
+    return moves
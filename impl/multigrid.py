@@ -0,0 +1,180 @@
+"""
+大きな Tank の coarse-to-fine (multigrid) 初期化。
+ランダムな初期配置からの粗視化 (相分離・クラスタの成長) は格子が大きいほど時間がかかるので、
+小さい格子で平衡に近づけてから最近傍で拡大し、目標のサイズで続きを回す (何段でもよい)。
+
+- 拡大は最近傍 (各セルを約 factor x factor のブロックにコピー)。soap の向きもそのままコピーする
+- 拡大すると個数の端数がずれるので、多すぎる kind のセルを足りない kind との界面から選んで置き換え、
+  init_mols と同じ個数 (int(N^2 * ratio)) にちょうど合わせる。新しい soap の向きは隣の soap からもらう
+- 各段の最後の配置と観測量は record (.npz) に残し、最終的な Tank の metadata["init"] にも段ごとの情報が入る
+
+    python -m impl.multigrid --tank-size 400 --levels 3 --level-steps 300 --steps 300 --cold-steps 1000
+"""
+
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from impl.molecule import LEC, MoleculeKind, MOL_DTYPE, directions
+from impl.tank import Tank
+from impl.observables import SCALAR_COLUMNS, compute_observables
+
+S = MoleculeKind.SoapKind.value
+W = MoleculeKind.WaterKind.value
+A = MoleculeKind.AirKind.value
+
+# 一番粗い段の最小サイズ (sequential の 7x7 窓と checkerboard の副格子が入るように)
+MIN_SIZE = 8
+
+def level_sizes(tank_size, levels, factor=2):
+    """粗い順の各段のサイズ (最後が tank_size)"""
+    sizes = [max(MIN_SIZE, int(np.ceil(tank_size / factor ** k))) for k in range(levels, 0, -1)]
+    return sizes + [tank_size]
+
+def target_counts(tank_size, soap_ratio, water_ratio):
+    """Tank.init_mols と同じ個数 {kind: 個数}"""
+    soap_num = int(tank_size * tank_size * soap_ratio)
+    water_num = int(tank_size * tank_size * water_ratio)
+    return {S: soap_num, W: water_num, A: tank_size * tank_size - soap_num - water_num}
+
+def touches(kinds, kind):
+    """8 近傍 (周期境界) に kind があるセル"""
+    mask = np.zeros(kinds.shape, dtype=bool)
+    for dr, dc in directions:
+        mask |= np.roll(kinds, (-dr, -dc), axis=(0, 1)) == kind
+    return mask
+
+def fix_composition(mols, counts, rng):
+    """
+    mols の kind ごとの個数を counts にちょうど合わせる (その場で書き換える)。
+    多すぎる kind のセルを、足りない kind に接しているものから優先して選んで置き換える
+    """
+    N = mols.shape[0]
+    kinds = mols[:, :, 0]
+    while True:
+        diff = {kind: int((kinds == kind).sum()) - num for kind, num in counts.items()}
+        surplus = [kind for kind, d in diff.items() if d > 0]
+        deficit = [kind for kind, d in diff.items() if d < 0]
+        if not surplus:
+            return mols
+        src, dst = surplus[0], deficit[0]
+        num = min(diff[src], -diff[dst])
+        is_src = kinds == src
+        candidates = np.flatnonzero(is_src & touches(kinds, dst))
+        if len(candidates) < num:
+            candidates = np.flatnonzero(is_src)
+        cells = rng.choice(candidates, num, replace=False)
+        rows, cols = np.divmod(cells, N)
+        mols[rows, cols, 0] = dst
+        mols[rows, cols, 1] = -1
+        if dst == S:
+            for row_idx, col_idx in zip(rows, cols):
+                mols[row_idx, col_idx, 1] = neighbor_soap_dir(mols, row_idx, col_idx, rng)
+
+def neighbor_soap_dir(mols, row_idx, col_idx, rng):
+    """隣の soap の向き (なければランダム)"""
+    N = mols.shape[0]
+    for dr, dc in directions:
+        ngb = mols[(row_idx + dr) % N, (col_idx + dc) % N]
+        if ngb[0] == S and ngb[1] >= 0:
+            return ngb[1]
+    return rng.integers(8)
+
+def upsample(mols, tank_size, soap_ratio, water_ratio, rng):
+    """mols を最近傍で tank_size x tank_size に拡大し、個数を init_mols と同じにそろえる"""
+    idx = np.arange(tank_size) * mols.shape[0] // tank_size
+    fine = mols[np.ix_(idx, idx)].astype(MOL_DTYPE)
+    return fix_composition(fine, target_counts(tank_size, soap_ratio, water_ratio), rng)
+
+def level_summary(tank, steps, elapsed):
+    """各段の記録 (metadata に入れるので JSON にできる値だけ)"""
+    values = compute_observables(tank.mols)
+    summary = dict(tank_size=tank.tank_size, steps=steps, elapsed=elapsed,
+                   energy_per_site=float(tank.energy / tank.mols[:, :, 0].size))
+    summary.update({name: float(values[i]) for i, name in enumerate(SCALAR_COLUMNS)})
+    return summary
+
+def multigrid_tank(soap_ratio, water_ratio, temp_scale, tank_size=1000, levels=3, level_steps=200, factor=2,
+                   seed=0, lec=LEC, sweep="checkerboard", record=None, **tank_kwargs):
+    """
+    levels 段の粗い格子を順に level_steps step (段ごとのリストでもよい) ずつ回して拡大し、
+    tank_size の Tank を返す (続きは返した Tank の run で回す)。粗い段は sweep で回し、
+    tank_kwargs は最後の Tank にだけ渡す。record を与えると各段の最後の配置と情報を .npz に保存する。
+    """
+    sizes = level_sizes(tank_size, levels, factor)
+    steps = list(np.broadcast_to(level_steps, (levels,)))
+    seeds = np.random.SeedSequence(seed).spawn(2 * levels + 2)
+    mols = None
+    info = []
+    arrays = {}
+    for level in range(levels):
+        start = time.perf_counter()
+        restart = None
+        if mols is not None:
+            restart = upsample(mols, sizes[level], soap_ratio, water_ratio, np.random.default_rng(seeds[2 * level]))
+        tank = Tank(soap_ratio, water_ratio, temp_scale, tank_size=sizes[level], seed=seeds[2 * level + 1],
+                    restart=restart, lec=lec, sweep=sweep)
+        for _ in range(int(steps[level])):
+            tank.step()
+        mols = tank.mols
+        info.append(level_summary(tank, int(steps[level]), time.perf_counter() - start))
+        arrays["level_{}".format(level)] = mols.copy()
+        print("level {} size {} energy/site {:.4f}".format(level, sizes[level], info[-1]["energy_per_site"]))
+    restart = upsample(mols, tank_size, soap_ratio, water_ratio, np.random.default_rng(seeds[2 * levels]))
+    tank = Tank(soap_ratio, water_ratio, temp_scale, tank_size=tank_size, seed=seeds[2 * levels + 1], restart=restart,
+                lec=lec, sweep=sweep, **tank_kwargs)
+    tank.init_info = dict(method="multigrid", factor=factor, levels=info)
+    if record is not None:
+        arrays["initial"] = tank.mols.copy()
+        np.savez(record, info=np.array(json.dumps(tank.init_info)), **arrays)
+    return tank
+
+def load_record(path):
+    """record の (info, [各段の配置], 拡大直後の最終サイズの配置)"""
+    with np.load(path) as data:
+        info = json.loads(str(data["info"]))
+        levels = [data["level_{}".format(level)] for level in range(len(info["levels"]))]
+        return info, levels, data["initial"]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="multigrid 初期化と cold start の比較")
+    parser.add_argument("--tank-size", type=int, default=400)
+    parser.add_argument("--soap-ratio", type=float, default=0.3)
+    parser.add_argument("--water-ratio", type=float, default=0.35)
+    parser.add_argument("--temp-scale", type=float, default=0.3)
+    parser.add_argument("--levels", type=int, default=3)
+    parser.add_argument("--level-steps", type=int, nargs="+", default=[200], help="粗い段ごとの step 数 (1 つなら全段)")
+    parser.add_argument("--steps", type=int, default=200, help="目標サイズでの step 数")
+    parser.add_argument("--cold-steps", type=int, default=0, help="比べる cold start の step 数 (0 なら比べない)")
+    parser.add_argument("--sweep", default="checkerboard", choices=["sequential", "checkerboard", "active"])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--record", default=None, help="各段の配置を保存する .npz")
+    args = parser.parse_args(argv)
+    level_steps = args.level_steps[0] if len(args.level_steps) == 1 else args.level_steps
+    if np.ndim(level_steps) and len(level_steps) != args.levels:
+        print("--level-steps needs 1 or --levels values.")
+        sys.exit()
+
+    results = {}
+    start = time.perf_counter()
+    tank = multigrid_tank(args.soap_ratio, args.water_ratio, args.temp_scale, tank_size=args.tank_size,
+                          levels=args.levels, level_steps=level_steps, seed=args.seed, sweep=args.sweep,
+                          record=args.record)
+    for _ in range(args.steps):
+        tank.step()
+    results["multigrid"] = level_summary(tank, args.steps, time.perf_counter() - start)
+    if args.cold_steps > 0:
+        start = time.perf_counter()
+        cold = Tank(args.soap_ratio, args.water_ratio, args.temp_scale, tank_size=args.tank_size, seed=args.seed,
+                    sweep=args.sweep)
+        for _ in range(args.cold_steps):
+            cold.step()
+        results["cold"] = level_summary(cold, args.cold_steps, time.perf_counter() - start)
+    names = ["elapsed", "energy_per_site"] + SCALAR_COLUMNS
+    print("{:20s}".format("") + "".join("{:>14s}".format(key) for key in results))
+    for name in names:
+        print("{:20s}".format(name) + "".join("{:14.4f}".format(r[name]) for r in results.values()))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,246 @@
+"""
+構造の観測量を格子全体についてベクトル化して計算し、保存 step ごとの時系列として書き出す。
+
+- soap クラスタ: 8 近傍・周期境界の union-find でラベル付けし、サイズ分布 (2 のべきの bin) と micelle 割合
+- 界面の向き: soap-water / soap-air の結合のうち is_xsc_interaction / is_xsh_interaction に当たる割合
+- 曲率: soap ごとの is_sscurv_interaction を満たす近傍の数の分布
+
+時系列は trajectory 形式 (impl/trajectory.py) の float64 レコードとして書く (header の metadata に列名)。
+Tank.run(..., observables=...) で run 中に、または保存済みの trajectory に対して
+
+    python -m impl.observables log/exe.traj --out log/exe_obs.traj
+"""
+
+import queue
+import argparse
+import functools
+import threading
+import numpy as np
+from impl.molecule import InteractionHelpers, MoleculeKind, Soap, directions
+from impl.trajectory import TrajectoryWriter, TrajectoryReader
+
+S = MoleculeKind.SoapKind.value
+W = MoleculeKind.WaterKind.value
+A = MoleculeKind.AirKind.value
+
+OFFSETS = np.array(directions)
+# 片側の 4 方向 (結合を 1 回ずつ数える)
+HALF_OFFSETS = [(0, 1), (1, -1), (1, 0), (1, 1)]
+
+# 2^k <= size < 2^(k+1) を bin k に入れる。1000x1000 まで入る
+SIZE_BINS = 21
+CURV_BINS = 9
+
+SCALAR_COLUMNS = ["soap_num", "cluster_num", "mean_cluster_size", "max_cluster_size", "micelle_fraction",
+                  "interface_fraction", "water_xsc", "water_xsh", "air_xsc", "air_xsh", "mean_sscurv"]
+COLUMNS = (SCALAR_COLUMNS + ["size_bin_{}".format(k) for k in range(SIZE_BINS)]
+           + ["sscurv_{}".format(n) for n in range(CURV_BINS)])
+
+@functools.lru_cache(maxsize=None)
+def get_interaction_tables():
+    """
+    InteractionHelpers の判定を全状態について評価した bool テーブル。pos は soap -> 相手の方向。
+    xsc[dir, pos], xsh[dir, pos]: pos 方向に water/air があるときの soap の向き
+    sscurv[dir, other_dir, pos]: pos 方向に other_dir の soap があるとき
+    """
+    helpers = InteractionHelpers()
+    xsc = np.zeros((8, 8), dtype=bool)
+    xsh = np.zeros((8, 8), dtype=bool)
+    sscurv = np.zeros((8, 8, 8), dtype=bool)
+    for pos in range(8):
+        # is_xsc/xsh の pos は x -> soap
+        back = (pos + 4) % 8
+        for dir in range(8):
+            soap = Soap(dir=dir)
+            xsc[dir, pos] = helpers.is_xsc_interaction(soap, back)
+            xsh[dir, pos] = helpers.is_xsh_interaction(soap, back)
+            for other_dir in range(8):
+                sscurv[dir, other_dir, pos] = helpers.is_sscurv_interaction(soap, Soap(dir=other_dir), pos)
+    for table in (xsc, xsh, sscurv):
+        table.flags.writeable = False
+    return xsc, xsh, sscurv
+
+def label_clusters(mask):
+    """
+    mask (H, W) の True のセルを 8 近傍・周期境界でつないだクラスタのラベル (0, 1, ...)。mask 外は -1。
+    union-find を配列で回す: 結合ごとに根の大きい方を小さい方へつなぎ (np.minimum.at)、
+    pointer jumping で親を根まで縮める、を結合の両端の根が一致するまで繰り返す。
+    """
+    n_rows, n_cols = mask.shape
+    idx = np.arange(n_rows * n_cols).reshape(n_rows, n_cols)
+    src, dst = [], []
+    for dr, dc in HALF_OFFSETS:
+        # ngb[r, c] = x[r+dr, c+dc]
+        ngb_mask = np.roll(mask, (-dr, -dc), axis=(0, 1))
+        both = mask & ngb_mask
+        src.append(idx[both])
+        dst.append(np.roll(idx, (-dr, -dc), axis=(0, 1))[both])
+    src = np.concatenate(src)
+    dst = np.concatenate(dst)
+
+    parent = np.arange(n_rows * n_cols)
+    while True:
+        root_a, root_b = parent[src], parent[dst]
+        diff = root_a != root_b
+        if not diff.any():
+            break
+        src, dst = src[diff], dst[diff]
+        root_a, root_b = root_a[diff], root_b[diff]
+        np.minimum.at(parent, np.maximum(root_a, root_b), np.minimum(root_a, root_b))
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+
+    labels = np.full(n_rows * n_cols, -1)
+    flat_mask = mask.ravel()
+    _, labels[flat_mask] = np.unique(parent[flat_mask], return_inverse=True)
+    return labels.reshape(n_rows, n_cols)
+
+def cluster_sizes(mols):
+    """soap クラスタのサイズの配列"""
+    labels = label_clusters(mols[:, :, 0] == S)
+    return np.bincount(labels[labels >= 0])
+
+def sscurv_count_field(mols):
+    """soap ごとの is_sscurv_interaction を満たす近傍の数 (soap 以外は 0)"""
+    _, _, sscurv = get_interaction_tables()
+    kinds = mols[:, :, 0]
+    dirs = mols[:, :, 1].astype(np.intp) % 8
+    is_soap = kinds == S
+    count = np.zeros(kinds.shape, dtype=np.int64)
+    for p, (dr, dc) in enumerate(OFFSETS):
+        ngb_soap = np.roll(is_soap, (-dr, -dc), axis=(0, 1))
+        ngb_dirs = np.roll(dirs, (-dr, -dc), axis=(0, 1))
+        count += is_soap & ngb_soap & sscurv[dirs, ngb_dirs, p]
+    return count
+
+def interface_counts(mols):
+    """
+    soap-water / soap-air の結合数とそのうち xsc / xsh の数、界面 (water か air が隣にある) の soap 数。
+    """
+    xsc, xsh, _ = get_interaction_tables()
+    kinds = mols[:, :, 0]
+    dirs = mols[:, :, 1].astype(np.intp) % 8
+    is_soap = kinds == S
+    counts = dict(water=np.zeros(3, dtype=np.int64), air=np.zeros(3, dtype=np.int64))
+    at_interface = np.zeros(kinds.shape, dtype=bool)
+    for p, (dr, dc) in enumerate(OFFSETS):
+        ngb_kinds = np.roll(kinds, (-dr, -dc), axis=(0, 1))
+        for name, kind in (("water", W), ("air", A)):
+            bond = is_soap & (ngb_kinds == kind)
+            at_interface |= bond
+            counts[name] += [np.count_nonzero(bond), np.count_nonzero(bond & xsc[dirs, p]),
+                             np.count_nonzero(bond & xsh[dirs, p])]
+    return counts, np.count_nonzero(at_interface)
+
+def compute_observables(mols, micelle_min_size=10):
+    """1 フレーム分の観測量。COLUMNS の順の float64 配列"""
+    sizes = cluster_sizes(mols)
+    soap_num = sizes.sum()
+    size_hist = np.bincount(np.log2(np.maximum(sizes, 1)).astype(int), weights=sizes, minlength=SIZE_BINS)
+    counts, interface_num = interface_counts(mols)
+    curv = sscurv_count_field(mols)[mols[:, :, 0] == S]
+    curv_hist = np.bincount(curv, minlength=CURV_BINS)
+
+    def ratio(a, b):
+        return a / b if b > 0 else 0.0
+
+    scalars = [soap_num, len(sizes), ratio(soap_num, len(sizes)), sizes.max(initial=0),
+               ratio(sizes[sizes >= micelle_min_size].sum(), soap_num), ratio(interface_num, soap_num),
+               ratio(counts["water"][1], counts["water"][0]), ratio(counts["water"][2], counts["water"][0]),
+               ratio(counts["air"][1], counts["air"][0]), ratio(counts["air"][2], counts["air"][0]),
+               ratio(curv.sum(), len(curv))]
+    # size_bin_k は bin k のクラスタに入っている soap の割合、sscurv_n は sscurv 近傍が n 個の soap の割合
+    return np.concatenate([scalars, size_hist[:SIZE_BINS] / max(soap_num, 1),
+                           curv_hist[:CURV_BINS] / max(len(curv), 1)])
+
+class ObservableRecorder:
+    """
+    compute_observables の結果を step ごとに trajectory 形式 (shape (len(COLUMNS),), float64) に追記する。
+    record はフレームをコピーしてキューに積むだけで、計算と書き出しは別スレッドで行う
+    (キューが queue_size 個たまったときだけ待つ)。
+    """
+    def __init__(self, path, metadata=None, micelle_min_size=10, mode="w", resume_step=None, queue_size=4):
+        self.micelle_min_size = micelle_min_size
+        metadata = dict(metadata or {}, columns=COLUMNS, micelle_min_size=micelle_min_size)
+        self.writer = TrajectoryWriter(path, (len(COLUMNS),), metadata=metadata, dtype=np.float64,
+                                       mode=mode, resume_step=resume_step)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._record_loop, daemon=True)
+        self.thread.start()
+
+    def _record_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                if self.error is not None:
+                    continue
+                step, mols = item
+                self.writer.append(step, compute_observables(mols, self.micelle_min_size))
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def record(self, step, mols):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((int(step), np.array(mols, copy=True)))
+
+    def flush(self):
+        """キューに積んだフレームの観測量を全部書いてディスクまで同期する (TrajectoryWriter.flush と同じ)"""
+        if self.thread is not None:
+            self.queue.join()
+            if self.error is None:
+                self.writer.flush()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def load_observables(path):
+    """時系列ファイルを読み、{"step": ..., 列名: ...} の配列の dict にする"""
+    with TrajectoryReader(path) as reader:
+        values = np.array([np.array(frame) for _, frame in reader]).reshape(len(reader), -1)
+        columns = reader.metadata["columns"]
+        steps = np.array(reader.steps)
+    series = {"step": steps}
+    series.update({column: values[:, i] for i, column in enumerate(columns)})
+    return series
+
+def analyze_trajectory(traj_path, out_path, micelle_min_size=10):
+    """保存済み trajectory の全フレームについて観測量を計算して out_path に書く"""
+    with TrajectoryReader(traj_path) as reader:
+        with ObservableRecorder(out_path, metadata=reader.metadata, micelle_min_size=micelle_min_size) as recorder:
+            for step, frame in reader:
+                recorder.record(step, np.asarray(frame))
+                print(step)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="trajectory から構造の観測量の時系列を作る")
+    parser.add_argument("trajectory")
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--micelle-min-size", type=int, default=10)
+    args = parser.parse_args(argv)
+    analyze_trajectory(args.trajectory, args.out, args.micelle_min_size)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import os
+import threading
+import multiprocessing as mp
+from multiprocessing import shared_memory
+import numpy as np
+from impl.molecule import LEC, MoleculeKind
+from impl.lattice import LatticeKernel, SUBLATTICE_STRIDE
+from impl.tank import Tank, VISIT_PROB
+from impl.stats import MoveStats, SWAP, ROTATE
+
+# 制御用配列 ctrl の中身: [cmd, temp_scale, shift_row, shift_col, color_0, ..., color_15, dE_0, ..., dE_{workers-1},
+#                         counts_0, ..., counts_{workers-1}]
+# dE_i は worker i がその step で採択した ΔE の和、counts_i はその step の MoveStats.counts (stats=True のときだけ)
+CMD_STEP = 0
+CMD_QUIT = 1
+N_COLORS = SUBLATTICE_STRIDE * SUBLATTICE_STRIDE
+CTRL_HEADER = 4 + N_COLORS
+COUNTS_SIZE = MoveStats().counts.size
+# 1 step (全 color) を待つ上限の秒数。worker が落ちたら barrier が揃わないので、ここで諦めて止める
+BARRIER_TIMEOUT = 300.0
+
+def ctrl_size(workers, stats):
+    return CTRL_HEADER + workers + (workers * COUNTS_SIZE if stats else 0)
+
+def _worker_main(shm_name, ctrl_name, shape, worker_idx, workers, row_range, lec, seed_seq, start_barrier,
+                 phase_barrier, stats=False, timeout=BARRIER_TIMEOUT):
+    """
+    1 worker = 行方向の 1 strip。各副格子 (color) の中心のうち自分の strip にあるものだけを更新し、
+    color ごとに全 worker で同期する。strip 外 (halo) のセルは共有メモリから直接読み書きするが、
+    同じ color の中心同士は 4 セル以上離れているので他の worker の更新とは干渉しない。
+    step の合間 (親の次の step 待ち) 以外の barrier は timeout 秒で諦め、barrier が壊れたら (他の worker が
+    落ちた・親が abort した) 終わる。
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    ctrl_shm = shared_memory.SharedMemory(name=ctrl_name)
+    mols = np.ndarray(shape, dtype=np.int8, buffer=shm.buf)
+    ctrl = np.ndarray(ctrl_size(workers, stats), dtype=np.float64, buffer=ctrl_shm.buf)
+    counts_begin = CTRL_HEADER + workers + worker_idx * COUNTS_SIZE
+    move_stats = MoveStats() if stats else None
+    kernel = LatticeKernel(lec)
+    rng = np.random.default_rng(seed_seq)
+    row_begin, row_end = row_range
+    try:
+        while True:
+            start_barrier.wait()
+            if ctrl[0] == CMD_QUIT:
+                break
+            temp_scale = ctrl[1]
+            shift = ctrl[2:4].astype(int)
+            dE_sum = 0.0
+            if move_stats is not None:
+                move_stats.reset()
+            for color in ctrl[4:CTRL_HEADER].astype(int):
+                origin = shift + [color // SUBLATTICE_STRIDE, color % SUBLATTICE_STRIDE]
+                pos = kernel.sublattice(shape[:2], origin)
+                own = (pos[0] >= row_begin) & (pos[0] < row_end)
+                pos = tuple(x[own] for x in pos)
+                visit = rng.random(len(pos[0])) < VISIT_PROB
+                pos = tuple(x[visit] for x in pos)
+                n = len(pos[0])
+                swap_pos = rng.integers(8, size=n)
+                if move_stats is not None:
+                    kind_a = mols[pos][..., 0]
+                    kind_b = mols[kernel.shift(mols, pos, swap_pos)][..., 0]
+                accepted, dE = kernel.try_swap(mols, pos, swap_pos, rng.random(n), temp_scale)
+                dE_sum += dE[accepted].sum()
+                if move_stats is not None:
+                    move_stats.count_array(SWAP, kind_a, kind_b, accepted)
+                accepted, dE = kernel.try_rotate(mols, pos, rng.integers(2, size=n), rng.random(n), temp_scale)
+                dE_sum += dE[accepted].sum()
+                if move_stats is not None:
+                    move_stats.count_array(ROTATE, MoleculeKind.SoapKind, MoleculeKind.SoapKind, accepted)
+                phase_barrier.wait(timeout)
+            ctrl[CTRL_HEADER + worker_idx] = dE_sum
+            if move_stats is not None:
+                ctrl[counts_begin:counts_begin + COUNTS_SIZE] = move_stats.counts.ravel()
+            start_barrier.wait(timeout)
+    except threading.BrokenBarrierError:
+        pass
+    except BaseException:
+        # 例外で落ちるときは barrier を壊して、親と他の worker を timeout まで待たせない
+        start_barrier.abort()
+        phase_barrier.abort()
+        raise
+    finally:
+        del mols, ctrl
+        shm.close()
+        ctrl_shm.close()
+
+class ParallelTank(Tank):
+    """
+    checkerboard sweep を行方向の strip に分けて複数プロセスで回す Tank。
+    格子は共有メモリ上にあり、self.mols はそのまま write_log などに使える。
+    使い終わったら close() する (with 文でもよい)。
+    worker が落ちる (例外・OOM kill) か 1 step が barrier_timeout 秒で終わらなければ、
+    残りの worker を止めて RuntimeError を投げる。
+    """
+    def __init__(self, soap_ratio, water_ratio, temp_scale, tank_size=100, seed=0, restart=None, lec=LEC,
+                 workers=None, stats=False, barrier_timeout=BARRIER_TIMEOUT):
+        super().__init__(soap_ratio, water_ratio, temp_scale, tank_size=tank_size, seed=seed,
+                         restart=restart, lec=lec, sweep="checkerboard", stats=stats)
+        if workers is None:
+            workers = os.cpu_count()
+        # strip は副格子の 1 周期 (4 行) 以上の幅にする
+        self.workers = max(1, min(workers, tank_size // SUBLATTICE_STRIDE))
+        self.barrier_timeout = barrier_timeout
+
+        self.shm = shared_memory.SharedMemory(create=True, size=self.mols.nbytes)
+        mols = np.ndarray(self.mols.shape, dtype=self.mols.dtype, buffer=self.shm.buf)
+        mols[:] = self.mols
+        self.mols = mols
+        size = ctrl_size(self.workers, stats)
+        self.ctrl_shm = shared_memory.SharedMemory(create=True, size=size * 8)
+        self.ctrl = np.ndarray(size, dtype=np.float64, buffer=self.ctrl_shm.buf)
+
+        self.start_barrier = mp.Barrier(self.workers + 1)
+        phase_barrier = mp.Barrier(self.workers)
+        bounds = np.linspace(0, tank_size, self.workers + 1).astype(int)
+        seed_seqs = np.random.SeedSequence(seed).spawn(self.workers)
+        self.procs = []
+        for worker_idx in range(self.workers):
+            proc = mp.Process(target=_worker_main,
+                              args=(self.shm.name, self.ctrl_shm.name, self.mols.shape, worker_idx, self.workers,
+                                    (bounds[worker_idx], bounds[worker_idx+1]), lec,
+                                    seed_seqs[worker_idx], self.start_barrier, phase_barrier, stats,
+                                    barrier_timeout),
+                              daemon=True)
+            proc.start()
+            self.procs.append(proc)
+
+    def step(self):
+        self.ctrl[0] = CMD_STEP
+        self.ctrl[1] = self.temp_scale
+        self.ctrl[2:4] = self.rng.integers(SUBLATTICE_STRIDE, size=2)
+        self.ctrl[4:CTRL_HEADER] = self.rng.permutation(N_COLORS)
+        # 1 回目で全 worker が走り出し、2 回目で全 color の更新が終わるのを待つ
+        self.check_workers()
+        try:
+            self.start_barrier.wait(self.barrier_timeout)
+            self.start_barrier.wait(self.barrier_timeout)
+        except threading.BrokenBarrierError:
+            self.abort("ParallelTank step failed (a worker died or the step took over {} s).".format(
+                self.barrier_timeout))
+        self.energy += self.ctrl[CTRL_HEADER:CTRL_HEADER + self.workers].sum()
+        if self.stats is not None:
+            counts = self.ctrl[CTRL_HEADER + self.workers:].reshape(self.workers, *self.stats.counts.shape)
+            self.stats.counts += counts.sum(axis=0).astype(np.int64)
+
+    def run(self, loop_num, out_prefix, save_step_num, checkpoint=None, **kwargs):
+        """Tank.run と同じ。checkpoint は使えないので、run を始める前に ValueError にする"""
+        if checkpoint is not None:
+            raise ValueError("ParallelTank does not support checkpoint.")
+        super().run(loop_num, out_prefix, save_step_num, **kwargs)
+
+    def save_checkpoint(self, path):
+        # worker ごとの乱数の状態は集めていないので、再開しても同じ結果にならない
+        raise NotImplementedError("ParallelTank does not support checkpoint.")
+
+    def check_workers(self):
+        """落ちた worker があれば abort する"""
+        if any(proc.exitcode is not None for proc in self.procs):
+            self.abort("ParallelTank worker died.")
+
+    def abort(self, message):
+        """worker を止めて共有メモリを片付け、RuntimeError を投げる"""
+        exitcodes = [proc.exitcode for proc in self.procs]
+        # 待っている worker を barrier から抜けさせてから止める
+        self.start_barrier.abort()
+        for proc in self.procs:
+            if proc.exitcode is None:
+                proc.terminate()
+            proc.join()
+        self.procs = []
+        self.release()
+        raise RuntimeError("{} worker exitcodes: {}".format(message, exitcodes))
+
+    def release(self):
+        if self.ctrl_shm is None:
+            return
+        # 共有メモリを手放す前に格子を通常の配列へ戻しておく
+        self.mols = self.mols.copy()
+        del self.ctrl
+        self.shm.close()
+        self.shm.unlink()
+        self.ctrl_shm.close()
+        self.ctrl_shm.unlink()
+        self.ctrl_shm = None
+
+    def close(self):
+        if self.procs:
+            self.check_workers()
+            self.ctrl[0] = CMD_QUIT
+            try:
+                self.start_barrier.wait(self.barrier_timeout)
+            except threading.BrokenBarrierError:
+                self.abort("ParallelTank workers did not quit within {} s.".format(self.barrier_timeout))
+            for proc in self.procs:
+                proc.join()
+            self.procs = []
+        self.release()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,162 @@
+"""
+相図探索: (soap_ratio, water_ratio, temp_scale, seed) の各点で Tank を回し、
+要約量を 1 つの CSV (results table) にまとめる。途中で止めても、既に CSV にある点は飛ばして再開できる。
+点が済んでいるかは点の値と run の設定 (tank_size, root_seed, sweep, step 数) の組で判定するので、
+設定を変えて同じ CSV に回すと、その設定の点として新しく回す。
+
+    python -m impl.phase_sweep --soap-ratios 0.05:0.5:20 --water-ratios 0.1:0.6:20 \\
+        --temp-scales 0.1:2.0:10 --seeds 1 --tank-size 50 --out phase.csv
+"""
+
+import os
+import csv
+import time
+import argparse
+import itertools
+import multiprocessing as mp
+import numpy as np
+from impl.molecule import MoleculeKind
+from impl.tank import Tank
+
+KEY_COLUMNS = ["soap_ratio", "water_ratio", "temp_scale", "seed"]
+# 結果を変える run の設定。再開のときの突き合わせにも使う
+RUN_COLUMNS = ["tank_size", "root_seed", "sweep", "equil_steps", "sample_steps", "sample_every"]
+RESULT_COLUMNS = KEY_COLUMNS + RUN_COLUMNS + ["steps", "energy_per_site", "energy_per_site_std",
+                                              "soap_soap_contact", "water_air_contact", "elapsed"]
+
+def make_grid(soap_ratios, water_ratios, temp_scales, seeds=(0,)):
+    """直積の点のリスト。soap_ratio + water_ratio > 1 の点は除く"""
+    return [dict(soap_ratio=float(s), water_ratio=float(w), temp_scale=float(t), seed=int(seed))
+            for s, w, t, seed in itertools.product(soap_ratios, water_ratios, temp_scales, seeds)
+            if s + w <= 1.0]
+
+def point_key(point):
+    """CSV との突き合わせに使う key (float は丸めて比較する)"""
+    return (round(float(point["soap_ratio"]), 6), round(float(point["water_ratio"]), 6),
+            round(float(point["temp_scale"]), 6), int(point["seed"]))
+
+def run_key(row):
+    """point_key に run の設定 (RUN_COLUMNS) を足したもの。CSV の行か、点と設定を合わせた dict"""
+    return point_key(row) + (int(row["tank_size"]), int(row["root_seed"]), str(row["sweep"]),
+                             int(row["equil_steps"]), int(row["sample_steps"]), int(row["sample_every"]))
+
+def point_seed_seq(root_seed, point):
+    """
+    root SeedSequence から点ごとの SeedSequence を作る。
+    spawn_key を点の値から決めるので、grid の並びや再開の有無によらず同じ点は同じ乱数になる。
+    """
+    soap_ratio, water_ratio, temp_scale, seed = point_key(point)
+    root = np.random.SeedSequence(root_seed)
+    spawn_key = (round(soap_ratio * 1e6), round(water_ratio * 1e6), round(temp_scale * 1e6), seed)
+    return np.random.SeedSequence(root.entropy, spawn_key=root.spawn_key + spawn_key)
+
+def contact_fraction(mols, kind_a, kind_b):
+    """8 近傍の結合のうち kind_a-kind_b (順不同) の割合"""
+    kinds = mols[:, :, 0]
+    count = 0
+    for shift in [(0, 1), (1, 0), (1, 1), (1, -1)]:
+        ngb = np.roll(kinds, shift, axis=(0, 1))
+        count += np.count_nonzero(((kinds == kind_a) & (ngb == kind_b)) | ((kinds == kind_b) & (ngb == kind_a)))
+    return count / (4 * kinds.size)
+
+def run_point(point, root_seed=0, tank_size=50, equil_steps=200, sample_steps=100, sample_every=10,
+              sweep="checkerboard"):
+    """1 点分のシミュレーション。RESULT_COLUMNS の dict を返す"""
+    start = time.time()
+    tank = Tank(point["soap_ratio"], point["water_ratio"], point["temp_scale"], tank_size=tank_size,
+                seed=point_seed_seq(root_seed, point), sweep=sweep)
+    for _ in range(equil_steps):
+        tank.step()
+    energies = []
+    for step_idx in range(sample_steps):
+        tank.step()
+        if step_idx % sample_every == 0:
+            energies.append(tank.energy / tank.mols[:, :, 0].size)
+    return dict(soap_ratio=point["soap_ratio"], water_ratio=point["water_ratio"],
+                temp_scale=point["temp_scale"], seed=point["seed"], tank_size=tank_size, root_seed=root_seed,
+                sweep=sweep, equil_steps=equil_steps, sample_steps=sample_steps, sample_every=sample_every,
+                steps=equil_steps + sample_steps,
+                energy_per_site=np.mean(energies), energy_per_site_std=np.std(energies),
+                soap_soap_contact=contact_fraction(tank.mols, MoleculeKind.SoapKind, MoleculeKind.SoapKind),
+                water_air_contact=contact_fraction(tank.mols, MoleculeKind.WaterKind, MoleculeKind.AirKind),
+                elapsed=time.time() - start)
+
+def _run_point_star(args):
+    point, kwargs = args
+    return run_point(point, **kwargs)
+
+def load_done_keys(out_path):
+    """
+    out_path に既にある行の run_key。列が RESULT_COLUMNS と違う (run の設定の列が無い古い CSV など) ときは
+    設定を突き合わせられないので ValueError
+    """
+    if not os.path.exists(out_path):
+        return set()
+    with open(out_path, newline="") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames is not None and reader.fieldnames != RESULT_COLUMNS:
+            raise ValueError("{} has different columns; cannot resume from it: {}".format(out_path, reader.fieldnames))
+        return {run_key(row) for row in reader}
+
+def run_sweep(points, out_path, processes=None, root_seed=0, tank_size=50, equil_steps=200, sample_steps=100,
+              sample_every=10, sweep="checkerboard"):
+    """
+    points を process pool で回して out_path (CSV) に 1 行ずつ追記する。
+    out_path に同じ設定で既にある点は飛ばす。設定は run_point に渡す。
+    """
+    kwargs = dict(root_seed=root_seed, tank_size=tank_size, equil_steps=equil_steps, sample_steps=sample_steps,
+                  sample_every=sample_every, sweep=sweep)
+    done = load_done_keys(out_path)
+    todo = [point for point in points if run_key(dict(point, **kwargs)) not in done]
+    print("{} points, {} done, {} to run".format(len(points), len(points) - len(todo), len(todo)))
+    if not todo:
+        return
+    is_new = not os.path.exists(out_path) or os.path.getsize(out_path) == 0
+    with open(out_path, "a", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=RESULT_COLUMNS)
+        if is_new:
+            writer.writeheader()
+        with mp.Pool(processes) as pool:
+            for done_num, row in enumerate(pool.imap_unordered(_run_point_star, [(p, kwargs) for p in todo]), 1):
+                writer.writerow(row)
+                f.flush()
+                print("{}/{}".format(done_num, len(todo)), *(row[k] for k in KEY_COLUMNS))
+
+def parse_values(specs, dtype=float):
+    """"start:stop:num" (linspace) か値の列を受け付ける"""
+    values = []
+    for spec in specs:
+        if ":" in spec:
+            start, stop, num = spec.split(":")
+            values.extend(np.linspace(float(start), float(stop), int(num)))
+        else:
+            values.append(dtype(spec))
+    return values
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="soap_ratio / water_ratio / temp_scale の相図 sweep")
+    parser.add_argument("--soap-ratios", nargs="+", required=True)
+    parser.add_argument("--water-ratios", nargs="+", required=True)
+    parser.add_argument("--temp-scales", nargs="+", required=True)
+    parser.add_argument("--seeds", type=int, default=1, help="点ごとの独立な試行数")
+    parser.add_argument("--root-seed", type=int, default=0)
+    parser.add_argument("--tank-size", type=int, default=50)
+    parser.add_argument("--equil-steps", type=int, default=200)
+    parser.add_argument("--sample-steps", type=int, default=100)
+    parser.add_argument("--sample-every", type=int, default=10)
+    parser.add_argument("--sweep", default="checkerboard", choices=["sequential", "checkerboard", "active"])
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--out", default="phase_sweep.csv")
+    args = parser.parse_args(argv)
+
+    points = make_grid(parse_values(args.soap_ratios), parse_values(args.water_ratios),
+                       parse_values(args.temp_scales), range(args.seeds))
+    try:
+        run_sweep(points, args.out, processes=args.processes, root_seed=args.root_seed, tank_size=args.tank_size,
+                  equil_steps=args.equil_steps, sample_steps=args.sample_steps, sample_every=args.sample_every,
+                  sweep=args.sweep)
+    except ValueError as e:
+        parser.error(str(e))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+"""
+matplotlib を使わずに格子を RGB 配列へ直接描く renderer。
+セルを scale x scale ピクセルに塗り、soap には向きごとに事前に作った矢印の sprite を押す。
+色と向きは renderer.py の COLORS / DIRS と同じ。
+"""
+
+import os
+import glob
+import struct
+import zlib
+import multiprocessing as mp
+import numpy as np
+from impl.trajectory import TrajectoryReader
+
+# 8方向 (molecule.py の directions と同じ順)
+DIRS = np.array([
+    [-1, -1], [-1, 0], [-1, 1],
+    [ 0, 1],  [ 1, 1],  [ 1, 0],
+    [ 1,-1],  [ 0,-1]
+])
+
+# 種類 → 色 (index = kind, 0 は未使用)
+COLORS = np.array([
+    [0.0, 0.0, 0.0],
+    [1.0, 0.5, 0.0],    # Soap : orange
+    [0.2, 0.4, 1.0],    # Water: blue
+    [0.95, 0.95, 0.95]  # Air  : white
+])
+ARROW_COLOR = np.array([0, 0, 0], dtype=np.uint8)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+def make_arrow_sprites(scale):
+    """
+    向きごとの矢印のマスク。shape (8, scale, scale)。
+    セル中心の少し後ろから向きの方向へ伸びる軸と三角形の頭。
+    """
+    coords = (np.arange(scale) + 0.5) / scale - 0.5
+    y, x = np.meshgrid(coords, coords, indexing="ij")
+    sprites = np.zeros((len(DIRS), scale, scale), dtype=bool)
+    for d, (dy, dx) in enumerate(DIRS):
+        norm = np.hypot(dy, dx)
+        uy, ux = dy / norm, dx / norm
+        t = x * ux + y * uy           # 向きに沿った座標
+        n = np.abs(-x * uy + y * ux)  # 向きに垂直な距離
+        shaft = (t >= -0.4) & (t <= 0.1) & (n <= max(0.06, 0.5 / scale))
+        head = (t >= 0.05) & (t <= 0.45) & (n <= (0.45 - t) * 0.7)
+        sprites[d] = shaft | head
+    return sprites
+
+def rasterize(arr, scale=8, sprites=None):
+    """arr (H, W, 2) = [kind, dir] を RGB (H*scale, W*scale, 3) の uint8 配列にする"""
+    if sprites is None:
+        sprites = make_arrow_sprites(scale)
+    kinds = arr[:, :, 0].astype(np.intp)
+    dirs = arr[:, :, 1].astype(np.intp)
+    H, W = kinds.shape
+    palette = np.round(COLORS * 255).astype(np.uint8)
+    img = np.repeat(np.repeat(palette[kinds], scale, axis=0), scale, axis=1)
+    # (H, W, scale, scale, 3) の view にしてセル単位で sprite を押す
+    tiles = img.reshape(H, scale, W, scale, 3).swapaxes(1, 2)
+    is_soap = kinds == 1
+    for d in range(len(DIRS)):
+        cells = is_soap & (dirs == d)
+        if cells.any():
+            tile = tiles[cells]
+            tile[:, sprites[d]] = ARROW_COLOR
+            tiles[cells] = tile
+    return img
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+def png_ihdr(img):
+    H, W, _ = img.shape
+    return png_chunk(b"IHDR", struct.pack(">IIBBBBB", W, H, 8, 2, 0, 0, 0))
+
+def png_compress(img, level=6):
+    """RGB uint8 配列を PNG の画像データ (IDAT の中身) にする"""
+    H, W, _ = img.shape
+    raw = np.zeros((H, 1 + W * 3), dtype=np.uint8)  # 各行の先頭は filter type 0
+    raw[:, 1:] = img.reshape(H, W * 3)
+    return zlib.compress(raw.tobytes(), level)
+
+def encode_png(img, level=6):
+    """RGB uint8 配列を PNG のバイト列にする (zlib だけで書く)"""
+    return PNG_SIGNATURE + png_ihdr(img) + png_chunk(b"IDAT", png_compress(img, level)) + png_chunk(b"IEND", b"")
+
+def write_png(path, img, level=6):
+    with open(path, "wb") as f:
+        f.write(encode_png(img, level))
+
+def load_frame(src):
+    """src = .npy のパスか (.traj のパス, フレーム index)"""
+    if isinstance(src, tuple):
+        path, idx = src
+        with TrajectoryReader(path) as reader:
+            return np.array(reader[idx])
+    return np.load(src)
+
+def collect_jobs(log_dir, out_dir, npy_name=None):
+    """
+    log_dir の *_step_*.npy と *.traj (2D の格子のもの) のフレームを描く jobs = [(src, out_path), ...]。
+    npy_name は .npy の名前 (拡張子なし) -> 出力ファイル名 (None なら名前 + ".png")
+    """
+    jobs = []
+    for f in sorted(glob.glob(os.path.join(log_dir, "*_step_*.npy"))):
+        name = os.path.splitext(os.path.basename(f))[0]
+        jobs.append((f, os.path.join(out_dir, name + ".png" if npy_name is None else npy_name(name))))
+    # trajectory (*.traj) は 1 ファイルにまとまっているのでフレームごとに読む
+    for f in sorted(glob.glob(os.path.join(log_dir, "*.traj"))):
+        name = os.path.splitext(os.path.basename(f))[0]
+        with TrajectoryReader(f) as reader:
+            # 観測量の時系列 (*_obs.traj) や 3D の trajectory は描けないので飛ばす
+            if len(reader.shape) != 3 or reader.shape[2] != 2:
+                print(name, "skipped (shape {})".format(reader.shape))
+                continue
+            print(name, len(reader), "frames")
+            for idx, step in enumerate(reader.steps):
+                jobs.append(((f, idx), os.path.join(out_dir, "{}_frame_{}.png".format(name, step))))
+    return jobs
+
+def _render_job(args):
+    src, out_path, scale = args
+    write_png(out_path, rasterize(load_frame(src), scale))
+    return out_path
+
+def render_frames(jobs, scale=8, processes=None):
+    """jobs = [(src, out_path), ...] を process pool で PNG にする"""
+    with mp.Pool(processes) as pool:
+        for out_path in pool.imap_unordered(_render_job, [(src, out_path, scale) for src, out_path in jobs]):
+            print("render:", out_path)
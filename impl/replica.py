@@ -0,0 +1,161 @@
+import os
+import sys
+import multiprocessing as mp
+import numpy as np
+from impl.molecule import LEC
+from impl.tank import Tank
+
+class _ReplicaWorker:
+    """1 プロセス分の replica (Tank) を持ち、ReplicaExchange からのコマンドを処理する"""
+    def __init__(self, tank_args):
+        # tank_args: {replica_idx: Tank の引数 dict}
+        self.tanks = {replica_idx: Tank(**args) for replica_idx, args in tank_args.items()}
+
+    def handle(self, cmd, *args):
+        match cmd:
+            case "run":
+                # 各 replica を step_num step 進めてエネルギーを返す
+                temps, step_num = args
+                energies = {}
+                for replica_idx, tank in self.tanks.items():
+                    tank.temp_scale = temps[replica_idx]
+                    for _ in range(step_num):
+                        tank.step()
+                    energies[replica_idx] = tank.energy
+                return energies
+            case "get_mols":
+                replica_idx, = args
+                return self.tanks[replica_idx].mols.copy()
+            case "write_log":
+                replica_idx, out_prefix, loop_idx = args
+                self.tanks[replica_idx].write_log(out_prefix, loop_idx)
+            case _:
+                print("invalid replica command.")
+                sys.exit()
+
+def _worker_main(conn, tank_args):
+    worker = _ReplicaWorker(tank_args)
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        conn.send(worker.handle(*msg))
+    conn.close()
+
+class ReplicaExchange:
+    """
+    温度ラダー temps の各温度に 1 つずつ Tank (replica) を置いて並列に回し、
+    round ごとに隣り合う温度の replica の入れ替えを Metropolis 判定で提案する (parallel tempering)。
+    入れ替えは温度の付け替えで行うので、配置をプロセス間で送る必要はない。
+    processes=0 ならすべて同じプロセスで回す (debug 用)。
+    """
+    def __init__(self, soap_ratio, water_ratio, temps, tank_size=100, seed=0, restart=None, lec=LEC,
+                 sweep="checkerboard", processes=None):
+        self.temps = np.sort(np.asarray(temps, dtype=float))
+        n_replicas = len(self.temps)
+        seed_seq = np.random.SeedSequence(seed)
+        replica_seeds = seed_seq.spawn(n_replicas + 1)
+        self.rng = np.random.default_rng(replica_seeds[-1])
+        # temp_to_replica[i]: 温度 temps[i] にいる replica
+        self.temp_to_replica = np.arange(n_replicas)
+        self.energies = np.zeros(n_replicas)
+        self.swap_attempts = np.zeros(n_replicas - 1, dtype=int)
+        self.swap_accepts = np.zeros(n_replicas - 1, dtype=int)
+        self.round_idx = 0
+
+        if processes is None:
+            processes = os.cpu_count()
+        processes = min(processes, n_replicas)
+        tank_args = [dict(soap_ratio=soap_ratio, water_ratio=water_ratio, temp_scale=self.temps[replica_idx],
+                          tank_size=tank_size, seed=replica_seeds[replica_idx], restart=restart, lec=lec,
+                          sweep=sweep)
+                     for replica_idx in range(n_replicas)]
+        if processes <= 0:
+            self.local_worker = _ReplicaWorker(dict(enumerate(tank_args)))
+            self.replica_to_worker = np.zeros(n_replicas, dtype=int)
+            self.conns, self.procs = [], []
+            return
+        self.local_worker = None
+        self.replica_to_worker = np.arange(n_replicas) % processes
+        self.conns, self.procs = [], []
+        for worker_idx in range(processes):
+            parent_conn, child_conn = mp.Pipe()
+            args = {replica_idx: tank_args[replica_idx]
+                    for replica_idx in np.flatnonzero(self.replica_to_worker == worker_idx)}
+            proc = mp.Process(target=_worker_main, args=(child_conn, args), daemon=True)
+            proc.start()
+            self.conns.append(parent_conn)
+            self.procs.append(proc)
+
+    def _broadcast(self, *msg):
+        if self.local_worker is not None:
+            return [self.local_worker.handle(*msg)]
+        for conn in self.conns:
+            conn.send(msg)
+        return [conn.recv() for conn in self.conns]
+
+    def _call(self, replica_idx, *msg):
+        if self.local_worker is not None:
+            return self.local_worker.handle(*msg)
+        conn = self.conns[self.replica_to_worker[replica_idx]]
+        conn.send(msg)
+        return conn.recv()
+
+    def replica_temps(self):
+        """replica ごとの現在の温度"""
+        temps = np.empty(len(self.temps))
+        temps[self.temp_to_replica] = self.temps
+        return temps
+
+    def try_exchange(self):
+        """偶数/奇数番目の隣接ペアを round ごとに交互に提案する"""
+        for i in range(self.round_idx % 2, len(self.temps) - 1, 2):
+            a, b = self.temp_to_replica[i], self.temp_to_replica[i+1]
+            # min(1, exp((1/T_i - 1/T_{i+1}) (E_a - E_b)))
+            log_acc = (1.0/self.temps[i] - 1.0/self.temps[i+1]) * (self.energies[a] - self.energies[b])
+            self.swap_attempts[i] += 1
+            if log_acc >= 0 or self.rng.random() < np.exp(log_acc):
+                self.swap_accepts[i] += 1
+                self.temp_to_replica[i], self.temp_to_replica[i+1] = b, a
+
+    def acceptance_rates(self):
+        """隣接温度ペア (temps[i], temps[i+1]) ごとの入れ替え採択率"""
+        return self.swap_accepts / np.maximum(self.swap_attempts, 1)
+
+    def run(self, round_num, step_num, out_prefix=None, save_round_num=1):
+        """
+        round_num 回、全 replica を step_num step 進めて入れ替えを提案する。
+        out_prefix を与えると save_round_num round ごとに各温度の配置を
+        <out_prefix>_T<温度 index>_step_<step> として write_log する。
+        """
+        for _ in range(round_num):
+            temps = dict(enumerate(self.replica_temps()))
+            for energies in self._broadcast("run", temps, step_num):
+                for replica_idx, energy in energies.items():
+                    self.energies[replica_idx] = energy
+            self.try_exchange()
+            self.round_idx += 1
+            if self.round_idx % save_round_num == 0:
+                print(self.round_idx, " ".join("{:.2f}".format(r) for r in self.acceptance_rates()))
+                if out_prefix is not None:
+                    for temp_idx, replica_idx in enumerate(self.temp_to_replica):
+                        self._call(replica_idx, "write_log", replica_idx, "{}_T{}".format(out_prefix, temp_idx),
+                                   self.round_idx * step_num)
+
+    def get_mols(self, temp_idx=0):
+        """temps[temp_idx] にいる replica の配置 (既定は最低温度)"""
+        replica_idx = self.temp_to_replica[temp_idx]
+        return self._call(replica_idx, "get_mols", replica_idx)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(None)
+        for proc in self.procs:
+            proc.join()
+        self.conns, self.procs = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,241 @@
+"""
+histogram reweighting。保存済みのサンプル (全エネルギー・観測量) から、走らせていない温度
+(と LocalEnergyConstant) での期待値を誤差つきで推定する。
+
+- 1 run なら single-histogram (Ferrenberg-Swendsen): 重み exp(-E'/T' + E/T)
+- 複数 run なら multi-histogram (WHAM): 全 run のサンプルを合わせ、run ごとの自由エネルギー f_k を自己無撞着に解く
+  (ビンに分けずにサンプルごとに和を取る形。エネルギーは LocalEnergyConstant の値の組み合わせなので離散的で、
+  ビンに分けても同じになる)
+- エネルギーは lec の各項について線形なので、サンプルごとに項ごとの相互作用の数 (term_counts) を持っておけば、
+  lec を変えたときのエネルギーは内積で出る (lec の摂動も同じ重みの式で扱える)
+- 誤差は各 run を blocks 個の連続したブロックに分けた jackknife (ブロックが自己相関時間より長ければ相関も含む)
+
+    python -m impl.reweight log/T030.traj log/T035.traj --temps 0.28:0.38:11 --burn-in 1000 --out reweight.csv
+
+離れた温度ほど重みが少数のサンプルに集中するので、n_eff (重みの有効サンプル数) が小さい点は信用しない。
+"""
+
+import sys
+import csv
+import argparse
+import dataclasses
+import functools
+import numpy as np
+from impl.molecule import LEC, LocalEnergyConstant, build_energy_table, directions
+from impl.observables import COLUMNS, compute_observables
+from impl.trajectory import TrajectoryReader
+from impl.phase_sweep import parse_values
+
+# LocalEnergyConstant の項の名前 (term_counts の列の順)
+TERMS = [field.name for field in dataclasses.fields(LocalEnergyConstant)]
+
+@functools.lru_cache(maxsize=None)
+def get_term_tables():
+    """
+    tables[t, s, s2, pos]: 項 TERMS[t] の係数だけを 1 にしたエネルギーテーブル (状態 s = kind * 8 + dir % 8)。
+    エネルギーテーブルは lec の各項の線形和なので、sum_t lec[t] * tables[t] が get_energy_table(lec)
+    """
+    tables = [build_energy_table(LocalEnergyConstant(**{name: float(name == term) for name in TERMS}))
+              for term in TERMS]
+    tables = np.stack(tables)
+    n_states = tables.shape[1] * tables.shape[2]
+    return tables.reshape(len(TERMS), n_states, n_states, -1)
+
+def lec_vector(lec):
+    return np.array([getattr(lec, term) for term in TERMS])
+
+def term_counts(mols):
+    """
+    mols (N, N, 2) の項ごとの相互作用の数 (自分から見た近傍ごとに数える)。
+    全エネルギー (LatticeKernel.total_energy) は term_counts(mols) @ lec_vector(lec)
+    """
+    tables = get_term_tables()
+    n_states = tables.shape[1]
+    s = mols[..., 0].astype(np.intp) * 8 + mols[..., 1] % 8
+    counts = np.zeros(len(TERMS))
+    for p, off in enumerate(directions):
+        ngb = np.roll(s, shift=(-off[0], -off[1]), axis=(0, 1))
+        pairs = np.bincount((s * n_states + ngb).ravel(), minlength=n_states * n_states)
+        counts += tables[:, :, :, p].reshape(len(TERMS), -1) @ pairs
+    return counts
+
+def logsumexp(x, axis=None):
+    x_max = np.max(x, axis=axis, keepdims=True)
+    return np.squeeze(x_max, axis=axis) + np.log(np.exp(x - x_max).sum(axis=axis))
+
+class Samples:
+    """
+    1 run (1 つの temp_scale と lec) の平衡なサンプル。
+    energies (n,) と observables (n, len(names))。counts (n, len(TERMS)) があれば energies は counts から計算し、
+    別の lec でのエネルギーも出せる。
+    """
+    def __init__(self, temp_scale, energies=None, observables=None, names=(), counts=None, lec=LEC):
+        self.temp_scale = temp_scale
+        self.lec = lec
+        self.counts = None if counts is None else np.asarray(counts, dtype=float)
+        if energies is None:
+            energies = self.counts @ lec_vector(lec)
+        self.energies = np.asarray(energies, dtype=float)
+        self.names = list(names)
+        if observables is None:
+            observables = np.zeros((len(self.energies), 0))
+        self.observables = np.asarray(observables, dtype=float).reshape(len(self.energies), len(self.names))
+
+    def __len__(self):
+        return len(self.energies)
+
+    def energy(self, lec=None):
+        """lec でのエネルギー (None ならこの run の lec)"""
+        if lec is None or lec == self.lec:
+            return self.energies
+        if self.counts is None:
+            print("term counts are required to reweight to another lec.")
+            sys.exit()
+        return self.counts @ lec_vector(lec)
+
+    @classmethod
+    def from_trajectory(cls, path, burn_in=0, observables=True, micelle_min_size=10):
+        """
+        trajectory の step >= burn_in のフレームから。temp_scale と lec は header の metadata から読む。
+        observables=True なら compute_observables の全列 (COLUMNS) も計算する
+        """
+        counts, values, steps = [], [], []
+        with TrajectoryReader(path) as reader:
+            metadata = reader.metadata
+            for step, frame in reader:
+                if step < burn_in:
+                    continue
+                frame = np.asarray(frame)
+                counts.append(term_counts(frame))
+                if observables:
+                    values.append(compute_observables(frame, micelle_min_size))
+                steps.append(step)
+        names = COLUMNS if observables else ()
+        samples = cls(metadata["temp_scale"], observables=np.array(values) if observables else None, names=names,
+                      counts=np.array(counts).reshape(-1, len(TERMS)), lec=LocalEnergyConstant(**metadata["lec"]))
+        samples.steps = np.array(steps)
+        return samples
+
+def solve_wham(u, n_samples, f=None, tol=1e-10, max_iter=100000):
+    """
+    u[k, j]: 全サンプル j の run k での reduced energy (E_k / T_k)。n_samples[k]: run k のサンプル数。
+    f_k = -log Z_k を f_0 = 0 として自己無撞着に解き、(f, log_den) を返す。
+    log_den[j] = log sum_l N_l exp(f_l - u[l, j]) (サンプル j の重みの分母)
+    """
+    log_n = np.log(n_samples)[:, None]
+    f = np.zeros(len(u)) if f is None else f
+    for _ in range(max_iter):
+        log_den = logsumexp(log_n + f[:, None] - u, axis=0)
+        f_new = -logsumexp(-u - log_den, axis=1)
+        f_new -= f_new[0]
+        if np.abs(f_new - f).max() < tol:
+            f = f_new
+            break
+        f = f_new
+    log_den = logsumexp(log_n + f[:, None] - u, axis=0)
+    return f, log_den
+
+def weighted_estimates(log_w, energies, temp_scale, values):
+    """正規化前の log 重みから [<E>, C = Var(E) / T^2, <観測量>...] と重みの有効サンプル数"""
+    w = np.exp(log_w - log_w.max())
+    w /= w.sum()
+    mean_e = w @ energies
+    heat_capacity = (w @ (energies - mean_e) ** 2) / temp_scale ** 2
+    return np.concatenate([[mean_e, heat_capacity], w @ values]), 1.0 / (w @ w)
+
+class Reweighter:
+    """
+    runs (Samples のリスト) を合わせて、任意の (temp_scale, lec) での期待値を出す。
+    run が 1 つなら single-histogram、複数なら WHAM (f は最初に 1 度解いておく)。
+    """
+    def __init__(self, runs, blocks=10):
+        assert all(run.names == runs[0].names for run in runs)
+        self.runs = runs
+        self.blocks = blocks
+        self.names = ["energy", "heat_capacity"] + runs[0].names
+        self.n_samples = np.array([len(run) for run in runs])
+        self.observables = np.concatenate([run.observables for run in runs])
+        # u[k, j] = run k の lec・温度での全サンプル j の reduced energy
+        self.u = np.array([np.concatenate([r.energy(run.lec) for r in runs]) / run.temp_scale for run in runs])
+        # 各サンプルの run 内のブロック番号 (jackknife 用)
+        self.block_ids = np.concatenate([np.arange(n) * blocks // n for n in self.n_samples])
+        self.run_ids = np.repeat(np.arange(len(runs)), self.n_samples)
+        self.f, self.log_den = solve_wham(self.u, self.n_samples)
+
+    def target_energy(self, lec=None):
+        """全サンプルの lec でのエネルギー (None なら各 run の lec。run ごとに lec が違うときは指定が必要)"""
+        if lec is None:
+            lecs = {run.lec for run in self.runs}
+            assert len(lecs) == 1
+            lec = lecs.pop()
+        return np.concatenate([run.energy(lec) for run in self.runs])
+
+    def estimate(self, temp_scale, lec=None):
+        """(temp_scale, lec) での [energy, heat_capacity, 観測量...] の推定値、jackknife の誤差、n_eff"""
+        energies = self.target_energy(lec)
+        u_target = energies / temp_scale
+        mean, n_eff = weighted_estimates(-u_target - self.log_den, energies, temp_scale, self.observables)
+        replicas = []
+        for block in range(self.blocks):
+            keep = self.block_ids != block
+            n_samples = np.bincount(self.run_ids[keep], minlength=len(self.runs))
+            _, log_den = solve_wham(self.u[:, keep], n_samples, f=self.f.copy())
+            replicas.append(weighted_estimates(-u_target[keep] - log_den, energies[keep], temp_scale,
+                                               self.observables[keep])[0])
+        replicas = np.array(replicas)
+        err = np.sqrt((self.blocks - 1) / self.blocks * ((replicas - replicas.mean(axis=0)) ** 2).sum(axis=0))
+        return mean, err, n_eff
+
+    def scan(self, temp_scales, lec=None):
+        """temp_scales の各点の推定 (行ごとの dict)"""
+        rows = []
+        for temp_scale in temp_scales:
+            mean, err, n_eff = self.estimate(temp_scale, lec)
+            row = dict(temp_scale=temp_scale, n_eff=n_eff)
+            for name, m, e in zip(self.names, mean, err):
+                row[name] = m
+                row[name + "_err"] = e
+            rows.append(row)
+        return rows
+
+def parse_lec(specs, base=LEC):
+    """["E_sscurv=-2.5", ...] で base の項を置き換えた LocalEnergyConstant"""
+    values = {}
+    for spec in specs:
+        name, value = spec.split("=")
+        if name not in TERMS:
+            print("invalid energy term:", name)
+            sys.exit()
+        values[name] = float(value)
+    return dataclasses.replace(base, **values)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="保存済み trajectory から別の温度・エネルギー定数での観測量を推定する")
+    parser.add_argument("trajectories", nargs="+")
+    parser.add_argument("--temps", nargs="+", required=True, help="値の列か start:stop:num")
+    parser.add_argument("--burn-in", type=int, default=0, help="この step より前のフレームは使わない")
+    parser.add_argument("--blocks", type=int, default=10, help="jackknife のブロック数")
+    parser.add_argument("--lec", nargs="*", default=[], help="E_xxx=値 (最初の run の lec から置き換える)")
+    parser.add_argument("--micelle-min-size", type=int, default=10)
+    parser.add_argument("--out", default=None, help="CSV")
+    args = parser.parse_args(argv)
+
+    runs = [Samples.from_trajectory(path, args.burn_in, micelle_min_size=args.micelle_min_size)
+            for path in args.trajectories]
+    for path, run in zip(args.trajectories, runs):
+        print(path, "temp_scale", run.temp_scale, "samples", len(run))
+    reweighter = Reweighter(runs, args.blocks)
+    lec = parse_lec(args.lec, runs[0].lec) if args.lec else None
+    rows = reweighter.scan(parse_values(args.temps), lec)
+    for row in rows:
+        print("T {:.4f} n_eff {:7.1f} energy {:.2f} +- {:.2f} C {:.2f} +- {:.2f} max_cluster_size {:.2f} +- {:.2f}".format(
+            row["temp_scale"], row["n_eff"], row["energy"], row["energy_err"], row["heat_capacity"],
+            row["heat_capacity_err"], row["max_cluster_size"], row["max_cluster_size_err"]))
+    if args.out is not None:
+        with open(args.out, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+
+if __name__ == "__main__":
+    main()
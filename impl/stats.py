@@ -0,0 +1,89 @@
+import numpy as np
+from impl.molecule import MoleculeKind
+
+# move の種類 (counts の先頭の index)
+SWAP = 0
+ROTATE = 1
+KAWASAKI = 2
+CLUSTER_TRANSLATE = 3
+CLUSTER_ROTATE = 4
+MOVE_NAMES = ("swap", "rotate", "kawasaki", "cluster_translate", "cluster_rotate")
+N_KINDS = 4
+
+class MoveStats:
+    """
+    提案の数を move の種類と分子の組ごとに数え、step ごとの時間を記録する。
+    counts[move, kind_a, kind_b, accepted]: swap / kawasaki は中心と相手の kind、rotate と cluster の move は (soap, soap)。
+    Tank(..., stats=True) で有効になる (無効なら Tank.stats は None で何も数えない)。
+    mc_time は step (ΔE 計算と採択) に、io_time は保存 (write_log / trajectory / 動画 / 観測量 / checkpoint)
+    にかかった時間。
+    """
+    def __init__(self):
+        self.counts = np.zeros((len(MOVE_NAMES), N_KINDS, N_KINDS, 2), dtype=np.int64)
+        self.step_times = []
+        self.mc_time = 0.0
+        self.io_time = 0.0
+
+    def count(self, move, kind_a, kind_b, accepted):
+        self.counts[move, kind_a, kind_b, int(accepted)] += 1
+
+    def count_array(self, move, kind_a, kind_b, accepted):
+        """配列でまとめて数える (checkerboard 用)"""
+        idx = (np.asarray(kind_a, dtype=np.intp) * N_KINDS + kind_b) * 2 + accepted
+        self.counts[move] += np.bincount(idx.ravel(), minlength=N_KINDS * N_KINDS * 2).reshape(N_KINDS, N_KINDS, 2)
+
+    def add_step_time(self, elapsed):
+        self.step_times.append(elapsed)
+        self.mc_time += elapsed
+
+    def attempted(self, move=None):
+        counts = self.counts if move is None else self.counts[move]
+        return int(counts.sum())
+
+    def accepted(self, move=None):
+        counts = self.counts if move is None else self.counts[move]
+        return int(counts[..., 1].sum())
+
+    def rejected(self, move=None):
+        return self.attempted(move) - self.accepted(move)
+
+    def acceptance_rate(self, move=None):
+        attempted = self.attempted(move)
+        return self.accepted(move) / attempted if attempted > 0 else 0.0
+
+    def by_kind_pair(self, move):
+        """{"Soap-Water": (attempted, accepted), ...} (順不同の組にまとめる)"""
+        pairs = {}
+        for kind_a in MoleculeKind:
+            for kind_b in MoleculeKind:
+                if kind_b < kind_a:
+                    continue
+                counts = self.counts[move, kind_a, kind_b]
+                if kind_a != kind_b:
+                    counts = counts + self.counts[move, kind_b, kind_a]
+                if counts.sum() > 0:
+                    name = "{}-{}".format(kind_a.name[:-4], kind_b.name[:-4])
+                    pairs[name] = (int(counts.sum()), int(counts[1]))
+        return pairs
+
+    def summary(self):
+        """JSON にできる dict"""
+        step_times = np.array(self.step_times)
+        ret = dict(steps=len(step_times), mc_time=self.mc_time, io_time=self.io_time,
+                   mean_step_time=float(step_times.mean()) if len(step_times) else 0.0)
+        for move, name in enumerate(MOVE_NAMES):
+            ret[name] = dict(attempted=self.attempted(move), accepted=self.accepted(move),
+                             rejected=self.rejected(move), acceptance_rate=self.acceptance_rate(move),
+                             by_kind_pair=self.by_kind_pair(move))
+        return ret
+
+    def format_line(self):
+        """run の保存 step ごとに出す 1 行"""
+        step_ms = 1e3 * np.mean(self.step_times[-100:]) if self.step_times else 0.0
+        # swap / rotate 以外は提案があったものだけ出す
+        acc = " ".join("{} {:.3f}".format(name, self.acceptance_rate(move)) for move, name in enumerate(MOVE_NAMES)
+                       if move in (SWAP, ROTATE) or self.attempted(move) > 0)
+        return "acc {} | step {:.1f}ms | mc {:.1f}s io {:.1f}s".format(acc, step_ms, self.mc_time, self.io_time)
+
+    def reset(self):
+        self.__init__()
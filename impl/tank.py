@@ -1,73 +1,384 @@
+import os
+import time
+import io
+import json
 import numpy as np
-from impl.molecule import Soap, Water, Air, MCMCUtl
-from impl.molecule import MoleculeKind
+import dataclasses
+from impl.molecule import MCMCUtl, directions
+from impl.molecule import MoleculeKind, LEC, MOL_DTYPE, LocalEnergyConstant
+from impl.lattice import LatticeKernel
+from impl.trajectory import TrajectoryWriter
+from impl.video import VideoWriter
+from impl.observables import ObservableRecorder
+from impl.stats import MoveStats, SWAP, ROTATE
+from impl.active import ActiveSites
+from impl.moves import make_moves
+from impl.convergence import ConvergenceMonitor
+from impl.live import LivePublisher
 import sys
 
+# 1 step で各セルが提案の中心に選ばれる確率
+VISIT_PROB = 0.1
+
 class Tank:
-    def __init__(self, soap_ratio, water_ratio, temp_scale, tank_size=100, seed=0, restart=None):
+    # ΔE と副格子 sweep の kernel (Tank3D は LatticeKernel3D)
+    kernel_class = LatticeKernel
+    # write_log が .npy を書くディレクトリ (インスタンスごとに変えてよい)
+    log_dir = "./log"
+
+    def __init__(self, soap_ratio, water_ratio, temp_scale, tank_size=100, seed=0, restart=None, lec=LEC,
+                 delta_energy=True, check_delta=False, sweep="sequential", stats=False, moves=None):
         assert soap_ratio+water_ratio <= 1.0
+        self.soap_ratio = soap_ratio
+        self.water_ratio = water_ratio
+        self.seed = seed
         self.rng = np.random.default_rng(seed)
         self.temp_scale = temp_scale
         self.tank_size = tank_size
+        self.lec = lec
+        # delta_energy: 変化する結合だけで ΔE を計算する (False なら 7x7 窓を 2 回全計算)
+        # check_delta: ΔE を毎回 7x7 の全再計算と突き合わせる (debug 用)
+        self.delta_energy = delta_energy
+        self.check_delta = check_delta
+        self.mcmc_utl = MCMCUtl(lec, check_delta=check_delta)
+        # sweep: "sequential" はセルを順に 1 つずつ、"checkerboard" は互いに独立な副格子ごとに一括で更新する
+        # "active" は active なセル (ActiveSites) だけに提案する (active_step)
+        assert sweep in ("sequential", "checkerboard", "active")
+        self.sweep = sweep
+        self.kernel = self.kernel_class(lec)
         self.mols = self.init_mols(soap_ratio, water_ratio, restart)
+        # 終わった step 数。run はここから loop_num まで進める
+        self.loop_idx = 0
+        # 全エネルギー。採択された ΔE を足していくので、時系列 (energy_trace) は記録するだけでよい
+        self.energy = self.kernel.total_energy(self.mols)
+        self.energy_trace = []
+        # stats=True なら提案の採択数と時間を数える (MoveStats)。無効なら None
+        self.stats = MoveStats() if stats else None
+        # moves: 非局所な move の名前 → 中心ごとに提案する確率 (impl/moves.py)。
+        # 遠くのセルも書き換えるので sequential のときだけ使える
+        self.move_mix = dict(moves or {})
+        self.moves = make_moves(self.move_mix)
+        assert not self.moves or sweep == "sequential"
+        # run に渡した平衡化の monitor (ConvergenceMonitor)。checkpoint にも残す
+        self.convergence = None
+        # restart の配置をどう作ったか (impl/multigrid.py など)。metadata に残す
+        self.init_info = None
+        self.active = None
+        if sweep == "active":
+            assert tank_size >= 7
+            self.active = ActiveSites(self.mols)
 
     def init_mols(self, soap_ratio, water_ratio, restart):
         if restart is not None:
-            def encode_raw_mols(raw_mol):
-                if raw_mol[0] == 1:
-                    return np.asarray([MoleculeKind.SoapKind, raw_mol[1]])
-                elif raw_mol[0] == 2:
-                    return np.asarray([MoleculeKind.WaterKind, raw_mol[1]])
-                elif raw_mol[0] == 3:
-                    return np.asarray([MoleculeKind.AirKind, raw_mol[1]])
-                else:
-                    print("invalid restart MolecleKind.")
-                    sys.exit()
-            mols = np.apply_along_axis(encode_raw_mols, 2, restart)
+            mols = np.asarray(restart).astype(MOL_DTYPE)
+            if not np.isin(mols[:, :, 0], list(MoleculeKind)).all():
+                print("invalid restart MolecleKind.")
+                sys.exit()
             W, H, _ = mols.shape
             assert W == self.tank_size and H == self.tank_size
             return mols
 
         soap_num = int(self.tank_size*self.tank_size*soap_ratio)
         water_num = int(self.tank_size*self.tank_size*water_ratio)
-        soaps = [Soap(rng=self.rng) for _ in range(soap_num)]
-        waters = [Water() for _ in range(water_num)]
-        airs = [Air() for _ in range(self.tank_size*self.tank_size-(soap_num+water_num))]
-        mols = soaps + waters + airs
+        air_num = self.tank_size*self.tank_size-(soap_num+water_num)
+        mols = np.full((self.tank_size*self.tank_size, 2), -1, dtype=MOL_DTYPE)
+        mols[:, 0] = np.repeat([MoleculeKind.SoapKind, MoleculeKind.WaterKind, MoleculeKind.AirKind],
+                               [soap_num, water_num, air_num])
+        mols[:soap_num, 1] = self.rng.choice(8, size=soap_num)
         self.rng.shuffle(mols)
-        mols = np.asarray([m.encode() for m in mols])
         mols = mols.reshape(self.tank_size, self.tank_size, 2)
         return mols
 
-    def run(self, loop_num, out_prefix, save_step_num):
-        for loop_idx in range(loop_num):
-            self.step()
-            if loop_idx % save_step_num == 0:
-                print(loop_idx)
-                self.write_log(out_prefix, loop_idx)
+    def metadata(self):
+        """trajectory の header などに残す run の設定"""
+        seed = self.seed
+        if isinstance(seed, np.random.SeedSequence):
+            seed = dict(entropy=seed.entropy, spawn_key=list(seed.spawn_key))
+        metadata = dict(soap_ratio=self.soap_ratio, water_ratio=self.water_ratio, temp_scale=self.temp_scale,
+                        tank_size=self.tank_size, seed=seed, sweep=self.sweep, lec=dataclasses.asdict(self.lec),
+                        moves=self.move_mix)
+        if self.convergence is not None:
+            metadata["convergence"] = self.convergence.summary()
+        if self.init_info is not None:
+            metadata["init"] = self.init_info
+        return metadata
+
+    def run(self, loop_num, out_prefix, save_step_num, trajectory=None, checkpoint=None, checkpoint_step_num=1000,
+            video=None, observables=None, convergence=None, live=None):
+        """
+        loop_idx が loop_num になるまで step を進める (checkpoint から再開した Tank は続きから)。
+        trajectory を与えると、保存する step を log_dir の *.npy ではなく trajectory に追記する。
+        trajectory はファイルパス (ここで開いて閉じる) か TrajectoryWriter。
+        checkpoint を与えると checkpoint_step_num step ごとと最後に save_checkpoint する。
+        video を与えると、保存する step のフレームを動画にも書く。video はファイルパスか VideoWriter
+        (checkpoint から再開したときは open_video が別のファイルにする)。
+        observables を与えると、保存する step ごとに構造の観測量 (impl/observables.py) を時系列に書く。
+        observables はファイルパスか ObservableRecorder。
+        convergence (ConvergenceMonitor) を与えると、平衡と判定した step でフレームを保存して止める
+        (loop_num は上限になる)。判定と統計量は metadata() の "convergence" に入る。
+        checkpoint から戻した Tank は保存されていた monitor を続けて使う。
+        live を与えると、数秒おきに格子とカウンタを共有メモリに publish する (impl/live.py。別プロセスから
+        python -m impl.live <name> で見る)。live は共有メモリの名前 (run の間だけ作る) か LivePublisher。
+        """
+        if convergence is not None and self.convergence is None:
+            self.convergence = convergence
+        monitor = self.convergence
+        writer = self.open_trajectory(trajectory) if isinstance(trajectory, str) else trajectory
+        video_writer = self.open_video(video) if isinstance(video, str) else video
+        recorder = self.open_observables(observables) if isinstance(observables, str) else observables
+        publisher = LivePublisher(live, self.mols.shape, self.metadata()) if isinstance(live, str) else live
+        stats = self.stats
+
+        def save_checkpoint():
+            # checkpoint より前のフレームがディスクに載ってから checkpoint を書く (落ちたときに欠けないように)
+            for sink in (writer, recorder):
+                if sink is not None:
+                    sink.flush()
+            self.save_checkpoint(checkpoint)
+
+        try:
+            for loop_idx in range(self.loop_idx, loop_num):
+                if monitor is not None and monitor.converged:
+                    break
+                if stats is not None:
+                    start = time.perf_counter()
+                self.step()
+                if stats is not None:
+                    io_start = time.perf_counter()
+                    stats.add_step_time(io_start - start)
+                self.loop_idx = loop_idx + 1
+                self.energy_trace.append(self.energy)
+                stop = monitor is not None and monitor.update(self)
+                if loop_idx % save_step_num == 0 or stop:
+                    line = [loop_idx]
+                    if stats is not None:
+                        line.append(stats.format_line())
+                    if monitor is not None:
+                        line.append(monitor.format_line())
+                    print(*line)
+                    if writer is None:
+                        self.write_log(out_prefix, loop_idx)
+                    else:
+                        writer.append(loop_idx, self.mols)
+                    if video_writer is not None:
+                        video_writer.append(self.mols)
+                    if recorder is not None:
+                        recorder.record(loop_idx, self.mols)
+                if publisher is not None:
+                    publisher.update(self)
+                if checkpoint is not None and self.loop_idx % checkpoint_step_num == 0:
+                    save_checkpoint()
+                if stats is not None:
+                    stats.io_time += time.perf_counter() - io_start
+                if stop:
+                    break
+            if checkpoint is not None:
+                save_checkpoint()
+            if publisher is not None:
+                publisher.update(self, force=True)
+        finally:
+            if isinstance(trajectory, str):
+                writer.close()
+            if isinstance(video, str):
+                video_writer.close()
+            if isinstance(observables, str):
+                recorder.close()
+            if isinstance(live, str):
+                publisher.close()
+
+    def open_trajectory(self, path):
+        """run が trajectory に書く TrajectoryWriter。checkpoint から再開したときは続きに追記する"""
+        if self.loop_idx > 0 and os.path.exists(path):
+            # 再開: checkpoint 以降に書かれていたフレームは捨てて追記する
+            return TrajectoryWriter(path, self.mols.shape, mode="a", resume_step=self.loop_idx)
+        return TrajectoryWriter(path, self.mols.shape, metadata=self.metadata())
+
+    def open_video(self, path):
+        """
+        run が書く VideoWriter。動画は追記できないので、checkpoint から再開したときは
+        <path>_from_<loop_idx>.<拡張子> に別の動画として書く (再開前の動画は上書きしない)
+        """
+        if self.loop_idx > 0:
+            root, ext = os.path.splitext(path)
+            path = "{}_from_{}{}".format(root, self.loop_idx, ext)
+        return VideoWriter(path)
+
+    def open_observables(self, path):
+        """run が観測量を書く ObservableRecorder (open_trajectory と同じく再開なら追記)"""
+        if self.loop_idx > 0 and os.path.exists(path):
+            return ObservableRecorder(path, mode="a", resume_step=self.loop_idx)
+        return ObservableRecorder(path, metadata=self.metadata())
+
+    def save_checkpoint(self, path):
+        """
+        格子・乱数の状態・loop_idx・パラメータを path (.npz) に保存する。
+        書きかけのファイルが残らないよう一時ファイルに書いてから置き換える。
+        """
+        state = dict(metadata=self.metadata(), loop_idx=self.loop_idx, rng_state=self.rng.bit_generator.state,
+                     delta_energy=self.delta_energy, check_delta=self.check_delta, energy=self.energy, stats=None)
+        if self.stats is not None:
+            state["stats"] = dict(mc_time=self.stats.mc_time, io_time=self.stats.io_time)
+        buf = io.BytesIO()
+        arrays = dict(mols=self.mols, state=np.array(json.dumps(state)), energy_trace=np.asarray(self.energy_trace))
+        if self.active is not None:
+            # 抽出は sites の並びに依存するので、並びごと保存する
+            arrays["active_sites"] = self.active.sites[:self.active.count]
+        if self.stats is not None:
+            # 再開しても数え続けられるように、採択数と step ごとの時間も残す
+            arrays["stats_counts"] = self.stats.counts
+            arrays["stats_step_times"] = np.asarray(self.stats.step_times, dtype=float)
+        if self.convergence is not None:
+            arrays["convergence_samples"] = np.asarray(self.convergence.samples, dtype=float)
+            arrays["convergence_steps"] = np.asarray(self.convergence.steps, dtype=np.int64)
+        np.savez(buf, **arrays)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buf.getvalue())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def from_checkpoint(cls, path):
+        """save_checkpoint した Tank を復元する。続けて同じ run を呼べば中断しなかった場合と同じ結果になる"""
+        with np.load(path) as data:
+            mols = data["mols"]
+            state = json.loads(str(data["state"]))
+            energy_trace = data["energy_trace"].tolist()
+            active_sites = data["active_sites"] if "active_sites" in data else None
+            if "convergence_samples" in data:
+                convergence = (data["convergence_samples"], data["convergence_steps"])
+            if "stats_counts" in data:
+                stats_arrays = (data["stats_counts"], data["stats_step_times"].tolist())
+        metadata = state["metadata"]
+        seed = metadata["seed"]
+        if isinstance(seed, dict):
+            seed = np.random.SeedSequence(seed["entropy"], spawn_key=tuple(seed["spawn_key"]))
+        tank = cls(metadata["soap_ratio"], metadata["water_ratio"], metadata["temp_scale"],
+                   tank_size=metadata["tank_size"], seed=seed, restart=mols,
+                   lec=LocalEnergyConstant(**metadata["lec"]), delta_energy=state["delta_energy"],
+                   check_delta=state["check_delta"], sweep=metadata["sweep"], moves=metadata.get("moves"),
+                   stats=state.get("stats") is not None)
+        tank.rng.bit_generator.state = state["rng_state"]
+        tank.loop_idx = state["loop_idx"]
+        tank.energy = state["energy"]
+        tank.energy_trace = energy_trace
+        if active_sites is not None:
+            tank.active = ActiveSites(tank.mols, active_sites)
+        tank.init_info = metadata.get("init")
+        if tank.stats is not None:
+            tank.stats.counts[...] = stats_arrays[0]
+            tank.stats.step_times = stats_arrays[1]
+            tank.stats.mc_time = state["stats"]["mc_time"]
+            tank.stats.io_time = state["stats"]["io_time"]
+        if "convergence" in metadata:
+            tank.convergence = ConvergenceMonitor.from_summary(metadata["convergence"], *convergence)
+        return tank
+
+    def energy_field(self):
+        """セルごとの self energy。shape (tank_size, tank_size)"""
+        return self.kernel.energy_field(self.mols)
+
+    def recompute_energy(self):
+        """self.energy を格子全体から計算し直す (ΔE の足し込みの丸め誤差をリセットする)"""
+        self.energy = self.kernel.total_energy(self.mols)
+        return self.energy
 
     def step(self):
+        if self.sweep == "checkerboard":
+            self.energy += self.kernel.checkerboard_sweep(self.mols, self.temp_scale, self.rng, VISIT_PROB,
+                                                          stats=self.stats)
+            return
+        if self.sweep == "active":
+            self.active_step()
+            return
         for row_idx in range(self.tank_size):
             for col_idx in range(self.tank_size):
-                if self.rng.random() < 0.1:
+                if self.rng.random() < VISIT_PROB:
                     self.try_swap_7x7(row_idx, col_idx)
 
+    def active_step(self):
+        """
+        sweep="active" の 1 step。sequential で中心に選ばれる数 (Binomial(N^2, VISIT_PROB)) だけ
+        一様に選んだセルへの提案を行う。inactive なセルへの提案は格子を変えないので、
+        active なセルに当たるまでの回数を幾何分布でまとめて飛ばし、当たったセルは ActiveSites から一様に引く。
+        各提案は一様に選んだセルへの Metropolis 更新のままなので、サンプルする分布は変わらない
+        (sequential とはセルを回る順番が違うので、同じ seed でも軌跡は一致しない)。
+        """
+        n = self.tank_size * self.tank_size
+        remaining = self.rng.binomial(n, VISIT_PROB)
+        active = self.active
+        while len(active) > 0:
+            remaining -= self.rng.geometric(len(active) / n)
+            if remaining < 0:
+                break
+            row_idx, col_idx = active.sample(self.rng)
+            kind = self.mols[row_idx, col_idx, 0]
+            self.try_swap_7x7(row_idx, col_idx)
+            # active は kind だけで決まるので、違う kind との swap が採択されたときだけ判定し直す
+            if self.mols[row_idx, col_idx, 0] != kind:
+                active.refresh(self.mols, row_idx, col_idx)
+
     def try_swap(self, row_idx, col_idx):
         neighbor = self.get_neighbor(row_idx, col_idx)
-        mcmc_utl = MCMCUtl()
+        mcmc_utl = self.mcmc_utl
         new_neighbor = mcmc_utl.try_local_swap(neighbor, self.temp_scale, self.rng)
         self.embed_neighbor(new_neighbor, row_idx, col_idx)
 
     def try_swap_7x7(self, row_idx, col_idx):
+        mcmc_utl = self.mcmc_utl
+        stats = self.stats
+        if stats is not None:
+            kind = self.mols[row_idx, col_idx, 0]
+        if self.delta_energy:
+            is_swap, dE = mcmc_utl.try_swap_delta(self.mols, row_idx, col_idx, self.temp_scale, self.rng)
+            if is_swap:
+                self.energy += dE
+            if stats is not None:
+                d = directions[mcmc_utl.last_swap_pos]
+                # 採択されていれば相手は中心に移っている
+                other = (self.mols[row_idx, col_idx, 0] if is_swap
+                         else self.mols[(row_idx + d[0]) % self.tank_size, (col_idx + d[1]) % self.tank_size, 0])
+                stats.count(SWAP, kind, other, is_swap)
+            is_rotate, dE = mcmc_utl.try_rotate_delta(self.mols, row_idx, col_idx, self.temp_scale, self.rng)
+            if is_rotate:
+                self.energy += dE
+            if stats is not None and self.mols[row_idx, col_idx, 0] == MoleculeKind.SoapKind:
+                stats.count(ROTATE, MoleculeKind.SoapKind, MoleculeKind.SoapKind, is_rotate)
+            self.try_moves(row_idx, col_idx)
+            return
 
         neighbor = self.get_neighbor_7x7(row_idx, col_idx)
-        mcmc_utl = MCMCUtl()
 
-        new_neighbor = mcmc_utl.try_local_swap_7x7(neighbor, self.temp_scale, self.rng)
+        new_neighbor, dE = mcmc_utl.try_local_swap_7x7(neighbor, self.temp_scale, self.rng, return_dE=True)
+        self.energy += dE
+        if stats is not None:
+            # 棄却なら元の配列がそのまま返る
+            d = directions[mcmc_utl.last_swap_pos]
+            stats.count(SWAP, kind, neighbor[3 + d[0], 3 + d[1], 0], new_neighbor is not neighbor)
 
-        new_neighbor = mcmc_utl.try_local_rotate_7x7(new_neighbor, self.temp_scale, self.rng)
+        swapped = new_neighbor
+        new_neighbor, dE = mcmc_utl.try_local_rotate_7x7(new_neighbor, self.temp_scale, self.rng, return_dE=True)
+        self.energy += dE
+        if stats is not None and swapped[3, 3, 0] == MoleculeKind.SoapKind:
+            stats.count(ROTATE, MoleculeKind.SoapKind, MoleculeKind.SoapKind, new_neighbor is not swapped)
 
         self.embed_neighbor_7x7(new_neighbor, row_idx, col_idx)
+        self.try_moves(row_idx, col_idx)
+
+    def try_moves(self, row_idx, col_idx):
+        """swap / rotate の後に、moves の非局所な move をそれぞれの確率で提案する"""
+        for prob, move in self.moves:
+            if self.rng.random() >= prob:
+                continue
+            ret = move.propose(self, row_idx, col_idx)
+            if ret is None:
+                continue
+            accepted, dE, _, kind_a, kind_b = ret
+            if accepted:
+                self.energy += dE
+            if self.stats is not None:
+                self.stats.count(move.stat, kind_a, kind_b, accepted)
 
     def get_neighbor_7x7(self, row_idx, col_idx):
         idx = [(row_idx + di) % self.tank_size for di in range(-3, 4)]  # -3..3
@@ -90,5 +401,4 @@ class Tank:
         self.mols[np.ix_(idx, jdx, [0, 1])] = new_neighbor
 
     def write_log(self, out_prefix, loop_idx):
-        arr = np.apply_along_axis(lambda x: [x[0].value, x[1]], 2, self.mols)
-        np.save("./log/"+out_prefix+"_step_{}".format(loop_idx), arr)
\ No newline at end of file
+        np.save(os.path.join(self.log_dir, out_prefix+"_step_{}".format(loop_idx)), self.mols)
\ No newline at end of file
@@ -0,0 +1,47 @@
+import sys
+import numpy as np
+from impl.molecule import LEC, MoleculeKind, MOL_DTYPE
+from impl.lattice3d import LatticeKernel3D, DIRECTIONS_3D
+from impl.tank import Tank
+
+class Tank3D(Tank):
+    """
+    N x N x N (周期境界) の Tank。mols は (N, N, N, 2) = [kind, dir] で、soap の dir は DIRECTIONS_3D の index。
+    更新は副格子 sweep (sweep="checkerboard") だけ。run・checkpoint・trajectory は Tank と同じで、
+    観測量 (impl/observables.py) と動画は 2D 専用なので使えない。
+    """
+    kernel_class = LatticeKernel3D
+
+    def __init__(self, soap_ratio, water_ratio, temp_scale, tank_size=64, seed=0, restart=None, lec=LEC,
+                 delta_energy=True, check_delta=False, sweep="checkerboard", stats=False, moves=None):
+        assert sweep == "checkerboard" and not moves
+        super().__init__(soap_ratio, water_ratio, temp_scale, tank_size=tank_size, seed=seed, restart=restart,
+                         lec=lec, delta_energy=delta_energy, check_delta=check_delta, sweep=sweep, stats=stats)
+
+    def init_mols(self, soap_ratio, water_ratio, restart):
+        N = self.tank_size
+        if restart is not None:
+            mols = np.asarray(restart).astype(MOL_DTYPE)
+            if not np.isin(mols[..., 0], list(MoleculeKind)).all():
+                print("invalid restart MolecleKind.")
+                sys.exit()
+            assert mols.shape == (N, N, N, 2)
+            return mols
+
+        cell_num = N * N * N
+        soap_num = int(cell_num * soap_ratio)
+        water_num = int(cell_num * water_ratio)
+        air_num = cell_num - (soap_num + water_num)
+        mols = np.full((cell_num, 2), -1, dtype=MOL_DTYPE)
+        mols[:, 0] = np.repeat([MoleculeKind.SoapKind, MoleculeKind.WaterKind, MoleculeKind.AirKind],
+                               [soap_num, water_num, air_num])
+        mols[:soap_num, 1] = self.rng.choice(len(DIRECTIONS_3D), size=soap_num)
+        self.rng.shuffle(mols)
+        return mols.reshape(N, N, N, 2)
+
+    def run(self, loop_num, out_prefix, save_step_num, trajectory=None, checkpoint=None, checkpoint_step_num=1000,
+            video=None, observables=None, convergence=None, live=None):
+        assert video is None and observables is None
+        assert convergence is None or not convergence.observables
+        super().run(loop_num, out_prefix, save_step_num, trajectory=trajectory, checkpoint=checkpoint,
+                    checkpoint_step_num=checkpoint_step_num, convergence=convergence, live=live)
@@ -0,0 +1,172 @@
+"""
+1 run 分のフレーム (Tank.mols) を 1 ファイルに追記していく trajectory 形式。
+
+    MAGIC (8 byte) | header 長 (uint64) | header (JSON) | record | record | ...
+    record = step (int64) | payload 長 (uint64) | payload
+
+header には shape / dtype / compression と run の metadata (比率・温度・seed・LocalEnergyConstant など) が入る。
+payload は圧縮なしなら mols の生バイト列 (そのまま memmap できる)、"zlib" なら zlib で圧縮したもの。
+最後の record が書きかけ (プロセスが落ちた場合) なら読み込み時に無視する。
+"""
+
+import os
+import sys
+import json
+import queue
+import struct
+import threading
+import zlib
+import numpy as np
+
+MAGIC = b"CRUCTRJ1"
+RECORD_HEADER = struct.Struct("<qQ")
+
+class TrajectoryWriter:
+    """
+    フレームを別スレッドで書き出す writer。append はフレームをコピーしてキューに積むだけなので、
+    シミュレーションはディスク待ちで止まらない (キューが queue_size 個たまったときだけ待つ)。
+    mode="a" なら既存ファイルの末尾に追記する (header の shape/dtype は一致している必要がある)。
+    resume_step を与えると、追記の前に step >= resume_step のフレームを捨てる (checkpoint からの再開用)。
+    """
+    def __init__(self, path, shape, metadata=None, dtype=np.int8, compression=None, level=1,
+                 queue_size=64, mode="w", resume_step=None):
+        assert compression in (None, "zlib")
+        self.path = path
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.compression = compression
+        self.level = level
+        if mode == "a" and os.path.exists(path):
+            reader = TrajectoryReader(path)
+            assert reader.shape == self.shape and reader.dtype == self.dtype
+            self.compression = reader.compression
+            self.f = open(path, "r+b")
+            # 書きかけの record (と resume_step 以降のフレーム) があればそこから上書きする
+            end_offset = reader.end_offset
+            if resume_step is not None:
+                drop = [idx for idx, step in enumerate(reader.steps) if step >= resume_step]
+                if drop:
+                    end_offset = reader.offsets[drop[0]] - RECORD_HEADER.size
+            self.f.seek(end_offset)
+            self.f.truncate()
+            reader.close()
+        else:
+            header = dict(shape=list(self.shape), dtype=self.dtype.str, compression=self.compression,
+                          metadata=metadata or {})
+            header = json.dumps(header).encode()
+            self.f = open(path, "wb")
+            self.f.write(MAGIC + struct.pack("<Q", len(header)) + header)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _write_loop(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    break
+                if self.error is not None:
+                    continue
+                step, frame = item
+                payload = frame.tobytes()
+                if self.compression == "zlib":
+                    payload = zlib.compress(payload, self.level)
+                self.f.write(RECORD_HEADER.pack(step, len(payload)) + payload)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def append(self, step, frame):
+        if self.error is not None:
+            raise self.error
+        assert frame.shape == self.shape
+        self.queue.put((int(step), np.array(frame, dtype=self.dtype, copy=True)))
+
+    def flush(self):
+        """キューに積んだフレームを全部書いてディスクまで同期する (checkpoint の前に呼ぶ)"""
+        if self.thread is not None:
+            self.queue.join()
+            if self.error is None:
+                self.f.flush()
+                os.fsync(self.f.fileno())
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self.f.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class TrajectoryReader:
+    """
+    trajectory を開いて record の位置だけを読み、フレームは必要になったときに読む。
+    圧縮なしのフレームは np.memmap (読み込み専用) で返すので、run 全体をメモリに載せない。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, "rb")
+        if self.f.read(len(MAGIC)) != MAGIC:
+            print("invalid trajectory file.")
+            sys.exit()
+        header_len, = struct.unpack("<Q", self.f.read(8))
+        header = json.loads(self.f.read(header_len))
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        self.compression = header["compression"]
+        self.metadata = header["metadata"]
+
+        file_size = os.fstat(self.f.fileno()).st_size
+        self.steps, self.offsets, self.sizes = [], [], []
+        offset = self.f.tell()
+        while offset + RECORD_HEADER.size <= file_size:
+            self.f.seek(offset)
+            step, size = RECORD_HEADER.unpack(self.f.read(RECORD_HEADER.size))
+            if offset + RECORD_HEADER.size + size > file_size:
+                break
+            self.steps.append(step)
+            self.offsets.append(offset + RECORD_HEADER.size)
+            self.sizes.append(size)
+            offset += RECORD_HEADER.size + size
+        self.end_offset = offset
+        self.step_to_idx = {step: idx for idx, step in enumerate(self.steps)}
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, idx):
+        """idx 番目のフレーム"""
+        if self.compression is None:
+            return np.memmap(self.path, dtype=self.dtype, mode="r", offset=self.offsets[idx], shape=self.shape)
+        self.f.seek(self.offsets[idx])
+        payload = zlib.decompress(self.f.read(self.sizes[idx]))
+        return np.frombuffer(payload, dtype=self.dtype).reshape(self.shape)
+
+    def frame_at_step(self, step):
+        """step 番目 (Tank.run の loop_idx) に保存したフレーム"""
+        return self[self.step_to_idx[step]]
+
+    def __iter__(self):
+        for idx, step in enumerate(self.steps):
+            yield step, self[idx]
+
+    def close(self):
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
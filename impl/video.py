@@ -0,0 +1,133 @@
+"""
+Tank.run の保存 step をその場で動画にする frame sink。
+.npy → PNG → 外部ツールで連結、の 3 段の代わりに、フレームをメモリ上で描いて
+ffmpeg (rawvideo rgb24 を stdin に流す) に渡す。ffmpeg が無ければ APNG (animated PNG) を書く。
+描画とエンコードは別スレッドで行う。
+"""
+
+import os
+import queue
+import shutil
+import struct
+import threading
+import tempfile
+import subprocess
+import numpy as np
+from impl import raster
+
+class VideoWriter:
+    """
+    append したフレームを別スレッドで描画して動画に書く。append はフレームをコピーしてキューに積むだけなので
+    シミュレーションは描画やエンコードを待たない (キューが queue_size 個たまったときだけ待つ)。
+    encoder は "ffmpeg" / "apng" / None (ffmpeg が PATH にあれば ffmpeg, 無ければ apng)。
+    apng のときは path の拡張子を .png に変える。
+    """
+    def __init__(self, path, fps=10, scale=4, encoder=None, queue_size=16,
+                 ffmpeg_args=("-c:v", "libx264", "-crf", "18")):
+        if encoder is None:
+            encoder = "ffmpeg" if shutil.which("ffmpeg") else "apng"
+        assert encoder in ("ffmpeg", "apng")
+        if encoder == "apng" and os.path.splitext(path)[1].lower() != ".png":
+            path = os.path.splitext(path)[0] + ".png"
+            print("ffmpeg not found. write APNG:", path)
+        self.path = path
+        self.fps = fps
+        self.scale = scale
+        self.encoder = encoder
+        self.ffmpeg_args = list(ffmpeg_args)
+        self.sprites = raster.make_arrow_sprites(scale)
+        self.shape = None
+        self.proc = None
+        self.f = None
+        self.frame_num = 0
+        self.seq = 0  # APNG の fcTL / fdAT の通し番号
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.error = None
+        self.thread = threading.Thread(target=self._write_loop, daemon=True)
+        self.thread.start()
+
+    def _open(self, img):
+        H, W, _ = img.shape
+        if self.encoder == "ffmpeg":
+            # yuv420p は幅・高さが偶数である必要があるので pad する
+            cmd = ["ffmpeg", "-y", "-loglevel", "error",
+                   "-f", "rawvideo", "-pix_fmt", "rgb24", "-s", "{}x{}".format(W, H), "-r", str(self.fps), "-i", "-",
+                   "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", "-pix_fmt", "yuv420p"] + self.ffmpeg_args + [self.path]
+            # stderr はパイプだと詰まりうるので一時ファイルに受ける (失敗したときにエラーに入れる)
+            self.ffmpeg_log = tempfile.TemporaryFile()
+            self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stderr=self.ffmpeg_log)
+        else:
+            self.f = open(self.path, "wb")
+            # acTL のフレーム数は close で書き直す
+            self.f.write(raster.PNG_SIGNATURE + raster.png_ihdr(img))
+            self.actl_offset = self.f.tell()
+            self.f.write(raster.png_chunk(b"acTL", struct.pack(">II", 0, 0)))
+
+    def _write_frame(self, img):
+        if self.shape is None:
+            self.shape = img.shape
+            self._open(img)
+        assert img.shape == self.shape
+        if self.encoder == "ffmpeg":
+            self.proc.stdin.write(img.tobytes())
+        else:
+            H, W, _ = img.shape
+            self.f.write(raster.png_chunk(b"fcTL", struct.pack(">IIIIIHHBB", self.seq, W, H, 0, 0, 1, self.fps, 0, 0)))
+            self.seq += 1
+            data = raster.png_compress(img)
+            if self.frame_num == 0:
+                self.f.write(raster.png_chunk(b"IDAT", data))
+            else:
+                self.f.write(raster.png_chunk(b"fdAT", struct.pack(">I", self.seq) + data))
+                self.seq += 1
+        self.frame_num += 1
+
+    def _write_loop(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self._write_frame(raster.rasterize(frame, self.scale, self.sprites))
+            except Exception as e:
+                self.error = e
+
+    def append(self, frame):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(np.array(frame, copy=True))
+
+    def _finish(self):
+        if self.proc is not None:
+            try:
+                self.proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            returncode = self.proc.wait()
+            self.ffmpeg_log.seek(0)
+            log = self.ffmpeg_log.read().decode(errors="replace").strip()
+            self.ffmpeg_log.close()
+            if returncode != 0:
+                raise RuntimeError("ffmpeg failed ({}): {}".format(returncode, log))
+        if self.f is not None:
+            self.f.write(raster.png_chunk(b"IEND", b""))
+            self.f.seek(self.actl_offset)
+            self.f.write(raster.png_chunk(b"acTL", struct.pack(">II", self.frame_num, 0)))
+            self.f.close()
+
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+            self._finish()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,35 +1,13 @@
 from impl.tank import Tank
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap, BoundaryNorm
-
-#soap_ratio = 0.2
-#water_ratio = 0.25
-#tank_size = 50
-#save_step_num = 10
-#hot_step_num = 200
-#hot_tmp = 15.0
-#cold_step_num = 100
-#cold_tmp = 0.1
-#loop_num = 50
-#
-#print("loop0 hot")
-#tank = Tank(soap_ratio, water_ratio, hot_tmp, tank_size=tank_size, seed=0)
-#tank.run(hot_step_num+1, "loop0_hot", save_step_num)
-#print("loop0 cold")
-#restart = np.load("./log/loop0_hot_step_{}.npy".format(hot_step_num))
-#tank = Tank(soap_ratio, water_ratio, hot_tmp, tank_size=tank_size, seed=1, restart=restart)
-#tank.run(cold_step_num+1, "loop0_cold", save_step_num)
+
+#from impl.replica import ReplicaExchange
 #
-#for loop_idx in range(1, loop_num+1):
-#    print("loop{} hot".format(loop_idx))
-#    restart = np.load("./log/loop{}_cold_step_{}.npy".format(loop_idx-1, cold_step_num))
-#    tank = Tank(soap_ratio, water_ratio, hot_tmp, tank_size=tank_size, seed=2*loop_idx, restart=restart)
-#    tank.run(hot_step_num+1, "loop{}_hot".format(loop_idx), save_step_num)
-#    print("loop{} cold".format(loop_idx))
-#    restart = np.load("./log/loop{}_hot_step_{}.npy".format(loop_idx, hot_step_num))
-#    tank = Tank(soap_ratio, water_ratio, cold_tmp, tank_size=tank_size, seed=2*loop_idx+1, restart=restart)
-#    tank.run(cold_step_num+1, "loop{}_cold".format(loop_idx), save_step_num)
+## hot/cold のアニールの代わりに、温度ラダー上の replica を並列に回して隣接温度で入れ替える
+#temps = np.geomspace(0.1, 15.0, 12)
+#with ReplicaExchange(0.2, 0.25, temps, tank_size=50, seed=0) as rx:
+#    rx.run(round_num=1000, step_num=10, out_prefix="rx", save_round_num=10)
+#    print(rx.acceptance_rates())
 
 #tank = Tank(0.3, 0.35, 0.1, tank_size=120)
 #tank.run(1001, "exe", 10)
@@ -57,6 +35,10 @@ DIR8 = np.array([[-1, -1], [-1, 0], [-1, 1],
 SOAP, WATER, AIR = 1, 2, 3
 
 def plot_lattice_with_soap_arrows(step, every=1, arrow_scale=0.6, origin="lower"):
+    # 表示するときだけ matplotlib を読み込む (import しただけではウィンドウを開かない)
+    import matplotlib.pyplot as plt
+    from matplotlib.colors import ListedColormap, BoundaryNorm
+
     kind = step[..., 0].astype(int)
     d = step[..., 1].astype(int)
 
@@ -99,5 +81,9 @@ def plot_lattice_with_soap_arrows(step, every=1, arrow_scale=0.6, origin="lower"
     plt.tight_layout()
     plt.show()
 
-step = np.load("./log/exe_step_{}.npy".format(0))   # (H,W,2)
-plot_lattice_with_soap_arrows(step, every=1, arrow_scale=1.5)
+def main(path="./log/exe_step_{}.npy".format(0)):
+    step = np.load(path)   # (H,W,2)
+    plot_lattice_with_soap_arrows(step, every=1, arrow_scale=1.5)
+
+if __name__ == "__main__":
+    main()
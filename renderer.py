@@ -1,15 +1,15 @@
 import numpy as np
-import matplotlib.pyplot as plt
-import glob
 import os
+from impl import raster
 
 # ===== 設定 =====
 LOG_DIR = "./log"
 OUT_DIR = "./png"
 SCALE = 6        # 1セル何px相当にするか
 ARROW_SCALE = 0.4
-
-os.makedirs(OUT_DIR, exist_ok=True)
+FAST = True      # True: matplotlib を使わず impl/raster.py で直接 PNG を作る (process pool で並列)
+FAST_SCALE = 8   # FAST のときの 1セルのピクセル数
+PROCESSES = None # FAST のときのプロセス数 (None なら CPU 数)
 
 # 8方向（あなたの定義と一致）
 DIRS = np.array([
@@ -26,6 +26,9 @@ COLORS = {
 }
 
 def render(arr, out_path):
+    # matplotlib は遅い描画 (FAST = False) のときだけ読み込む
+    import matplotlib.pyplot as plt
+
     H, W, _ = arr.shape
 
     img = np.zeros((H, W, 3))
@@ -55,15 +58,23 @@ def render(arr, out_path):
     plt.close()
 
 
+def main(log_dir=LOG_DIR, out_dir=OUT_DIR, fast=FAST):
+    os.makedirs(out_dir, exist_ok=True)
+    # (src, out) のリスト。src は .npy のパスか (.traj のパス, フレーム index)
+    jobs = raster.collect_jobs(
+        log_dir, out_dir, npy_name=lambda name: "out_frame_{}.png".format(int(name.split("_")[-1])//10))
+    print(len(jobs))
+
+    if fast:
+        raster.render_frames(jobs, scale=FAST_SCALE, processes=PROCESSES)
+    else:
+        for src, out in jobs:
+            print("render:", out)
+            render(raster.load_frame(src), out)
+
+    print("done.")
+
+
 # ===== 実行部 =====
-files = sorted(glob.glob(os.path.join(LOG_DIR, "*_step_*.npy")))
-print(len(files))
-for f in files:
-    name = os.path.splitext(os.path.basename(f))[0]
-    #out = os.path.join(OUT_DIR, name + ".png")
-    out = os.path.join(OUT_DIR, "out_frame_{}.png".format(int(name.split("_")[-1])//10))
-    arr = np.load(f)
-    print("render:", name)
-    render(arr, out)
-
-print("done.")
+if __name__ == "__main__":
+    main()
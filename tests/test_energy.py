@@ -0,0 +1,67 @@
+"""ΔE (swap / rotate / 複数セルの書き換え) と全エネルギーの再計算の突き合わせ (user-001/002/003)"""
+
+import numpy as np
+import pytest
+from impl.lattice import LatticeKernel
+from impl.tank import Tank
+
+def make_tank(sweep="sequential", tank_size=16, seed=0):
+    return Tank(0.3, 0.35, 0.3, tank_size=tank_size, seed=seed, sweep=sweep)
+
+def test_swap_delta_energy_matches_recomputation():
+    tank = make_tank()
+    kernel = LatticeKernel()
+    rng = np.random.default_rng(1)
+    for _ in range(200):
+        pos = tuple(rng.integers(tank.tank_size, size=(2, 1)))
+        swap_pos = rng.integers(len(kernel.offsets), size=1)
+        dE = kernel.swap_delta_energy(tank.mols, pos, swap_pos)[0]
+        mols = tank.mols.copy()
+        tgt = kernel.shift(mols, pos, swap_pos)
+        mols[pos], mols[tgt] = tank.mols[tgt], tank.mols[pos]
+        assert dE == pytest.approx(kernel.total_energy(mols) - kernel.total_energy(tank.mols))
+
+def test_rotate_delta_energy_matches_recomputation():
+    tank = make_tank()
+    kernel = LatticeKernel()
+    rows, cols = np.nonzero(tank.mols[:, :, 0] == 1)
+    for row_idx, col_idx in zip(rows[:50], cols[:50]):
+        for r in range(kernel.rotations.shape[1]):
+            new_dir = kernel.rotations[tank.mols[row_idx, col_idx, 1], r]
+            pos = (np.array([row_idx]), np.array([col_idx]))
+            dE = kernel.rotate_delta_energy(tank.mols, pos, np.array([new_dir]))[0]
+            mols = tank.mols.copy()
+            mols[row_idx, col_idx, 1] = new_dir
+            assert dE == pytest.approx(kernel.total_energy(mols) - kernel.total_energy(tank.mols))
+
+def test_change_delta_energy_with_adjacent_cells():
+    tank = make_tank()
+    kernel = LatticeKernel()
+    rng = np.random.default_rng(2)
+    for _ in range(50):
+        # 隣り合うセルを含む 3x3 のブロックをランダムに並べ替える
+        r0, c0 = rng.integers(tank.tank_size, size=2)
+        rows = (r0 + np.repeat(np.arange(3), 3)) % tank.tank_size
+        cols = (c0 + np.tile(np.arange(3), 3)) % tank.tank_size
+        pos = (rows, cols)
+        new_mols = tank.mols[pos][rng.permutation(9)]
+        dE = kernel.change_delta_energy(tank.mols, pos, new_mols)
+        mols = tank.mols.copy()
+        mols[pos] = new_mols
+        assert dE == pytest.approx(kernel.total_energy(mols) - kernel.total_energy(tank.mols))
+
+@pytest.mark.parametrize("sweep", ["sequential", "checkerboard", "active"])
+def test_energy_bookkeeping(sweep):
+    tank = make_tank(sweep=sweep)
+    for _ in range(5):
+        tank.step()
+    assert tank.energy == pytest.approx(tank.kernel.total_energy(tank.mols))
+
+def test_checkerboard_sweep_returns_accepted_delta():
+    tank = make_tank(sweep="checkerboard", tank_size=18)
+    kernel = tank.kernel
+    rng = np.random.default_rng(3)
+    for _ in range(5):
+        before = kernel.total_energy(tank.mols)
+        dE = kernel.checkerboard_sweep(tank.mols, tank.temp_scale, rng, 0.5)
+        assert dE == pytest.approx(kernel.total_energy(tank.mols) - before)
@@ -0,0 +1,67 @@
+"""
+非局所な move の対称性 (user-018): 採択された move から、同じ中心で提案できる逆向きの move が
+元の配置に戻し、ΔE がちょうど符号反転になること (Metropolis で詳細つり合いを満たす条件)
+"""
+
+import numpy as np
+import pytest
+from impl.molecule import MoleculeKind
+from impl.moves import KawasakiMove, ClusterMove, make_moves
+from impl.tank import Tank
+
+S, W, A = (MoleculeKind.SoapKind.value, MoleculeKind.WaterKind.value, MoleculeKind.AirKind.value)
+
+def island_mols(N=10):
+    """water の中に soap の小さなクラスタと air が少しある配置"""
+    mols = np.zeros((N, N, 2), dtype=np.int8)
+    mols[:, :, 0] = W
+    mols[:, :, 1] = -1
+    for r, c, d in [(4, 4, 0), (4, 5, 2), (5, 4, 4), (5, 5, 6), (6, 5, 1)]:
+        mols[r, c] = (S, d)
+    mols[1, 1:4, 0] = A
+    return mols
+
+def propose(tank, move, center, mols, seed):
+    """mols から center で move を 1 回提案する。(採択されたか, ΔE, 提案後の mols)"""
+    tank.mols = mols.copy()
+    tank.rng = np.random.default_rng(seed)
+    ret = move.propose(tank, *center)
+    if ret is None:
+        return False, 0.0, tank.mols
+    accepted, dE, _, _, _ = ret
+    return accepted, dE, tank.mols
+
+@pytest.mark.parametrize("move,center", [
+    (KawasakiMove(), (4, 4)),
+    (ClusterMove("translate"), (4, 4)),
+    (ClusterMove("rotate"), (4, 4)),
+])
+def test_reverse_move(move, center):
+    # 温度を十分高くして、提案した move がほぼ必ず採択されるようにする
+    tank = Tank(0.3, 0.35, 1e12, tank_size=10, restart=island_mols())
+    original = tank.mols.copy()
+    forward = None
+    for seed in range(1000):
+        accepted, dE, mols = propose(tank, move, center, original, seed)
+        if accepted and not np.array_equal(mols, original):
+            forward = dE, mols
+            break
+    assert forward is not None
+    dE, moved = forward
+    assert dE == pytest.approx(tank.kernel.total_energy(moved) - tank.kernel.total_energy(original))
+
+    for seed in range(5000):
+        accepted, reverse_dE, mols = propose(tank, move, center, moved, seed)
+        if accepted and np.array_equal(mols, original):
+            assert reverse_dE == pytest.approx(-dE)
+            return
+    pytest.fail("no reverse move found")
+
+def test_make_moves_options():
+    moves = make_moves({"kawasaki": 0.1, "cluster_translate": {"prob": 0.2, "max_size": 7}, "cluster_rotate": 0})
+    assert [prob for prob, _ in moves] == [0.1, 0.2]
+    assert moves[1][1].max_size == 7
+    with pytest.raises(ValueError):
+        make_moves({"bogus": 0.1})
+    with pytest.raises(ValueError):
+        make_moves({"kawasaki": {"prob": 0.1, "max_size": 7}})
@@ -0,0 +1,29 @@
+"""fix_composition が kind ごとの個数をちょうど合わせること (user-022)"""
+
+import numpy as np
+import pytest
+from impl.multigrid import fix_composition, target_counts, S
+from impl.tank import Tank
+
+def counts(mols):
+    return {kind: int((mols[:, :, 0] == kind).sum()) for kind in (1, 2, 3)}
+
+@pytest.mark.parametrize("ratios", [(0.3, 0.35), (0.1, 0.6), (0.5, 0.5)])
+def test_fix_composition_counts(ratios):
+    N = 20
+    rng = np.random.default_rng(0)
+    # 別の組成の配置を目標の組成に合わせる
+    mols = Tank(0.4, 0.3, 0.3, tank_size=N, seed=1).mols.copy()
+    target = target_counts(N, *ratios)
+    fix_composition(mols, target, rng)
+    assert counts(mols) == {int(kind): num for kind, num in target.items()}
+    is_soap = mols[:, :, 0] == S
+    assert ((mols[:, :, 1] >= 0) & (mols[:, :, 1] < 8))[is_soap].all()
+    assert (mols[:, :, 1] == -1)[~is_soap].all()
+
+def test_fix_composition_keeps_matching_lattice():
+    N = 20
+    mols = Tank(0.3, 0.35, 0.3, tank_size=N, seed=1).mols.copy()
+    before = mols.copy()
+    fix_composition(mols, target_counts(N, 0.3, 0.35), np.random.default_rng(0))
+    assert np.array_equal(mols, before)
@@ -0,0 +1,23 @@
+"""solve_wham を答えのわかる 2 準位系で確かめる (user-021)"""
+
+import numpy as np
+import pytest
+from impl.reweight import solve_wham
+
+def test_two_state_free_energy():
+    # E = 0, 1 の 2 状態 (縮退なし)。exp(-1/T) が 1/3 と 1/2 になる 2 つの温度で、
+    # 期待値どおりの個数 (3:1 と 2:1) のサンプルがあれば WHAM の解は厳密に Z の比になる
+    temps = np.array([1 / np.log(3), 1 / np.log(2)])
+    energies = np.array([0.0] * 300 + [1.0] * 100 + [0.0] * 200 + [1.0] * 100)
+    n_samples = np.array([400, 300])
+    u = energies[None, :] / temps[:, None]
+    f, log_den = solve_wham(u, n_samples)
+    z = 1 + np.exp(-1 / temps)
+    assert f[0] == 0.0
+    assert f[1] == pytest.approx(-np.log(z[1] / z[0]), abs=1e-8)
+    assert log_den.shape == energies.shape
+
+def test_single_run_is_trivial():
+    u = np.array([[0.0, 1.0, 2.0]])
+    f, _ = solve_wham(u, np.array([3]))
+    assert f.tolist() == [0.0]
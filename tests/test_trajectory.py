@@ -0,0 +1,57 @@
+"""TrajectoryWriter / TrajectoryReader の往復と、追記・再開時の切り詰め (user-008)"""
+
+import numpy as np
+from impl.trajectory import TrajectoryWriter, TrajectoryReader
+
+SHAPE = (6, 5, 2)
+
+def frame(step):
+    return np.full(SHAPE, step, dtype=np.int8)
+
+def write(path, steps, **kwargs):
+    with TrajectoryWriter(str(path), SHAPE, **kwargs) as writer:
+        for step in steps:
+            writer.append(step, frame(step))
+
+def read(path):
+    with TrajectoryReader(str(path)) as reader:
+        return reader.metadata, [(step, np.array(f)) for step, f in reader]
+
+def test_round_trip(tmp_path):
+    for compression in (None, "zlib"):
+        path = tmp_path / "{}.traj".format(compression)
+        write(path, range(0, 50, 10), metadata=dict(seed=3), compression=compression)
+        metadata, frames = read(path)
+        assert metadata == dict(seed=3)
+        assert [step for step, _ in frames] == [0, 10, 20, 30, 40]
+        for step, f in frames:
+            assert np.array_equal(f, frame(step))
+
+def test_append(tmp_path):
+    path = tmp_path / "a.traj"
+    write(path, [0, 1, 2])
+    write(path, [3, 4], mode="a")
+    _, frames = read(path)
+    assert [step for step, _ in frames] == [0, 1, 2, 3, 4]
+
+def test_resume_drops_frames_after_checkpoint(tmp_path):
+    path = tmp_path / "r.traj"
+    write(path, [0, 10, 20, 30])
+    # step 20 の checkpoint から再開: 20 以降は書き直される
+    write(path, [20, 30, 40], mode="a", resume_step=20)
+    _, frames = read(path)
+    assert [step for step, _ in frames] == [0, 10, 20, 30, 40]
+    for step, f in frames:
+        assert np.array_equal(f, frame(step))
+
+def test_append_truncates_partial_record(tmp_path):
+    path = tmp_path / "p.traj"
+    write(path, [0, 1])
+    with open(path, "ab") as f:
+        f.write(b"\x02\x00\x00\x00\x00\x00\x00\x00\xff")
+    _, frames = read(path)
+    assert [step for step, _ in frames] == [0, 1]
+    write(path, [2], mode="a")
+    _, frames = read(path)
+    assert [step for step, _ in frames] == [0, 1, 2]
+    assert np.array_equal(frames[-1][1], frame(2))